@@ -0,0 +1,226 @@
+import multiprocessing as mp
+import os
+import queue
+
+import torch
+
+from .inference_server import InferenceServer
+
+# Decoupled actor-learner mode. Rollout workers, each in its own process with its own CannoliEnv (and tracer)
+# and a copy of the policy (or a client of a shared InferenceServer), collect whole episodes into the slots of
+# a shared-memory RolloutRing while the learner trains on the episodes already collected. After every
+# optimizer step the learner publishes its weights to SharedWeights, and a worker picks up the latest version
+# before each episode. Episodes therefore lag the learner by a few updates. Every slot records the policy
+# version that collected it, and the learner corrects for the lag with V-trace (see advantage.vtrace).
+
+POLL_INTERVAL = 1.0
+
+
+class RolloutRing:
+    """
+    `slots` fixed-shape episode buffers in shared memory. Free slot indices circulate from the learner to
+    the workers, full ones back from the workers to the learner, so an episode is written once and read once
+    without being pickled
+    """
+
+    def __init__(self, slots: int, steps: int, state_dim: int, hidden_shape: tuple, ctx):
+        self.slots = slots
+        self.states = torch.zeros((slots, steps, state_dim)).share_memory_()
+        self.next_states = torch.zeros((slots, steps, state_dim)).share_memory_()
+        self.actions = torch.zeros((slots, steps), dtype=torch.long).share_memory_()
+        self.logp = torch.zeros((slots, steps)).share_memory_()
+        self.rewards = torch.zeros((slots, steps)).share_memory_()
+        self.dones = torch.zeros((slots, steps), dtype=torch.bool).share_memory_()
+        # the recurrent state carried into the first step
+        self.hidden = torch.zeros((slots,) + tuple(hidden_shape)).share_memory_()
+        # final observation of the episode, for reproducers
+        self.final_state = torch.zeros((slots, steps, state_dim)).share_memory_()
+        self.version = torch.zeros(slots, dtype=torch.long).share_memory_()
+        self.length = torch.zeros(slots, dtype=torch.long).share_memory_()
+
+        self.free = ctx.Queue()
+        self.full = ctx.Queue()
+        for slot in range(slots):
+            self.free.put(slot)
+
+    def episode(self, slot: int) -> dict:
+        """
+        copy of the episode in slot, which can be released right after
+        """
+        n = int(self.length[slot])
+        return {"states": self.states[slot, :n].clone(), "next_states": self.next_states[slot, :n].clone(),
+                "actions": self.actions[slot, :n].clone(), "logp": self.logp[slot, :n].clone(),
+                "rewards": self.rewards[slot, :n].clone(), "dones": self.dones[slot, :n].clone(),
+                "hidden": self.hidden[slot].clone(), "final_state": self.final_state[slot].clone(),
+                "version": int(self.version[slot])}
+
+
+class SharedWeights:
+    """
+    the learner's latest policy parameters in shared memory, with a version counter bumped on every publish
+    """
+
+    def __init__(self, agent, ctx):
+        self.tensors = {name: tensor.detach().clone().share_memory_() for name, tensor in agent.state_dict().items()}
+        self.version = ctx.Value("l", 0)
+        self.lock = ctx.Lock()
+
+    def publish(self, agent) -> int:
+        with self.lock, torch.no_grad():
+            for name, tensor in agent.state_dict().items():
+                self.tensors[name].copy_(tensor)
+            self.version.value += 1
+            return self.version.value
+
+    def load(self, agent) -> int:
+        with self.lock:
+            agent.load_state_dict(self.tensors)
+            return self.version.value
+
+
+class _LocalPolicy:
+    # the worker's own copy of the policy, the interface of inference_server.InferenceClient
+
+    def __init__(self, weights: SharedWeights, agent_kwargs: dict):
+        from .recurrent_actor_critic import ActorCritic
+
+        self.weights = weights
+        self.agent = ActorCritic(**agent_kwargs)
+        self.version = -1
+        self.hidden = None
+
+    def begin_episode(self) -> None:
+        if self.weights.version.value != self.version:
+            self.version = self.weights.load(self.agent)
+        self.hidden = self.agent.initial_state()
+
+    def step(self, observation: torch.Tensor) -> tuple:
+        _, action, log_prob, value, self.hidden = self.agent.step(observation, self.hidden)
+        return int(action), float(log_prob), float(value), self.version
+
+
+def _actor_worker(ring: RolloutRing, policy, stop, env_kwargs: dict):
+    """
+    collects episodes with the latest published policy until stop is set. policy is a _LocalPolicy or an
+    InferenceClient
+    """
+    from libs.cannoli_env import CannoliEnv
+
+    torch.set_num_threads(1)
+    env = CannoliEnv(**env_kwargs)
+    try:
+        while not stop.is_set():
+            try:
+                slot = ring.free.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                continue
+
+            state = env.reset()
+            policy.begin_episode()
+            # every episode starts from the zero recurrent state
+            ring.hidden[slot] = 0
+            steps = ring.states.shape[1]
+            for step in range(steps):
+                # as RiskAwarePPO._live_steps, the policy acts on the row the previous step wrote
+                observation = state[step - 1] if step else torch.zeros_like(state[0])
+                action, log_prob, _, version = policy.step(observation)
+                state, reward, done, _ = env.step(env.action_space[action])
+
+                ring.states[slot, step] = observation
+                ring.next_states[slot, step] = state[step]
+                ring.actions[slot, step] = action
+                ring.logp[slot, step] = log_prob
+                ring.rewards[slot, step] = float(reward)
+                ring.dones[slot, step] = bool(done)
+                # the oldest weights that acted in the episode
+                if not step:
+                    ring.version[slot] = version
+                if done:
+                    break
+            ring.final_state[slot] = state
+            ring.length[slot] = step + 1
+            ring.full.put(slot)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        env.close()
+
+
+class ActorLearner:
+    """
+    Starts `num_workers` rollout workers, env_kwargs being CannoliEnv arguments (as for VectorCannoliEnv) and
+    agent_kwargs ActorCritic ones, and hands their episodes to the learner
+
+        learner = ActorLearner(env_kwargs, agent_kwargs, agent, num_workers=2)
+        episode = learner.get()    # dict of the episode's tensors
+        learner.publish(agent)     # after an optimizer step
+
+    With `inference` (max_batch, max_wait) the workers hold no policy, their steps are answered in batches by
+    a single InferenceServer process (see inference_server.py).
+
+    stats counts the episodes received and the policy lag (published versions behind the learner) summed
+    over them.
+    """
+
+    def __init__(self, env_kwargs: dict, agent_kwargs: dict, agent, num_workers: int = 2, slots: int = None,
+                 inference: dict = None, start_method: str = None):
+        ctx = mp.get_context(start_method)
+        steps = env_kwargs["max_steps_episode"]
+        hidden = agent.initial_state()
+        self.ring = RolloutRing(slots or 2 * num_workers, steps, agent_kwargs["state_dim"], hidden.shape, ctx)
+        self.weights = SharedWeights(agent, ctx)
+        self.stop = ctx.Event()
+        self.stats = {"episodes": 0, "policy_lag": 0}
+        self.closed = False
+
+        self.server = InferenceServer(agent_kwargs, self.weights, num_workers, hidden.shape, ctx,
+                                      **inference) if inference is not None else None
+
+        base_id = os.getpid()
+        self.processes = []
+        for i in range(num_workers):
+            worker_kwargs = dict(env_kwargs, nav_id=f"{base_id}_actor_{i}")
+            policy = self.server.client(i) if self.server is not None else _LocalPolicy(self.weights, agent_kwargs)
+            process = ctx.Process(target=_actor_worker, args=(self.ring, policy, self.stop, worker_kwargs),
+                                  daemon=True)
+            process.start()
+            self.processes.append(process)
+
+    def get(self) -> dict:
+        """
+        the next collected episode, blocks until a worker delivers one
+        """
+        while True:
+            try:
+                slot = self.ring.full.get(timeout=POLL_INTERVAL)
+                break
+            except queue.Empty:
+                if not any(process.is_alive() for process in self.processes):
+                    raise RuntimeError("all rollout workers exited")
+        episode = self.ring.episode(slot)
+        self.ring.free.put(slot)
+        self.stats["episodes"] += 1
+        self.stats["policy_lag"] += self.weights.version.value - episode["version"]
+        return episode
+
+    def publish(self, agent) -> int:
+        return self.weights.publish(agent)
+
+    def metrics(self) -> dict:
+        episodes = max(self.stats["episodes"], 1)
+        out = {"actor_learner/episodes": float(self.stats["episodes"]),
+               "actor_learner/policy_lag": self.stats["policy_lag"] / episodes}
+        if self.server is not None:
+            out.update(self.server.metrics())
+        return out
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self.stop.set()
+        # workers finish their episode first, which may still need the server
+        for process in self.processes:
+            process.join()
+        if self.server is not None:
+            self.server.close()
@@ -0,0 +1,111 @@
+import functools
+
+import torch
+
+# Discounted returns and generalized advantage estimation for a whole rollout batch at once.
+#
+# Inputs are [num_envs, T] tensors, env i's steps along the time axis, where dones[i, t] marks the last step
+# of an episode: nothing after it is discounted into t, and last_value[i] (the critic's estimate of the state
+# after step T - 1) only bootstraps the steps of env i's unfinished trailing episode. Both estimators are the
+# backward recursion
+#
+#   x_t = y_t + discount * (1 - done_t) * x_t+1
+#
+# Within a block of BLOCK_STEPS steps it is unrolled into a [block, block] matrix of discount powers masked to
+# the episode of every step, so a block of every env is a single batched matmul. Blocks are chained back to
+# front through x at their first step, rollouts of up to BLOCK_STEPS steps take one pass.
+
+BLOCK_STEPS = 32
+
+
+@functools.lru_cache(maxsize=32)
+def _powers(T: int, discount: float, device: torch.device) -> torch.Tensor:
+    # [t, s] = discount^(s - t) for s >= t, 0 below the diagonal
+    steps = torch.arange(T, device=device)
+    lag = steps[None, :] - steps[:, None]
+    return torch.where(lag >= 0, discount ** lag.clamp(min=0).to(torch.float32), torch.zeros((), device=device))
+
+
+@functools.lru_cache(maxsize=32)
+def _steps_left_powers(T: int, discount: float, device: torch.device) -> torch.Tensor:
+    # discount^(T - t), what the x following the block is worth at step t
+    return discount ** torch.arange(T, 0, -1, device=device, dtype=torch.float32)
+
+
+def discounted_sum(y: torch.Tensor, dones: torch.Tensor, discount: float, carry: torch.Tensor = None,
+                   block_steps: int = BLOCK_STEPS) -> torch.Tensor:
+    """
+    [num_envs, T] x of the recursion above, carry [num_envs] being x_T (0 if None)
+    """
+    y = y.to(torch.float32)
+    dones = dones.to(torch.int32)
+    discount = float(discount)
+    out = torch.empty_like(y)
+    carry = torch.zeros(y.shape[0], device=y.device) if carry is None else carry.to(torch.float32)
+    T = y.shape[-1]
+    for start in reversed(range(0, T, block_steps)):
+        stop = min(start + block_steps, T)
+        block_dones = dones[:, start:stop]
+        # episode of every step, a done closes the episode after its own step
+        episode = torch.cumsum(block_dones, dim=-1) - block_dones
+        same_episode = episode[:, :, None] == episode[:, None, :]
+        x = torch.matmul(_powers(stop - start, discount, y.device) * same_episode, y[:, start:stop, None])[..., 0]
+        # steps without a done between them and the end of the block continue into the carry
+        open_steps = torch.flip(torch.cumsum(torch.flip(block_dones, [-1]), dim=-1), [-1]) == 0
+        x += open_steps * _steps_left_powers(stop - start, discount, y.device) * carry[:, None]
+        out[:, start:stop] = x
+        carry = x[:, 0]
+    return out
+
+
+def discounted_returns(rewards: torch.Tensor, dones: torch.Tensor, last_value: torch.Tensor,
+                       gamma: float) -> torch.Tensor:
+    """
+    [num_envs, T] discounted returns, bootstrapped from last_value [num_envs] where the episode is unfinished
+    """
+    return discounted_sum(rewards, dones, gamma, carry=last_value)
+
+
+def generalized_advantages(rewards: torch.Tensor, values: torch.Tensor, dones: torch.Tensor,
+                           last_value: torch.Tensor, gamma: float, lam: float) -> torch.Tensor:
+    """
+    [num_envs, T] GAE(gamma, lam) advantages given the critic's values [num_envs, T] of the visited states
+    """
+    rewards, values = rewards.to(torch.float32), values.to(torch.float32)
+    next_values = torch.cat([values[:, 1:], last_value.to(torch.float32)[:, None]], dim=-1)
+    deltas = rewards + gamma * (~dones.to(torch.bool)) * next_values - values
+    return discounted_sum(deltas, dones, gamma * lam)
+
+
+def returns_and_advantages(rewards: torch.Tensor, values: torch.Tensor, dones: torch.Tensor,
+                           last_value: torch.Tensor, gamma: float, lam: float) -> tuple:
+    return (discounted_returns(rewards, dones, last_value, gamma),
+            generalized_advantages(rewards, values, dones, last_value, gamma, lam))
+
+
+def vtrace(behaviour_logp: torch.Tensor, target_logp: torch.Tensor, rewards: torch.Tensor, values: torch.Tensor,
+           dones: torch.Tensor, last_value: torch.Tensor, gamma: float, rho_clip: float = 1.0,
+           c_clip: float = 1.0) -> tuple:
+    """
+    V-trace value targets and policy gradient advantages [num_envs, T] (Espeholt et al., IMPALA) of steps taken
+    by an older behaviour policy, values being the current critic's. Importance weights are truncated at
+    rho_clip for the targets and at c_clip for how far a correction propagates back in time. The per-step
+    trace coefficients rule out the discount matrix above, the recursion is scanned back to front instead.
+    """
+    ratios = torch.exp(target_logp.to(torch.float32) - behaviour_logp.to(torch.float32))
+    rhos, cs = ratios.clamp(max=rho_clip), ratios.clamp(max=c_clip)
+    values, last_value = values.to(torch.float32), last_value.to(torch.float32)
+    discounts = gamma * (~dones.to(torch.bool)).to(torch.float32)
+
+    next_values = torch.cat([values[:, 1:], last_value[:, None]], dim=-1)
+    deltas = rhos * (rewards.to(torch.float32) + discounts * next_values - values)
+    corrections = torch.empty_like(deltas)
+    acc = torch.zeros_like(last_value)
+    for t in reversed(range(deltas.shape[-1])):
+        acc = deltas[:, t] + discounts[:, t] * cs[:, t] * acc
+        corrections[:, t] = acc
+    vs = values + corrections
+
+    next_vs = torch.cat([vs[:, 1:], last_value[:, None]], dim=-1)
+    advantages = rhos * (rewards.to(torch.float32) + discounts * next_vs - values)
+    return vs, advantages
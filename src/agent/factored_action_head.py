@@ -0,0 +1,142 @@
+import math
+
+import numpy as np
+import torch
+from torch import nn
+from torch.distributions import Categorical
+
+from libs.action_space import NO_PARAM
+
+# Autoregressive factored policy head for parameterized action spaces such as cromulence demoone's, where
+# almost every action is (command, address) and a flat Categorical spends most of the policy's parameters
+# and every step's softmax on one giant output layer.
+#
+# An action is chosen as its command, then the index of its address among the addresses of that command,
+# one bit at a time from the most significant one. Every bit is conditioned on the policy features, the
+# command and the bits chosen before it, so the head holds O((commands + address bits) * hidden) parameters
+# and a step costs O(address bits) instead of O(actions). Bits that would lead past the last address of the
+# command are masked, commands without a parameter choose no bits at all.
+
+
+class ActionFactors:
+    """
+    (command, address index) <-> flat index mapping of an action space, a list of (command, param) tuples as
+    CannoliEnv takes it or an ActionSpace (see libs/action_space.py)
+    """
+
+    def __init__(self, action_space):
+        if hasattr(action_space, "columns"):
+            commands, params = action_space.columns()
+        else:
+            commands = np.array([action[0] for action in action_space], dtype=np.int64)
+            params = np.array([action[1] if len(action) > 1 and action[1] is not None else NO_PARAM
+                               for action in action_space], dtype=np.int64)
+        self.commands, command_of = np.unique(commands, return_inverse=True)
+
+        # commands without a parameter have a single address, None
+        address_of = np.zeros(len(commands), dtype=np.int64)
+        n_addresses = np.ones(len(self.commands), dtype=np.int64)
+        for c, command in enumerate(self.commands):
+            members = np.flatnonzero(command_of == c)
+            has_param = params[members] != NO_PARAM
+            if has_param.all():
+                addresses, address_of[members] = np.unique(params[members], return_inverse=True)
+                n_addresses[c] = len(addresses)
+            elif has_param.any():
+                raise ValueError(f"command {command} appears both with and without a parameter")
+
+        self.n_addresses = torch.from_numpy(n_addresses)
+        self.address_bits = max(math.ceil(math.log2(n)) for n in n_addresses.tolist())
+        self.command_of = torch.from_numpy(command_of.astype(np.int64))
+        self.address_of = torch.from_numpy(address_of)
+        self.flat_ids = torch.full((len(self.commands), int(n_addresses.max())), -1, dtype=torch.long)
+        self.flat_ids[self.command_of, self.address_of] = torch.arange(len(commands))
+
+    def __len__(self) -> int:
+        return len(self.command_of)
+
+
+class FactoredActionHead(nn.Module):
+
+    def __init__(self, hidden_size: int, factors: ActionFactors):
+        super().__init__()
+        self.factors = factors
+        self.bits = factors.address_bits
+
+        self.command = nn.Linear(hidden_size, len(factors.commands))
+        self.command_embedding = nn.Embedding(len(factors.commands), hidden_size)
+        # embedding of bit k being b at index 2 * k + b, summed over the bits chosen so far
+        self.bit_embedding = nn.Embedding(max(2 * self.bits, 1), hidden_size)
+        self.bit_weight = nn.Parameter(torch.zeros(max(self.bits, 1), hidden_size))
+        self.bit_bias = nn.Parameter(torch.zeros(max(self.bits, 1)))
+        nn.init.normal_(self.bit_weight, std=hidden_size ** -0.5)
+
+        self.register_buffer("n_addresses", factors.n_addresses.clone(), persistent=False)
+        self.register_buffer("flat_ids", factors.flat_ids.clone(), persistent=False)
+        self.register_buffer("command_of", factors.command_of.clone(), persistent=False)
+        self.register_buffer("address_of", factors.address_of.clone(), persistent=False)
+        self.register_buffer("place", 2 ** torch.arange(self.bits - 1, -1, -1), persistent=False)
+
+    def forward(self, features: torch.Tensor) -> "FactoredCategorical":
+        return FactoredCategorical(self, features)
+
+
+class FactoredCategorical:
+    """
+    distribution over the flat action indices of a FactoredActionHead, sampled and scored factor by factor
+    """
+
+    def __init__(self, head: FactoredActionHead, features: torch.Tensor):
+        self.head = head
+        self.features = features
+        self.command = Categorical(logits=head.command(features))
+
+    def _bit_logits(self, command: torch.Tensor, prefix: torch.Tensor, k) -> torch.Tensor:
+        # k is the bit index, or a tensor of all of them when prefix holds one prefix per bit
+        conditioning = self.features + self.head.command_embedding(command)
+        if prefix.dim() > conditioning.dim():
+            conditioning = conditioning.unsqueeze(-2)
+        h = torch.tanh(conditioning + prefix)
+        return (h * self.head.bit_weight[k]).sum(-1) + self.head.bit_bias[k]
+
+    def _one_allowed(self, command: torch.Tensor, chosen: torch.Tensor, place) -> torch.Tensor:
+        # setting the next bit keeps the address index below the command's number of addresses
+        return (chosen + place) < self.head.n_addresses[command]
+
+    def sample(self) -> torch.Tensor:
+        head = self.head
+        with torch.no_grad():
+            command = self.command.sample()
+            chosen = torch.zeros_like(command)
+            prefix = torch.zeros_like(self.features)
+            for k in range(head.bits):
+                place = 1 << (head.bits - 1 - k)
+                logits = self._bit_logits(command, prefix, k)
+                bit = torch.bernoulli(torch.sigmoid(logits)).long() * self._one_allowed(command, chosen, place)
+                chosen = chosen + bit * place
+                prefix = prefix + head.bit_embedding(2 * k + bit)
+            return head.flat_ids[command, chosen]
+
+    def log_prob(self, actions: torch.Tensor) -> torch.Tensor:
+        head = self.head
+        actions = actions.long()
+        command, address = head.command_of[actions], head.address_of[actions]
+        log_p = self.command.log_prob(command)
+        if not head.bits:
+            return log_p
+
+        # teacher forced, every bit is scored from the prefix of the bits actually chosen before it
+        bits = (address.unsqueeze(-1) // head.place) % 2
+        ks = torch.arange(head.bits, device=bits.device)
+        embedded = head.bit_embedding(2 * ks + bits)
+        prefix = torch.cumsum(embedded, dim=-2) - embedded
+        logits = self._bit_logits(command, prefix, ks)
+        chosen = (address.unsqueeze(-1) // (2 * head.place)) * (2 * head.place)
+        allowed = self._one_allowed(command.unsqueeze(-1), chosen, head.place)
+        bit_log_p = torch.where(bits.bool(), nn.functional.logsigmoid(logits), nn.functional.logsigmoid(-logits))
+        # a forced 0 bit is certain
+        return log_p + torch.where(allowed, bit_log_p, torch.zeros_like(bit_log_p)).sum(-1)
+
+    def entropy(self) -> torch.Tensor:
+        # of the command factor, the address bits' entropy depends on the command sampled
+        return self.command.entropy()
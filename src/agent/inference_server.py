@@ -0,0 +1,131 @@
+import queue
+import time
+
+import torch
+
+# Central policy inference for rollout workers. Instead of every worker running its own ActorCritic on a
+# single observation per step, workers write their observation into their row of a shared-memory request
+# table and wait. The server process gathers the pending rows, up to max_batch of them or whatever arrived
+# within max_wait seconds of the first, and answers all of them with one batched ActorCritic.step. The
+# recurrent state of every worker's episode stays in the table, the weights exist once, in the server,
+# which reloads them from SharedWeights whenever the learner published a new version.
+
+POLL_INTERVAL = 1.0
+# a server whose heartbeat is older than this is considered dead, its clients stop waiting for it
+HEARTBEAT_TIMEOUT = 10 * POLL_INTERVAL
+
+
+class _RequestTable:
+
+    def __init__(self, num_clients: int, state_dim: int, hidden_shape: tuple, ctx):
+        self.observations = torch.zeros((num_clients, state_dim)).share_memory_()
+        self.hidden = torch.zeros((num_clients,) + tuple(hidden_shape)).share_memory_()
+        # set by a client whose episode starts with this request, the server zeroes its recurrent state
+        self.reset = torch.zeros(num_clients, dtype=torch.bool).share_memory_()
+        self.actions = torch.zeros(num_clients, dtype=torch.long).share_memory_()
+        self.logp = torch.zeros(num_clients).share_memory_()
+        self.values = torch.zeros(num_clients).share_memory_()
+        # weights version that answered the last request
+        self.version = torch.zeros(num_clients, dtype=torch.long).share_memory_()
+
+        self.requests = ctx.Queue()
+        self.answered = [ctx.Semaphore(0) for _ in range(num_clients)]
+        # time.monotonic() of the server's last loop, 0 once it exited
+        self.heartbeat = ctx.Value("d", time.monotonic(), lock=False)
+
+
+class InferenceClient:
+    """
+    a worker's handle on the server, step() blocks until the server answered and raises RuntimeError if the
+    server stopped beating
+    """
+
+    def __init__(self, table: _RequestTable, index: int):
+        self.table = table
+        self.index = index
+        self.pending_reset = True
+
+    def begin_episode(self) -> None:
+        self.pending_reset = True
+
+    def step(self, observation: torch.Tensor) -> tuple:
+        """
+        (action, log_prob, value, weights version) for observation, continuing the episode's recurrent state
+        """
+        t, i = self.table, self.index
+        t.observations[i] = observation
+        t.reset[i] = self.pending_reset
+        self.pending_reset = False
+        t.requests.put(i)
+        while not t.answered[i].acquire(timeout=POLL_INTERVAL):
+            if time.monotonic() - t.heartbeat.value > HEARTBEAT_TIMEOUT:
+                raise RuntimeError("inference server is not running")
+        return int(t.actions[i]), float(t.logp[i]), float(t.values[i]), int(t.version[i])
+
+
+def _serve(table: _RequestTable, weights, stop, agent_kwargs: dict, max_batch: int, max_wait: float, stats):
+    from .recurrent_actor_critic import ActorCritic
+
+    agent = ActorCritic(**agent_kwargs)
+    version = -1
+    try:
+        while not stop.is_set():
+            table.heartbeat.value = time.monotonic()
+            try:
+                batch = [table.requests.get(timeout=POLL_INTERVAL)]
+            except queue.Empty:
+                continue
+            deadline = time.monotonic() + max_wait
+            while len(batch) < max_batch:
+                try:
+                    batch.append(table.requests.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+
+            if weights.version.value != version:
+                version = weights.load(agent)
+
+            idx = torch.tensor(batch)
+            hidden = agent.reset_state(table.hidden[idx], table.reset[idx])
+            _, actions, log_p, values, hidden = agent.step(table.observations[idx], hidden)
+            table.hidden[idx] = hidden
+            table.actions[idx] = actions
+            table.logp[idx] = log_p
+            table.values[idx] = values
+            table.version[idx] = version
+            with stats.get_lock():
+                stats[0] += 1
+                stats[1] += len(batch)
+            for i in batch:
+                table.answered[i].release()
+    finally:
+        table.heartbeat.value = 0.0
+
+
+class InferenceServer:
+    """
+    Serves `num_clients` workers from one process, weights being the SharedWeights the learner publishes to
+    and agent_kwargs the ActorCritic arguments. client(i) is the handle to pass to worker i.
+    """
+
+    def __init__(self, agent_kwargs: dict, weights, num_clients: int, hidden_shape: tuple, ctx,
+                 max_batch: int = None, max_wait: float = 0.002):
+        self.table = _RequestTable(num_clients, agent_kwargs["state_dim"], hidden_shape, ctx)
+        self.stop = ctx.Event()
+        # forwards, requests answered
+        self.stats = ctx.Array("l", 2)
+        self.process = ctx.Process(target=_serve, args=(self.table, weights, self.stop, agent_kwargs,
+                                                        max_batch or num_clients, max_wait, self.stats),
+                                   daemon=True)
+        self.process.start()
+
+    def client(self, index: int) -> InferenceClient:
+        return InferenceClient(self.table, index)
+
+    def metrics(self) -> dict:
+        forwards, requests = self.stats[:]
+        return {"inference/forwards": float(forwards), "inference/batch_size": requests / max(forwards, 1)}
+
+    def close(self) -> None:
+        self.stop.set()
+        self.process.join()
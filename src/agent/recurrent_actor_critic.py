@@ -5,6 +5,8 @@ import torch
 from torch import nn
 from torch.distributions import Categorical
 
+from .factored_action_head import FactoredActionHead
+
 
 class LambdaModule(nn.Module):
     def __init__(self):
@@ -21,17 +23,28 @@ def create_lstm(state_dim, hidden_size, recurrent_layers):
 
 class Actor(pl.LightningModule):
 
-    def __init__(self, shared, latent_space, action_dim):
+    def __init__(self, shared, latent_space, action_dim, action_factors=None):
         super(Actor, self).__init__()
         self.shared = shared
         self.action_dim = action_dim
 
-        self.actor_net = nn.Sequential(
-            self.shared,
-            LambdaModule(),
-            nn.Linear(latent_space, latent_space),
-            nn.Linear(latent_space, action_dim)
-        )
+        if action_factors is None:
+            # flat head, one logit per action
+            self.actor_net = nn.Sequential(
+                self.shared,
+                LambdaModule(),
+                nn.Linear(latent_space, latent_space),
+                nn.Linear(latent_space, action_dim)
+            )
+            self.factored_head = None
+        else:
+            # command first, then the address bit by bit, see factored_action_head.py
+            self.actor_net = nn.Sequential(
+                self.shared,
+                LambdaModule(),
+                nn.Linear(latent_space, latent_space)
+            )
+            self.factored_head = FactoredActionHead(latent_space, action_factors)
 
         # self.action_dim = action_dim
         # self.continuous_action_space = continuous_action_space
@@ -43,11 +56,17 @@ class Actor(pl.LightningModule):
     def forward(self, state, **kwargs):
         logits = self.actor_net(state).squeeze().squeeze()
 
-        pi = Categorical(logits=logits)
+        pi = self.distribution(logits)
         actions = pi.sample()
 
         return pi, actions
 
+    def distribution(self, out: torch.Tensor):
+        # out: output of actor_net, logits for the flat head, features for the factored one
+        if self.factored_head is None:
+            return Categorical(logits=out)
+        return self.factored_head(out)
+
     @staticmethod
     def get_log_prob(pi: Categorical, actions: torch.Tensor):
         return pi.log_prob(actions)
@@ -92,14 +111,14 @@ class Critic(nn.Module):
 
 class ActorCritic(pl.LightningModule):
 
-    def __init__(self, state_dim, action_dim, hidden_size, recurrent_layers, actor_lr, critic_lr):
+    def __init__(self, state_dim, action_dim, hidden_size, recurrent_layers, actor_lr, critic_lr, action_factors=None):
         super().__init__()
         self.actor_lr = actor_lr
         self.critic_lr = critic_lr
 
         self.shared = create_lstm(state_dim, hidden_size, recurrent_layers)
 
-        self.actor = Actor(self.shared, hidden_size, action_dim)
+        self.actor = Actor(self.shared, hidden_size, action_dim, action_factors=action_factors)
 
         self.critic = nn.Sequential(
             self.shared,
@@ -118,3 +137,61 @@ class ActorCritic(pl.LightningModule):
     def get_log_prob(self, pi, actions: torch.Tensor) -> torch.Tensor:
         logp = self.actor.get_log_prob(pi, actions)
         return logp
+
+    # Incremental inference. __call__ runs the shared LSTM over a whole [steps, state_dim] observation to pick
+    # the action of a single step, so an episode costs O(T^2). step() instead consumes one observation and
+    # carries the LSTM's (h, c) to the next step, which is O(T) per episode. The carried state is packed as a
+    # [2, layers, hidden] tensor (h, c) so it can be stored with the rollout and stacked by the DataLoader.
+
+    def initial_state(self, batch_size: int = None) -> torch.Tensor:
+        """
+        packed zero (h, c) at the start of an episode, [2, layers, hidden] or [batch_size, 2, layers, hidden]
+        """
+        shape = (2, self.shared.num_layers, self.shared.hidden_size)
+        return torch.zeros(shape if batch_size is None else (batch_size,) + shape, device=self.device)
+
+    def reset_state(self, hidden: torch.Tensor, dones: torch.Tensor) -> torch.Tensor:
+        """
+        zeroes the carried state of the batch entries whose episode ended
+        """
+        return hidden * (~dones.to(torch.bool)).to(hidden.dtype).view(-1, 1, 1, 1)
+
+    @staticmethod
+    def _unpack(hidden: torch.Tensor) -> tuple:
+        # [2, layers, hidden] -> (h, c) as nn.LSTM takes them, [batch, 2, layers, hidden] -> [layers, batch, hidden]
+        if hidden.dim() == 3:
+            return hidden[0], hidden[1]
+        return hidden[:, 0].transpose(0, 1).contiguous(), hidden[:, 1].transpose(0, 1).contiguous()
+
+    @staticmethod
+    def _pack(h: torch.Tensor, c: torch.Tensor) -> torch.Tensor:
+        if h.dim() == 2:
+            return torch.stack((h, c))
+        return torch.stack((h.transpose(0, 1), c.transpose(0, 1)), dim=1)
+
+    def _heads(self, features: torch.Tensor) -> tuple:
+        # the layers of actor_net and critic behind the shared LSTM
+        return self.actor.actor_net[2:](features), self.critic[2:](features)
+
+    @torch.no_grad()
+    def step(self, observation: torch.Tensor, hidden: torch.Tensor) -> tuple:
+        """
+        consumes one observation [state_dim] (or [batch, state_dim] with a batched hidden) and the state carried
+        from the previous step. Returns pi, action, log_p, value and the state to carry to the next step
+        """
+        out, (h, c) = self.shared(observation.to(torch.float32).unsqueeze(0), self._unpack(hidden))
+        logits, value = self._heads(out[0])
+        pi = self.actor.distribution(logits)
+        actions = pi.sample()
+        return pi, actions, pi.log_prob(actions), value.squeeze(-1), self._pack(h, c)
+
+    def evaluate(self, states: torch.Tensor, hidden: torch.Tensor = None) -> tuple:
+        """
+        pi and values [batch, steps, 1] of the observations step() consumed during whole episodes, states being
+        [batch, steps, state_dim] and hidden [batch, 2, layers, hidden] the state carried into their first step
+        """
+        if hidden is None:
+            hidden = self.initial_state(states.shape[0])
+        out, _ = self.shared(states.to(torch.float32).transpose(0, 1), self._unpack(hidden))
+        logits, value = self._heads(out.transpose(0, 1))
+        return self.actor.distribution(logits), value
@@ -1,6 +1,5 @@
 import logging
 from collections.abc import Callable
-from dataclasses import dataclass
 
 import torch
 from torch.utils.data import IterableDataset
@@ -20,67 +19,98 @@ class Batch(IterableDataset):
         return iterator
 
 
-@dataclass(frozen=False)
-class Episode:
-    rewards: list
-    values: list
-    states: list
-    actions: list
-
-    def __init__(self):
-        self.rewards = []
-        self.values = []
-        self.states = []
-        self.actions = []
-
-    def update(self, reward, value, state, action):
-        self.rewards.append(reward)
-        self.values.append(value)
-        self.states.append(state)
-        self.actions.append(action)
-
-    def reset(self):
-        # might want to do an optimized copy if it isn't slower
-        self.rewards = []
-        self.values = []
-        self.states = []
-        self.actions = []
-
-
-@dataclass(frozen=False)
-class MiniBatch:
-    states: list
-    next_states: list
-    actions: list
-    advs: list
-    qvals: list
-    logp: list
-
-    def __init__(self):
-        self.states = []
-        self.next_states = []
-        self.actions = []
-        self.adv = []
-        self.qvals = []
-        self.logp = []
-
-    def update_experience(self, state: torch.Tensor, next_state: torch.Tensor, action: float, logp: float):
-        self.states.append(state)
-        self.next_states.append(next_state)
-        self.actions.append(action)
-        self.logp.append(logp)
-
-    def update_reward(self, adv: list, qval: list, ):
-        self.adv.append(adv)
-        self.qvals.append(qval)
-
-    def data(self):
-        return self.states, self.next_states, self.actions, self.adv, self.qvals, self.logp
-
-    def reset(self):
-        self.states = []
-        self.next_states = []
-        self.actions = []
-        self.adv = []
-        self.qvals = []
-        self.logp = []
+class RolloutStorage:
+    """
+    Fixed-capacity rollout of `num_envs` episodes of up to `steps` steps, allocated once as contiguous
+    [num_envs, steps, ...] tensors. Steps are written in place to the row of the episode being collected,
+    nothing is appended or stacked. Minibatches in row order are views of the filled rows and only valid until
+    the rows are written again, shuffled ones are gathered copies that outlive reset().
+
+        storage.insert(step, obs, next_obs, action, logp, value, reward, done)
+        storage.end_episode(length)
+        storage.returns[:n], storage.advantages[:n] = ...
+        for minibatch in storage.minibatches(batch_size): ...
+        storage.reset()
+    """
+
+    def __init__(self, num_envs: int, steps: int, obs_shape: tuple, hidden_shape: tuple):
+        shape = (num_envs, steps)
+        self.obs = torch.zeros(shape + tuple(obs_shape))
+        self.next_obs = torch.zeros(shape + tuple(obs_shape))
+        self.actions = torch.zeros(shape, dtype=torch.long)
+        self.logp = torch.zeros(shape)
+        self.values = torch.zeros(shape)
+        self.rewards = torch.zeros(shape)
+        self.dones = torch.zeros(shape, dtype=torch.bool)
+        self.advantages = torch.zeros(shape)
+        self.returns = torch.zeros(shape)
+        # the recurrent state the policy carried into the first step of the row
+        self.hidden = torch.zeros((num_envs,) + tuple(hidden_shape))
+        self.lengths = torch.zeros(num_envs, dtype=torch.long)
+        # rows the actor is trained on, all of them unless a filter deselects some
+        self.selected = torch.ones(num_envs, dtype=torch.bool)
+
+        self.num_envs = num_envs
+        # rows holding a finished episode, the next one is written to row `size`
+        self.size = 0
+
+    def full(self) -> bool:
+        return self.size == self.num_envs
+
+    def insert(self, step: int, obs: torch.Tensor, next_obs: torch.Tensor, action, logp, value, reward: float,
+               done: bool, hidden: torch.Tensor = None) -> None:
+        row = self.size
+        self.obs[row, step] = obs
+        self.next_obs[row, step] = next_obs
+        self.actions[row, step] = int(action)
+        self.logp[row, step] = float(logp)
+        self.values[row, step] = float(value)
+        self.rewards[row, step] = float(reward)
+        self.dones[row, step] = bool(done)
+        if hidden is not None:
+            self.hidden[row] = hidden
+
+    def insert_episode(self, obs: torch.Tensor, next_obs: torch.Tensor, actions: torch.Tensor, logp: torch.Tensor,
+                       rewards: torch.Tensor, dones: torch.Tensor, hidden: torch.Tensor) -> int:
+        """
+        writes a whole collected episode to the next row, see end_episode
+        """
+        row, n = self.size, len(actions)
+        self.obs[row, :n] = obs
+        self.next_obs[row, :n] = next_obs
+        self.actions[row, :n] = actions
+        self.logp[row, :n] = logp
+        self.rewards[row, :n] = rewards
+        self.dones[row, :n] = dones
+        self.hidden[row] = hidden
+        return self.end_episode(n)
+
+    def end_episode(self, length: int) -> int:
+        """
+        closes the row of the episode written so far after `length` steps, returns its index. The steps past
+        the end of a shorter episode are zeroed and done, so they neither carry stale steps nor bootstrap
+        """
+        row = self.size
+        if length < self.obs.shape[1]:
+            for tensor in (self.obs, self.next_obs, self.actions, self.logp, self.values, self.rewards):
+                tensor[row, length:] = 0
+            self.dones[row, length - 1:] = True
+        self.lengths[row] = length
+        self.size += 1
+        return row
+
+    def minibatches(self, batch_size: int, shuffle: bool = False):
+        """
+        (obs, next_obs, actions, logp, advantages, returns, hidden, selected) of the filled rows, batch_size
+        rows at a time. Views in row order, gathered rows when shuffled
+        """
+        order = torch.randperm(self.size) if shuffle else None
+        for start in range(0, self.size, batch_size):
+            rows = slice(start, min(start + batch_size, self.size)) if order is None else \
+                order[start:start + batch_size]
+            yield (self.obs[rows], self.next_obs[rows], self.actions[rows], self.logp[rows],
+                   self.advantages[rows], self.returns[rows], self.hidden[rows], self.selected[rows])
+
+    def reset(self) -> None:
+        self.size = 0
+        self.selected[:] = True
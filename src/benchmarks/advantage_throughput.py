@@ -0,0 +1,87 @@
+"""
+Throughput of discounted returns and GAE over a rollout batch.
+
+Compares agent/advantage.py against the per-episode Python loops RiskAwarePPO used before, on the same
+[num_envs, T] rewards, values and dones, and checks that both agree. Run from src/:
+
+    python -m benchmarks.advantage_throughput --num-envs 64 --steps 24
+    python -m benchmarks.advantage_throughput --num-envs 8 --steps 256 --done-prob 0.01
+"""
+import time
+from argparse import ArgumentParser
+
+import torch
+
+from agent.advantage import returns_and_advantages
+
+
+def legacy_discount_rewards(rewards: list, discount: float) -> list:
+    # the loops of proximal_policy_optimization before agent/advantage.py, one call per episode
+    cumul_reward = []
+    sum_r = 0.0
+    for r in reversed(rewards):
+        sum_r = (sum_r * discount) + r
+        cumul_reward.append(sum_r)
+    return list(reversed(cumul_reward))
+
+
+def legacy_calc_advantage(rewards: list, values: list, last_value: float, gamma: float, lam: float) -> list:
+    rews = rewards + [last_value]
+    vals = values + [last_value]
+    delta = [rews[i] + gamma * vals[i + 1] - vals[i] for i in range(len(rews) - 1)]
+    return legacy_discount_rewards(delta, gamma * lam)
+
+
+def run_legacy(rewards, values, dones, last_value, gamma: float, lam: float) -> tuple:
+    returns, advantages = [], []
+    for env in range(rewards.shape[0]):
+        r, v, d = rewards[env].tolist(), values[env].tolist(), dones[env].tolist()
+        env_returns, env_advantages, start = [], [], 0
+        for t in range(len(r)):
+            if d[t] or t == len(r) - 1:
+                # finished episodes bootstrap from 0, the trailing unfinished one from last_value
+                bootstrap = 0.0 if d[t] else float(last_value[env])
+                episode = r[start:t + 1]
+                env_returns += legacy_discount_rewards(episode + [bootstrap], gamma)[:-1]
+                env_advantages += legacy_calc_advantage(episode, v[start:t + 1], bootstrap, gamma, lam)
+                start = t + 1
+        returns.append(env_returns)
+        advantages.append(env_advantages)
+    return torch.tensor(returns), torch.tensor(advantages)
+
+
+def run_batched(rewards, values, dones, last_value, gamma: float, lam: float) -> tuple:
+    return returns_and_advantages(rewards, values, dones, last_value, gamma, lam)
+
+
+def measure(fn, args: tuple, repeat: int) -> tuple:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return out, best
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--num-envs", type=int, default=64)
+    parser.add_argument("--steps", type=int, default=24)
+    parser.add_argument("--done-prob", type=float, default=0.05)
+    parser.add_argument("--gamma", type=float, default=0.99)
+    parser.add_argument("--lam", type=float, default=0.95)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    shape = (args.num_envs, args.steps)
+    batch = (torch.randn(shape), torch.randn(shape), torch.rand(shape) < args.done_prob, torch.randn(args.num_envs),
+             args.gamma, args.lam)
+
+    print(f"{args.num_envs} envs x {args.steps} steps, done probability {args.done_prob}")
+    (ref_returns, ref_adv), legacy_s = measure(run_legacy, batch, args.repeat)
+    (returns, adv), batched_s = measure(run_batched, batch, args.repeat)
+    for name, seconds in (("legacy", legacy_s), ("batched", batched_s)):
+        print(f"{name:>8}: {seconds * 1e3:8.3f} ms ({args.num_envs * args.steps / seconds / 1e6:.2f} M steps/s)")
+    print(f" speedup: {legacy_s / batched_s:.1f}x, max |diff| returns "
+          f"{(returns - ref_returns).abs().max():.2e}, advantages {(adv - ref_adv).abs().max():.2e}")
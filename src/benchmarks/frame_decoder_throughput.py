@@ -0,0 +1,98 @@
+"""
+Throughput of the POISON wire format decoders on large multi-event responses.
+
+Compares FrameDecoder against the previous reslicing parser of CannoliStreamingClient.parse, feeding both
+the same stream in BUFFER_SIZE chunks like try_read does. Run from src/:
+
+    python -m benchmarks.frame_decoder_throughput --events 20000 --chunk 1024
+"""
+import json
+import struct
+import time
+from argparse import ArgumentParser
+
+from libs.frame_decoder import FrameDecoder, POISON, POISON_BYTES, SCHEMAS
+
+
+def make_stream(n_events: int, corrupt_every: int = 0) -> bytes:
+    stream = bytearray()
+    for i in range(n_events):
+        event = {"req_crc": 1946603233 + i, "valid_key": None, "crc_magic1": 177334383,
+                 "crc_magic2": 2114797893, "return": i % 3, "command": i % 4,
+                 "heap": {"bounds": {"start": 0x5e46f18, "end": 0x5e46f18 + i}, "entropy": 0.5}}
+        data = json.dumps(event, indent=1).encode()
+        if corrupt_every and i % corrupt_every == 0:
+            stream += b"\xde\xad\xbe\xef"
+        stream += POISON_BYTES + struct.pack("<I", len(data)) + data
+    return bytes(stream)
+
+
+def legacy_parse(recv_buf: bytes, payloads: list) -> bytes:
+    # the parser CannoliStreamingClient used before FrameDecoder, reslicing the buffer per field
+    while True:
+        if len(recv_buf) < 4:
+            return recv_buf
+        poison = int.from_bytes(recv_buf[:4], "little")
+        if POISON != poison:
+            idx = recv_buf.find(POISON_BYTES, 1)
+            if idx < 0:
+                return b''
+            recv_buf = recv_buf[idx:]
+            continue
+        if len(recv_buf) < 4 + len(SCHEMAS) * 4:
+            return recv_buf
+        lengths = [int.from_bytes(recv_buf[4 + 4 * i:8 + 4 * i], "little") for i in range(len(SCHEMAS))]
+        if len(recv_buf) < 4 + 4 * len(SCHEMAS) + sum(lengths):
+            return recv_buf
+        recv_buf = recv_buf[4:]
+        for i in range(len(SCHEMAS)):
+            recv_buf = recv_buf[4:]
+        for length in lengths:
+            payloads.append(recv_buf[:length])
+            recv_buf = recv_buf[length:]
+
+
+def run_legacy(stream: bytes, chunk: int, drain_every: int) -> int:
+    # try_read only parsed once the socket went quiet, model that by parsing every drain_every chunks
+    recv_buf, payloads = b'', []
+    for n, i in enumerate(range(0, len(stream), chunk)):
+        recv_buf += stream[i:i + chunk]
+        if n % drain_every == 0:
+            recv_buf = legacy_parse(recv_buf, payloads)
+    legacy_parse(recv_buf, payloads)
+    return len(payloads)
+
+
+def run_decoder(stream: bytes, chunk: int, drain_every: int) -> int:
+    decoder, payloads = FrameDecoder(), []
+    for n, i in enumerate(range(0, len(stream), chunk)):
+        decoder.feed(stream[i:i + chunk])
+        if n % drain_every == 0:
+            payloads.extend(decoder.frames())
+    payloads.extend(decoder.frames())
+    return len(payloads)
+
+
+def measure(fn, stream: bytes, chunk: int, drain_every: int, repeat: int) -> tuple:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        n = fn(stream, chunk, drain_every)
+        best = min(best, time.perf_counter() - start)
+    return n, len(stream) / best / 1e6
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--chunk", type=int, default=1024)
+    parser.add_argument("--drain-every", type=int, default=64)
+    parser.add_argument("--corrupt-every", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    stream = make_stream(args.events, args.corrupt_every)
+    print(f"{args.events} events, {len(stream) / 1e6:.1f} MB, {args.chunk} byte reads")
+    for name, fn in (("legacy", run_legacy), ("frame_decoder", run_decoder)):
+        n, mbps = measure(fn, stream, args.chunk, args.drain_every, args.repeat)
+        print(f"{name:>14}: {mbps:8.1f} MB/s ({n} frames)")
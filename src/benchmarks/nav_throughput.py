@@ -0,0 +1,87 @@
+"""
+Load test of the NAV side of the rollout path against mock tracers (see libs/mock_tracer.py), no bench,
+GDB or QEMU needed. Run from src/:
+
+    python -m benchmarks.nav_throughput --episodes 200 --steps 24
+    python -m benchmarks.nav_throughput --num-envs 4 --fragment 64 --corrupt 0.01
+    python -m benchmarks.nav_throughput --open-loop
+"""
+import contextlib
+import io
+import os
+import random
+import tempfile
+import time
+from argparse import ArgumentParser
+
+import torch
+
+from libs.cannoli_env import CannoliEnv
+from libs.mock_tracer import MockBench
+from libs.vector_env import VectorCannoliEnv
+
+ALLOC_POOL_START = 0x5e46f18 + 0x6abac90 - 0x5e46f18
+
+
+def demoone_actions(n: int = 256) -> list:
+    locs = range(ALLOC_POOL_START, ALLOC_POOL_START + 4 * n, 4)
+    return [(0, l) for l in locs] + [(1, None)] + [(2, l) for l in locs] + [(3, l) for l in locs]
+
+
+def run_single(args, actions, db_path) -> int:
+    env = CannoliEnv("mock", args.steps, actions, args.episodes, 1, db_path=db_path, event_schema=args.event_schema,
+                     transactions=args.open_loop,
+                     bench=MockBench(latency=args.latency, fragment=args.fragment, corrupt=args.corrupt))
+    steps = 0
+    env.reset()
+    for _ in range(args.episodes):
+        episode = [random.choice(actions) for _ in range(args.steps)]
+        if args.open_loop:
+            steps += len(env.run_open_loop(episode))
+        else:
+            for action in episode:
+                env.step(action)
+                steps += 1
+        env.reset()
+    env.close()
+    return steps
+
+
+def run_vector(args, actions, db_dir) -> int:
+    env = VectorCannoliEnv("mock", args.steps, actions, args.episodes, 1, num_envs=args.num_envs, db_dir=db_dir,
+                           event_schema=args.event_schema,
+                           bench=MockBench(latency=args.latency, fragment=args.fragment, corrupt=args.corrupt))
+    steps = 0
+    env.reset()
+    for _ in range(args.episodes * args.steps // args.num_envs):
+        env.step([random.choice(actions) for _ in range(args.num_envs)])
+        steps += args.num_envs
+    env.close()
+    return steps
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--episodes", type=int, default=100)
+    parser.add_argument("--steps", type=int, default=24)
+    parser.add_argument("--num-envs", type=int, default=1)
+    parser.add_argument("--open-loop", action="store_true", help="one transaction per episode")
+    parser.add_argument("--event-schema", default="json")
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--fragment", type=int, default=0)
+    parser.add_argument("--corrupt", type=float, default=0.0)
+    parser.add_argument("--verbose", action="store_true", help="keep the per step prints of the client")
+    args = parser.parse_args()
+
+    torch.set_num_threads(1)
+    actions = demoone_actions()
+    with tempfile.TemporaryDirectory() as tmp:
+        quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+        start = time.perf_counter()
+        with quiet:
+            if args.num_envs > 1:
+                steps = run_vector(args, actions, tmp)
+            else:
+                steps = run_single(args, actions, os.path.join(tmp, "demo.db"))
+        elapsed = time.perf_counter() - start
+    print(f"{steps} steps in {elapsed:.2f}s: {steps / elapsed:.0f} steps/s")
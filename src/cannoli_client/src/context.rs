@@ -166,7 +166,64 @@ impl Serialize for PidContext {
     }
 }
 
+// Compact binary event schema, see src/libs/event_schema.py. NAV requests it by
+// starting the tracer with CANNOLI_EVENT_SCHEMA=binary, otherwise events are
+// sent as JSON.
+//
+//    4 bytes       u16        u16         u32
+// .-----------.---------.-------------.---------.-------------------------.
+// |  "CEV1"   | version | record size |  count  |     count * record      |
+// `-----------`---------`-------------`---------`-------------------------`
+//
+// record (little endian, 68 bytes):
+//   u64 req_crc, u64 valid_key, u64 crc_magic1, u64 crc_magic2, u64 return,
+//   u64 heap_start, u64 heap_end, f32 heap_entropy, i32 command,
+//   u16 present, u8 invariant, u8 padding
+const EVENT_MAGIC: &[u8; 4] = b"CEV1";
+const EVENT_VERSION: u16 = 1;
+const EVENT_RECORD_SIZE: u16 = 68;
+// presence bits of heap_start, heap_end and heap_entropy
+const PRESENT_HEAP: u16 = (1 << 5) | (1 << 6) | (1 << 7);
+
+fn binary_events_requested() -> bool {
+    match std::env::var("CANNOLI_EVENT_SCHEMA") {
+        Ok(schema) => schema == "binary",
+        Err(_) => false,
+    }
+}
+
 impl PidContext {
+    fn encode_binary_event(&self) -> Vec<u8> {
+        let mut present: u16 = 0;
+        let (start, end, entropy) = match &self.0.0.lock().unwrap().heap {
+            Some(heap) => {
+                present |= PRESENT_HEAP;
+                (heap.mem_region.start, heap.mem_region.end, heap.entropy)
+            },
+            None => (0u64, 0u64, 0f32),
+        };
+
+        let mut data: Vec<u8> = Vec::with_capacity(12 + EVENT_RECORD_SIZE as usize);
+        data.extend_from_slice(EVENT_MAGIC);
+        data.extend_from_slice(&EVENT_VERSION.to_le_bytes());
+        data.extend_from_slice(&EVENT_RECORD_SIZE.to_le_bytes());
+        data.extend_from_slice(&1u32.to_le_bytes());
+
+        // req_crc, valid_key, crc_magic1, crc_magic2 and return are only
+        // reported by the edk2 tracer
+        for _ in 0..5 {
+            data.extend_from_slice(&0u64.to_le_bytes());
+        }
+        data.extend_from_slice(&start.to_le_bytes());
+        data.extend_from_slice(&end.to_le_bytes());
+        data.extend_from_slice(&entropy.to_le_bytes());
+        // command and invariant are filled in by NAV
+        data.extend_from_slice(&0i32.to_le_bytes());
+        data.extend_from_slice(&present.to_le_bytes());
+        data.extend_from_slice(&[0u8, 0u8]);
+        data
+    }
+
     pub fn log_event(&self) {
         const POISON: u32 = 0x36afb081;
         println!("sending");
@@ -183,11 +240,15 @@ impl PidContext {
             }
         }
         // let backtrace_state = &mut self.1.lock().unwrap();
-        let data = serde_json::to_string_pretty(
+        let data: Vec<u8> = if binary_events_requested() {
+            self.encode_binary_event()
+        } else {
+            (serde_json::to_string_pretty(
                     &self)
                     // &backtrace_state
                     // .backtrace)
-                    .unwrap() + "\n";
+                    .unwrap() + "\n").into_bytes()
+        };
         // packet format
         // POISON value as a u32 integer (4 bytes) followed by the schema length
         // for every possible schema (this must be synchronized b/w cannoli and
@@ -214,7 +275,7 @@ impl PidContext {
         header.extend_from_slice(&(data.len() as u32).to_le_bytes());
         let stream = &mut self.2.lock().unwrap();
         let _ = stream.write(&header);
-        let _ = stream.write(&data.as_bytes());
-        println!("sent {}", data);
+        let _ = stream.write(&data);
+        println!("sent {} bytes", data.len());
     }
 }
@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+# Declarative action spaces. Instead of enumerating every (command, param) pair in a YAML list, a spec lists
+# the parameters of every command as an integer range or an explicit set:
+#
+#   action_space:
+#     - {command: 0, start: 0x6abac90, stop: 0x6acac90, step: 4}   # GetCrc (void* loc)
+#     - {command: 1, values: [0]}                                    # AllocatePool (), sent as 1,0
+#     - {command: 2, values: [0x6abf0c8, 0x6abf0cc]}                 # GetAccessVariable (void* loc)
+#
+# A command listed without values or a range, {command: 1}, is sent without a parameter.
+#
+# Actions are indexed in spec order, command by command. ActionSpace is a read-only sequence of the
+# (command, param) tuples CannoliEnv takes, an index is resolved arithmetically from the groups so nothing is
+# enumerated up front. Only bulk access (columns()) materializes the [n, 2] int64 table of all actions, which
+# is written once to <cache_dir>/action_space_<spec hash>.npy and memory-mapped from then on.
+
+NO_PARAM = -1
+
+
+def _normalize(spec: list) -> list:
+    groups = []
+    for entry in spec:
+        command = int(entry["command"])
+        if "values" in entry:
+            groups.append({"command": command, "values": [int(v) for v in entry["values"]]})
+        elif "start" in entry:
+            step = int(entry.get("step", 1))
+            if step <= 0:
+                raise ValueError(f"action space range of command {command} needs a positive step, got {step}")
+            groups.append({"command": command, "start": int(entry["start"]), "stop": int(entry["stop"]),
+                           "step": step})
+        else:
+            groups.append({"command": command})
+    return groups
+
+
+def spec_hash(spec: list) -> str:
+    return hashlib.sha256(json.dumps(_normalize(spec), sort_keys=True).encode()).hexdigest()[:16]
+
+
+class ActionSpace:
+
+    def __init__(self, spec: list, cache_dir: str = None):
+        self.groups = _normalize(spec)
+        self.hash = spec_hash(spec)
+        self.cache_dir = cache_dir
+
+        counts = []
+        for group in self.groups:
+            if "values" in group:
+                group["array"] = np.asarray(group["values"], dtype=np.int64)
+                counts.append(len(group["values"]))
+            elif "start" in group:
+                counts.append(len(range(group["start"], group["stop"], group["step"])))
+            else:
+                counts.append(1)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+        # reverse lookup, groups per command and the positions of the explicit values
+        self.command_groups = {}
+        for g, group in enumerate(self.groups):
+            self.command_groups.setdefault(group["command"], []).append(g)
+            if "values" in group:
+                group["positions"] = {v: i for i, v in enumerate(group["values"])}
+        self._table = None
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1])
+
+    def __getitem__(self, idx) -> tuple:
+        idx = int(idx)
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f"action {idx} out of range for {len(self)} actions")
+        g = int(np.searchsorted(self.offsets, idx, side="right")) - 1
+        group, j = self.groups[g], idx - int(self.offsets[g])
+        if "values" in group:
+            return group["command"], group["values"][j]
+        if "start" in group:
+            return group["command"], group["start"] + j * group["step"]
+        return group["command"], None
+
+    def __iter__(self):
+        for g, group in enumerate(self.groups):
+            if "values" in group:
+                yield from ((group["command"], v) for v in group["values"])
+            elif "start" in group:
+                yield from ((group["command"], p) for p in range(group["start"], group["stop"], group["step"]))
+            else:
+                yield group["command"], None
+
+    def get(self, action, default: int = -1) -> int:
+        """
+        index of action, default if it is not part of the space
+        """
+        command = action[0]
+        param = action[1] if len(action) > 1 else None
+        for g in self.command_groups.get(command, ()):
+            group = self.groups[g]
+            if "values" in group:
+                j = group["positions"].get(param)
+            elif "start" in group:
+                inside = param is not None and group["start"] <= param < group["stop"]
+                j = (param - group["start"]) // group["step"] if inside and \
+                    (param - group["start"]) % group["step"] == 0 else None
+            else:
+                j = 0 if param is None else None
+            if j is not None:
+                return int(self.offsets[g]) + j
+        return default
+
+    def __contains__(self, action) -> bool:
+        return self.get(action) >= 0
+
+    def columns(self) -> tuple:
+        """
+        (commands, params) int64 arrays of every action, NO_PARAM for actions without a parameter
+        """
+        table = self._materialize()
+        return table[:, 0], table[:, 1]
+
+    def _materialize(self) -> np.ndarray:
+        if self._table is not None:
+            return self._table
+        path = os.path.join(self.cache_dir, f"action_space_{self.hash}.npy") if self.cache_dir else None
+        if path is not None and os.path.exists(path):
+            self._table = np.load(path, mmap_mode="r")
+            return self._table
+
+        table = np.empty((len(self), 2), dtype=np.int64)
+        for g, group in enumerate(self.groups):
+            rows = table[self.offsets[g]:self.offsets[g + 1]]
+            rows[:, 0] = group["command"]
+            if "values" in group:
+                rows[:, 1] = group["array"]
+            elif "start" in group:
+                rows[:, 1] = np.arange(group["start"], group["stop"], group["step"], dtype=np.int64)
+            else:
+                rows[:, 1] = NO_PARAM
+        if path is None:
+            self._table = table
+            return table
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as file:
+            np.save(file, table)
+        os.replace(tmp, path)
+        self._table = np.load(path, mmap_mode="r")
+        return self._table
+
+    def __getstate__(self) -> dict:
+        # the table is memory-mapped again (or rebuilt) on the other side instead of being pickled
+        state = dict(self.__dict__)
+        state["_table"] = None
+        return state
+
+    def __repr__(self) -> str:
+        return f"ActionSpace({len(self)} actions, {len(self.groups)} groups, hash {self.hash})"
+
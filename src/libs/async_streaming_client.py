@@ -0,0 +1,184 @@
+import asyncio
+import json
+import os
+import pickle
+
+from .bench import Bench
+from .frame_decoder import FrameDecoder, is_end_of_batch
+from .invariants import RuleEngine
+
+# buffer limit of the stream reader, and the most read from it at once
+STREAM_LIMIT = 2 ** 24
+READ_SIZE = 2 ** 16
+
+
+class AsyncCannoliStreamingClient:
+    """
+    asyncio counterpart of CannoliStreamingClient. The tracer socket is served by a non-blocking unix
+    stream server and messages are framed by the POISON/length header (see CannoliStreamingClient.try_read)
+    instead of guessing the end of a message from the size of a recv. One event loop can therefore drive
+    dozens of tracers without a thread per env. Frames are decoded by the same FrameDecoder as the
+    synchronous client, which resyncs on corrupted headers and implausible lengths.
+
+    A batch of events (the response to one action) ends either
+    1. on an empty frame, a POISON header whose schema lengths are all 0, sent by the tracer once it has
+       finished handling a command, in which case step() resolves as soon as that frame is parsed, or
+    2. for tracers that do not send the marker, when no new frame starts within batch_gap seconds of the
+       last complete one.
+    """
+
+    def __init__(self, exec_name, nav_id=None, bench_dir=None, batch_gap: float = 0.005, timeout: float = None,
+                 invariants: list = None):
+        """
+        batch_gap: idle time after a complete frame after which a batch is considered complete
+        timeout: maximum time to wait for the first frame of a response, None waits forever
+        invariants: rules of the target YAML, see invariants.py
+        """
+        self.exec_name = exec_name
+        self.pid = os.getpid() if nav_id is None else nav_id
+        self.recv_path_cannoli = "/tmp/nav_" + str(self.pid)
+        self.bench = Bench(bench_dir=bench_dir)
+        self.batch_gap = batch_gap
+        self.timeout = timeout
+
+        self.events = list()
+        self.decoder = FrameDecoder()
+        self.rules = RuleEngine(invariants)
+        self.command = None
+
+        self.server = None
+        self.reader: asyncio.StreamReader = None
+        self.writer: asyncio.StreamWriter = None
+        self._connected: asyncio.Future = None
+
+    def spawn_tracer(self):
+        self.bench.run(self.pid)
+
+    async def listen(self) -> None:
+        # must listen before the tracer is spawned so that it can connect on start up
+        try:
+            os.unlink(self.recv_path_cannoli)
+        except OSError:
+            if os.path.exists(self.recv_path_cannoli):
+                raise
+        self._connected = asyncio.get_running_loop().create_future()
+        self.server = await asyncio.start_unix_server(self._on_connect, path=self.recv_path_cannoli,
+                                                      limit=STREAM_LIMIT)
+        print("[*] NAV: listening on " + self.recv_path_cannoli)
+
+    async def _on_connect(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        if self._connected.done():
+            # only one tracer per client
+            writer.close()
+            return
+        self.reader, self.writer = reader, writer
+        print("[*] NAV: received connection on " + self.recv_path_cannoli)
+        self._connected.set_result(True)
+
+    async def connect_to_tracer(self) -> None:
+        if self.server is None:
+            await self.listen()
+        await self._connected
+
+    async def try_write(self, choice: tuple) -> None:
+        self.command = choice[0]
+        print("NAV->Tracer: ", choice)
+        self.writer.write(pickle.dumps(choice) + b'\n')
+        await self.writer.drain()
+
+    async def _read_frame(self, timeout: float = None):
+        """
+        reads one POISON framed message. Returns the decoded event, an empty list for an end of batch
+        frame, None for a frame that could not be decoded or raises asyncio.TimeoutError if no frame
+        started within timeout
+        """
+        while True:
+            dropped = self.decoder.dropped
+            frame = self.decoder.next_frame()
+            if self.decoder.dropped != dropped:
+                print(f"[*] NAV: dropped {self.decoder.dropped - dropped} corrupted bytes")
+            if frame is not None:
+                break
+            # bytes already buffered belong to a frame that started, the rest of it is waited for. A
+            # cancelled read consumes nothing, so a timeout never loses received bytes
+            data = await asyncio.wait_for(self.reader.read(READ_SIZE), None if len(self.decoder) else timeout)
+            if not data:
+                raise ConnectionResetError("tracer closed the connection")
+            self.decoder.feed(data)
+
+        if is_end_of_batch(frame):
+            return []
+
+        event = None
+        for data in frame:
+            if not data:
+                continue
+            try:
+                event = json.loads(data)
+            except ValueError:
+                print("[*] NAV: failed to deserialize event")
+        return event
+
+    async def try_read(self) -> list:
+        if self.reader is None:
+            return []
+
+        self.events = list()
+        timeout = self.timeout
+        while True:
+            try:
+                event = await self._read_frame(timeout)
+            except asyncio.TimeoutError:
+                break
+            except ConnectionError as e:
+                print("Exception receiving", e)
+                break
+            if event == []:
+                # explicit end of batch
+                break
+            if event is not None:
+                self.events.append(event)
+            timeout = self.batch_gap
+
+        for e in self.events:
+            e["command"] = self.command
+            e["invariants"] = any(self.rules.check(self.command, e))
+        return self.events
+
+    async def step(self, action: tuple) -> list:
+        """
+        sends an action and resolves with its batch of events
+        """
+        await self.try_write(action)
+        return await self.try_read()
+
+    async def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except ConnectionError:
+                pass
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        self.reader, self.writer, self.server = None, None, None
+        if os.path.exists(self.recv_path_cannoli):
+            os.unlink(self.recv_path_cannoli)
+
+    async def reset(self) -> None:
+        self.events = list()
+        self.decoder.clear()
+
+        await self.close()
+        self.bench.kill()
+        await self.listen()
+        self.spawn_tracer()
+        await self.connect_to_tracer()
+
+
+async def gather_steps(clients: list, actions: list) -> list:
+    """
+    steps every client with its action concurrently on the running loop
+    """
+    return await asyncio.gather(*[client.step(action) for client, action in zip(clients, actions)])
@@ -13,15 +13,82 @@ import subprocess
 import signal
 from pathlib import Path
 import shlex
+import socket
+import time
+
+
+class MonitorError(Exception):
+    pass
+
+
+class QemuMonitor:
+    """
+    Minimal client for the QEMU human monitor (HMP) on a unix socket, used to take and restore
+    snapshots of the guest. savevm/loadvm need the guest to have a writable qcow2 drive to store
+    the vm state in.
+    """
+    PROMPT = b"(qemu) "
+
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self.sock = None
+
+    def connect(self, retries=50, delay=0.1):
+        # QEMU creates the socket some time after bench starts, keep trying for a while
+        for _ in range(retries):
+            try:
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.settimeout(self.timeout)
+                self.sock.connect(str(self.path))
+                self._read_until_prompt()
+                return
+            except (FileNotFoundError, ConnectionRefusedError):
+                self.sock.close()
+                self.sock = None
+                time.sleep(delay)
+        raise MonitorError(f"could not connect to the QEMU monitor on {self.path}")
+
+    def _read_until_prompt(self) -> str:
+        out = b''
+        while not out.endswith(self.PROMPT):
+            b = self.sock.recv(4096)
+            if not b:
+                raise MonitorError("QEMU monitor closed the connection")
+            out += b
+        return out[:-len(self.PROMPT)].decode(errors="replace")
+
+    def command(self, cmd: str) -> str:
+        if self.sock is None:
+            self.connect()
+        self.sock.sendall(cmd.encode() + b"\n")
+        out = self._read_until_prompt()
+        if "Error" in out or "error" in out:
+            raise MonitorError(f"{cmd}: {out.strip()}")
+        return out
+
+    def savevm(self, tag: str) -> None:
+        self.command(f"savevm {tag}")
+
+    def loadvm(self, tag: str) -> None:
+        self.command(f"loadvm {tag}")
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
 
 
 class Bench:
-    def __init__(self, debug=True):
-        p = os.environ.get("UEFI_PATH")
+    def __init__(self, debug=True, bench_dir=None):
+        # an explicit bench_dir lets parallel environments each run out of
+        # their own copy of the edk2 tree instead of sharing UEFI_PATH
+        p = bench_dir or os.environ.get("UEFI_PATH")
         self.bench_dir = Path(p) if p else None
         self.gdb = None
         self.qemu = None
         self.debug = debug
+        self.monitor = None
 
     def run_bench_cmd(self, cmd, popen=False, **kwargs):
         fn = subprocess.Popen if popen else subprocess.run
@@ -33,7 +100,7 @@ class Bench:
     def build(self) -> int:
         self.run_bench_cmd("bench build")
 
-    def run(self, pid):
+    def run(self, pid, event_schema=None, monitor_path=None, transactions=False):
         environ = {
             "BENCH_OVERRIDE_EXEC": "yes",
             "BENCH_RUN_NAV_PID": str(pid),
@@ -45,6 +112,16 @@ class Bench:
             "BENCH_RUN_CREATE_QEMU_BASH_SCRIPT": "no",
             "BENCH_RUN_CREATE_GDB_BASH_SCRIPT": "no",
         }
+        if monitor_path:
+            # expose the QEMU monitor so that the guest can be snapshotted, see QemuMonitor
+            environ["BENCH_RUN_QEMU_MONITOR"] = f"unix:{monitor_path},server,nowait"
+            self.monitor = QemuMonitor(monitor_path)
+        if event_schema:
+            # negotiated with the tracer, see event_schema.py
+            environ["CANNOLI_EVENT_SCHEMA"] = event_schema
+        if transactions:
+            # acknowledged by the tracer, see transaction.py
+            environ["CANNOLI_TRANSACTIONS"] = "1"
         prof = os.environ.get("BENCH_PROFILE")
         if prof:
             environ["BENCH_PROFILE"] = prof
@@ -58,5 +135,8 @@ class Bench:
         pass
 
     def kill(self):
+        if self.monitor:
+            self.monitor.close()
+            self.monitor = None
         if self.gdb and self.gdb.poll() is None:
             self.gdb.kill()
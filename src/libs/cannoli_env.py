@@ -1,10 +1,17 @@
+import copy
+
 import gym
 
 import numpy as np
 import torch
-from .cannoli_streaming_client import CannoliStreamingClient
-import json
-import sqlite3, datetime
+from .action_space import ActionSpace
+from .cannoli_streaming_client import CannoliStreamingClient, RESPAWN_RESET
+from .event_schema import JSON_SCHEMA, featurize
+from .instrumentation import PROFILER
+from .trace_writer import TraceWriter
+from .trajectory_store import TrajectoryWriter
+from .prefix_cache import PrefixCache, ROOT
+from .prefix_scheduler import PrefixScheduler
 
 
 class CannoliEnv(gym.Env):
@@ -23,13 +30,21 @@ class CannoliEnv(gym.Env):
         pass
 
     def __init__(self, executable_identifier, max_steps_episode: int, action_space: np.array, episodes: int,
-                 epochs: int):
+                 epochs: int, nav_id=None, db_path: str = "demo.db", bench_dir=None, event_schema=JSON_SCHEMA,
+                 reset_mode=RESPAWN_RESET, tracer_pool: dict = None, bench=None, invariants: list = None,
+                 trace_writer: dict = None, trajectory_dir: str = None, prefix_cache: dict = None,
+                 scheduler: dict = None, transactions: bool = False):
         super(CannoliEnv, self).__init__()
         self.max_steps_episode = max_steps_episode
         self.steps_left = max_steps_episode
 
         self.executable_identifier = executable_identifier
-        self.client: CannoliStreamingClient = CannoliStreamingClient(executable_identifier)
+        self.client: CannoliStreamingClient = CannoliStreamingClient(executable_identifier, nav_id=nav_id,
+                                                                     bench_dir=bench_dir, event_schema=event_schema,
+                                                                     reset_mode=reset_mode,
+                                                                     tracer_pool=tracer_pool, bench=bench,
+                                                                     invariants=invariants,
+                                                                     transactions=transactions)
         self.last_state = None
 
         # TODO: once checking against a specification better to keep this as an AST
@@ -49,41 +64,36 @@ class CannoliEnv(gym.Env):
         self.epoch = 0
         self.episode = 0
 
-        self.time = round(datetime.datetime.now().timestamp())
-        self.test_name = f"test_{round(datetime.datetime.now().timestamp())}"
-
-        self.db_events = list()
-        self.con = sqlite3.connect(f"demo.db")
-        self.db = self.con.cursor()
-
-        self._create_table()
-
-        # self.db.execute(f"INSERT INTO tests VALUES(?, ?)", (self.time, self.test_name))
-        # self.db.execute(f"CREATE TABLE {self.test_name}(epoch, episode, test, data)")
-        # self.con.commit()
-
-    def _create_table(self):
-        # Create the 'tests' table. Should only need to be done once per db
-        # Future consideration: add distinguishing information to easily filter
-        # "meaningful" tests, e.g,. max reward achieved for all epochs & episodes
-        self.db.execute(
-            "CREATE TABLE IF NOT EXISTS tests (uuid, testname)"
-        )
-
-        # insert test metadata into `tests` table
-        self.db.execute(f"INSERT INTO tests VALUES(?, ?)", (self.time, self.test_name))
-
-        # Create the 'test_X' tables
-        # Future consideration: add a column for `action` and `params` to easily
-        # filter the table and replay interesting/failing tests
-        self.db.execute(f'''
-            CREATE TABLE IF NOT EXISTS {self.test_name} (
-                epoch INTEGER,
-                episode INTEGER,
-                test INTEGER,
-                data TEXT
-            )''')
-        self.con.commit()
+        # steps are written to the normalized trace database (see trace_writer.py) by a background thread,
+        # trace_writer holds its settings (queue_size, batch_size, flush_interval, block)
+        self.writer = TraceWriter(db_path, executable=executable_identifier, nav_id=self.client.pid,
+                                  **(trace_writer or {}))
+
+        # optional columnar copy of every step for offline analysis and training (see trajectory_store.py)
+        self.trajectories = TrajectoryWriter(trajectory_dir, self.client.pid) if trajectory_dir else None
+        # index of every action, an ActionSpace resolves them without enumerating the space
+        self.action_ids = action_space if isinstance(action_space, ActionSpace) else \
+            {tuple(action): i for i, action in enumerate(action_space)}
+
+        # optional response cache for deterministic targets (see prefix_cache.py), prefix_cache holds its
+        # settings (max_entries). Steps are answered from the cache while the episode stays on the cached tree,
+        # the tracer is only reset and brought up to date with the prefix once a step misses
+        self.cache = PrefixCache(**prefix_cache) if prefix_cache is not None else None
+        self.cache_node = ROOT
+        self.pending = []
+        self.tracer_steps = 0
+        self.tracer_stale = True
+
+        # optional tracers of the prefix-sharing scheduler used by run_scheduled, scheduler holds its
+        # settings (workers). Every tracer needs its own bench
+        self.scheduler = None
+        if scheduler is not None:
+            clients = [CannoliStreamingClient(executable_identifier, nav_id=f"{self.client.pid}_s{i}",
+                                              bench_dir=bench_dir, event_schema=event_schema, reset_mode=reset_mode,
+                                              bench=copy.copy(bench) if bench is not None else None,
+                                              invariants=invariants, transactions=transactions)
+                       for i in range(scheduler.get("workers", 2))]
+            self.scheduler = PrefixScheduler(clients)
 
     def _atomic_transaction(self, action):
         try:
@@ -94,27 +104,156 @@ class CannoliEnv(gym.Env):
             responses = []
         return responses
 
+    def _transaction(self, actions: list) -> list:
+        try:
+            return self.client.try_transaction(actions)
+        except BaseException as e:
+            print("An exception occurred in Cannoli Env:", e)
+            return [[] for _ in actions]
+
+    def _cached_transaction(self, actions: list) -> list:
+        batches = []
+        if self.cache_node is not None:
+            for action in actions:
+                node = self.cache.get(self.cache_node, action)
+                if node is None:
+                    break
+                self.cache_node = node.id
+                self.pending.append(action)
+                batches.append(node.responses)
+
+        missed = actions[len(batches):]
+        if missed:
+            self._sync_tracer()
+            live = [self._atomic_transaction(missed[0])] if len(missed) == 1 else self._transaction(missed)
+            self.tracer_steps += len(missed)
+            for action, responses in zip(missed, live):
+                if self.cache_node is not None and len(responses):
+                    self.cache_node = self.cache.put(self.cache_node, action, responses)
+                else:
+                    # failed steps are not cached, the rest of the episode runs off the cached tree
+                    self.cache_node = None
+            batches.extend(live)
+        return batches
+
+    def _sync_tracer(self):
+        # bring the tracer to the end of the prefix that was served from the cache
+        if self.tracer_stale:
+            self._reset_tracer()
+            self.tracer_stale = False
+            self.tracer_steps = 0
+        if self.pending:
+            self.cache.stats["replayed"] += len(self.pending)
+            batches = self._transaction(self.pending)
+            # sent either way, the tracer needs a reset before the next episode
+            self.tracer_steps += len(self.pending)
+            if len(batches) != len(self.pending) or not all(len(responses) for responses in batches):
+                # the tracer is not at the end of the prefix, what it answers next must not be cached under it
+                self.cache.stats["replay_failures"] += 1
+                self.cache_node = None
+            self.pending = []
+
+    def _reset_tracer(self):
+        try:
+            with PROFILER.span("tracer_reset"):
+                self.client.reset()
+        except BaseException as e:
+            print("An exception occurred in Cannoli Env:", e)
+
     def step(self, action):
+        if self.cache is not None:
+            responses = self._cached_transaction([action])[0]
+        else:
+            responses = self._atomic_transaction(action)
+        return self._apply(action, responses)
+
+    def run_open_loop(self, actions: list) -> list:
+        """
+        open loop mode for replays, minimization and scripted prefixes. The actions (at most the steps left
+        in the episode) are sent to the tracer in a single transaction instead of one round trip per step,
+        then every action's events are applied as if step had been called with it.
+        Returns the (observation, reward, done, info) of every step
+        """
+        actions = list(actions[:self.steps_left])
+        batches = self._cached_transaction(actions) if self.cache is not None else self._transaction(actions)
+
+        results = []
+        for action, responses in zip(actions, batches):
+            observation, reward, done, info = self._apply(action, responses)
+            results.append((observation.clone(), reward, done, info))
+        return results
+
+    def run_scheduled(self, sequences: list) -> list:
+        """
+        runs a batch of planned episodes on the scheduler's tracers, sharing the execution of common action
+        prefixes (see prefix_scheduler.py), and applies each one as a complete episode of this env. Must be
+        called at the start of an episode and leaves the env at the start of a new one.
+        Returns the (observation, reward, done, info) of every step of every sequence
+        """
+        sequences = [list(sequence[:self.max_steps_episode]) for sequence in sequences]
+        try:
+            scheduled = self.scheduler.run(sequences)
+        except BaseException as e:
+            print("An exception occurred in Cannoli Env:", e)
+            scheduled = [[[] for _ in sequence] for sequence in sequences]
+
+        results = []
+        for sequence, batches in zip(sequences, scheduled):
+            episode = []
+            for action, responses in zip(sequence, batches):
+                observation, reward, done, info = self._apply(action, responses)
+                episode.append((observation.clone(), reward, done, info))
+            results.append(episode)
+            self._new_episode()
+        return results
+
+    def _apply(self, action, responses):
         current_step = self.max_steps_episode - self.steps_left
 
         self.action_sequence.append(action)
 
         episode_terminated = False
-        responses = self._atomic_transaction(action)
 
-        if not responses:
+        if not len(responses):
             print(f"Response is {responses} and likely action {action} is malformed")
 
-        xs = []
+        with PROFILER.span("build_state"):
+            next_state, incremental_reward, invariant_hit = self._state_and_reward(responses, current_step)
+
+        # if we've seen an invariant before in the episode multi
+        self.episode_reward += incremental_reward
+
+        with PROFILER.span("log"):
+            self.log(self.episode,
+                     self.epoch,
+                     self.episode_reward,
+                     incremental_reward,
+                     action[0],
+                     action[1],
+                     self.max_steps_episode - self.steps_left,
+                     responses)
+
+        if self.trajectories is not None:
+            self.trajectories.append(self.epoch, self.episode, current_step, self.action_ids.get(tuple(action), -1),
+                                     action[0], action[1] if len(action) > 1 else None, next_state.numpy(),
+                                     incremental_reward, self.episode_reward, invariant_hit)
+
+        self.last_state = next_state
+
+        self.steps_left -= 1
+        if not self.steps_left:
+            episode_terminated = True
+
+        self.observation_space[current_step] = self.last_state
+
+        return self.observation_space, self.episode_reward, episode_terminated, []
+
+    def _state_and_reward(self, responses, current_step) -> tuple:
+        # one [req_crc, valid_key, crc_magic1, crc_magic2, ret, command, invariant] row per event,
+        # decoded in one go for binary events
+        xs = featurize(responses)
         incremental_reward = 0
-        for response in responses:
-            req_crc = 0 if not response['req_crc'] else float(response['req_crc'])
-            valid_key = 0 if not response['valid_key'] else float(response['valid_key'])
-            crc_magic1 = 0 if not response['crc_magic1'] else float(response['crc_magic1'])
-            crc_magic2 = 0 if not response['crc_magic2'] else float(response['crc_magic2'])
-            ret = 0 if not response['return'] else float(response['return'])
-            command = float(response['command'])
-            invariant = float(response["invariants"])
+        for invariant in xs[:, 6]:
 
             # reward that incentivizes the reuse and composition of previously discovered gadgets
             # gadgets that cause immediate failure cannot be composed
@@ -131,75 +270,56 @@ class CannoliEnv(gym.Env):
                         incremental_reward *= 5 * self.invariants_previously_seen_in_episode
                 self.invariants_previously_seen_in_episode += 1
 
-            xs.append(
-                {"req_crc": req_crc, "valid_key": valid_key, "crc_magic1": crc_magic1, "crc_magic2": crc_magic2,
-                 "ret": ret,
-                 "command": command, "invariant": invariant})
-
         # TODO: this is a hack
-        if xs:
-            x = xs[0]
-            next_state = torch.tensor(
-                [x['req_crc'], x['valid_key'], x['crc_magic1'], x['crc_magic2'], x['ret'], x['command'],
-                 x['invariant']])
+        if len(xs):
+            next_state = torch.from_numpy(xs[0])
         else:
             next_state = torch.tensor([0, 0, 0, 0, 0, 0, 0])
         assert torch.is_tensor(next_state)
-
-        # if we've seen an invariant before in the episode multi
-        self.episode_reward += incremental_reward
-
-        self.log(self.episode,
-                 self.epoch,
-                 self.episode_reward,
-                 incremental_reward,
-                 action[0],
-                 action[1],
-                 self.max_steps_episode - self.steps_left,
-                 responses)
-
-        self.last_state = next_state
-
-        self.steps_left -= 1
-        if not self.steps_left:
-            episode_terminated = True
-
-        self.observation_space[current_step] = self.last_state
-
-        return self.observation_space, self.episode_reward, episode_terminated, []
+        return next_state, incremental_reward, bool(xs[:, 6].any())
 
     def log(self, episode, epoch, total_reward, incremental_reward, last_action, last_param, test, events):
-        out = dict()
-        out["episode"] = episode
-        out["epoch"] = epoch
-        out["total_reward"] = total_reward
-        out["incremental_reward"] = incremental_reward
-        out["last_action"] = last_action
-        out["last_param"] = last_param
-        out["test"] = test
-        out["events"] = events
-        self.db_events.append((epoch, episode, test, json.dumps(out)))
+        self.writer.log_step(epoch, episode, test, last_action, last_param, total_reward, incremental_reward, events)
 
     def reset(self, **kwargs):
-        try:
-            self.client.reset()
-        except BaseException as e:
-            print("An exception occurred in Cannoli Env:", e)
-        self.observation_space = torch.zeros(self.observation_shape)
+        if self.cache is None:
+            self._reset_tracer()
+        else:
+            # deferred to the first cache miss of the episode, if any
+            self.tracer_stale = self.tracer_stale or self.tracer_steps > 0
+            self.cache_node = ROOT
+            self.pending = []
+        return self._new_episode()
+
+    def _new_episode(self):
+        # the steps of the episode that just ended are already queued, only its total is left
+        if self.steps_left != self.max_steps_episode:
+            self.writer.end_episode(self.epoch, self.episode, self.episode_reward,
+                                    self.max_steps_episode - self.steps_left)
+
+        # zeroed in place, callers keeping an episode's observation past reset copy it
+        self.observation_space.zero_()
         self.episode_reward = 0
         self.last_state = None
         self.steps_left = self.max_steps_episode
         self.action_sequence = []
         self.invariants_previously_seen_in_episode = 1
 
-        # write to database
-        self.db.executemany(f"INSERT INTO {self.test_name} VALUES(?, ?, ?, ?)", self.db_events)
-        self.con.commit()
-        self.db_events = list()
-
         self.episode += 1
         if self.episode == self.n_episodes:
             self.epoch += 1
             self.episode = 0
 
         return self.observation_space
+
+    def close(self):
+        """
+        stops the tracer and its spares and commits the remaining steps
+        """
+        self.client.shutdown()
+        if self.scheduler is not None:
+            for worker in self.scheduler.workers:
+                worker.client.shutdown()
+        self.writer.close()
+        if self.trajectories is not None:
+            self.trajectories.close()
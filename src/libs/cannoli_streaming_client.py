@@ -1,11 +1,23 @@
 import socket, time, os, signal
-import subprocess, pathlib, json, pickle, hashlib
-from .bench import Bench
+import subprocess, pathlib, json, pickle
+from .bench import Bench, MonitorError
+from .tracer_pool import TracerPool, TracerInstance
+from .transaction import GroupDecoder, encode_transaction, read_ack
+from .instrumentation import PROFILER
+from .invariants import RuleEngine
+from .frame_decoder import FrameDecoder, is_end_of_batch
+from .event_schema import BINARY_SCHEMA, JSON_SCHEMA, EVENT_DTYPE, decode_events, events_from_dicts, \
+    is_binary, to_dicts
+import numpy as np
 
 BUFFER_SIZE = 1024
-POISON = 0x36afb081
 INIT_EVENT_COUNT = 4
-SCHEMAS = ["heap"]
+
+# reset modes: respawn boots a fresh bench/QEMU instance every episode, snapshot boots it once,
+# saves the vm state once the target reached its initial state and restores that on every reset
+RESPAWN_RESET = "respawn"
+SNAPSHOT_RESET = "snapshot"
+SNAPSHOT_TAG = "nav_initial"
 
 # Things to think about / do
 # 1. Hook up NAV & Tracer to this file -> anything that changes in the loop
@@ -20,18 +32,48 @@ SCHEMAS = ["heap"]
 
 class CannoliStreamingClient:
 
-    def __init__(self, exec_name):
+    def __init__(self, exec_name, nav_id=None, bench_dir=None, event_schema=JSON_SCHEMA, reset_mode=RESPAWN_RESET,
+                 tracer_pool: dict = None, bench=None, invariants: list = None, transactions: bool = False):
         """
         initializes qemu and cannoli socket connections
+
+        nav_id: identifier of the /tmp/nav_<id> socket the tracer connects to,
+        defaults to the pid so that a single env per process keeps working
+        bench_dir: working directory of the bench instance, defaults to UEFI_PATH
+        event_schema: "json" or "binary", the payload format requested from the tracer. With "binary"
+        try_read returns a structured array of EVENT_DTYPE instead of a list of dicts
+        reset_mode: "respawn" or "snapshot", see reset
+        tracer_pool: TracerPool settings (size, health_check_interval, max_lifetime, boot_timeout). When
+        given, respawning resets take a pre-booted tracer from the pool instead of booting one
+        bench: object used to spawn the tracer instead of Bench, e.g. mock_tracer.MockBench
+        invariants: rules of the `invariants` section of the target YAML (see invariants.py), defaults to
+        invariants.DEFAULT_RULES
+        transactions: ask the tracer for multi-action transactions (see transaction.py). try_transaction falls
+        back to one round trip per action when the tracer does not acknowledge them
         """
-        self.recv_buf: bytes = b''
+        self.decoder = FrameDecoder()
         self.events = list()
-        self.memos = dict()
+        self.rules = RuleEngine(invariants)
         self.command = None
         self.expected_lockbox = None
-        self.pid = os.getpid()
-        self.bench = Bench()
+        self.pid = os.getpid() if nav_id is None else nav_id
+        self.event_schema = event_schema
+        self.bench = bench or Bench(bench_dir=bench_dir)
         self.conn = None
+        # set once the tracer terminated a batch with an empty frame, from then on batches are
+        # only considered complete once their end marker arrived
+        self.end_markers = False
+        self.cannoli_sock = None
+        self.reset_mode = reset_mode
+        self.snapshot_ready = False
+        # requested until a tracer failed to acknowledge them, every tracer runs the same build
+        self.request_transactions = transactions
+        self.transactions = False
+        self.pool = TracerPool(self.pid, bench_dir=bench_dir, event_schema=event_schema, bench=bench,
+                               monitor=reset_mode == SNAPSHOT_RESET, transactions=transactions,
+                               **tracer_pool) if tracer_pool else None
+        # the pooled tracer attached to, if any, closing it also removes its socket file
+        self.instance = None
 
 
         # flush all init (pre-main) events and return the last one,
@@ -39,7 +81,9 @@ class CannoliStreamingClient:
         # self._flush()
 
     def spawn_tracer(self):
-        self.bench.run(self.pid)
+        monitor_path = f"/tmp/nav_{self.pid}.monitor" if self.reset_mode == SNAPSHOT_RESET else None
+        self.bench.run(self.pid, event_schema=self.event_schema, monitor_path=monitor_path,
+                       transactions=self.request_transactions)
 
     def connect_to_tracer(self):
         # create receive socket for Cannoli feedback
@@ -58,6 +102,18 @@ class CannoliStreamingClient:
         self.conn, addr = self.cannoli_sock.accept()
         print("[*] NAV: received connection on " + self.recv_path_cannoli)
         self.conn.settimeout(30)
+        if self.request_transactions:
+            self._negotiated(*read_ack(self.conn))
+        else:
+            self.transactions = False
+
+    def _negotiated(self, acknowledged: bool, pending: bytes):
+        self.transactions = acknowledged
+        # whatever the tracer sent in place of the acknowledgement starts the event stream
+        self.decoder.feed(pending)
+        if self.request_transactions and not acknowledged:
+            print("[*] NAV: tracer did not acknowledge transactions, sending actions one at a time")
+            self.request_transactions = False
 
 
 
@@ -77,9 +133,10 @@ class CannoliStreamingClient:
         action: input string
         """
         self.command = choice[0]
-        data = pickle.dumps(choice)
         print("NAV->Tracer: ", choice)
-        n = self.conn.send(data + b'\n')
+        with PROFILER.span("try_write"):
+            data = pickle.dumps(choice)
+            n = self.conn.send(data + b'\n')
         # print(f"[*] NAV: sent {n} bytes: {action.encode()} to qemu process")
         # self.qemu.stdin.flush()
 
@@ -111,124 +168,243 @@ class CannoliStreamingClient:
         # receive bytes
         if not self.conn:
             return []
-        while True:
+        self.events = list()
+        # the start of this batch may already be buffered behind the end of the previous one
+        end_of_batch = False
+        if len(self.decoder):
+            with PROFILER.span("parse"):
+                end_of_batch = self.parse()
+        while not end_of_batch:
             try:
-                b = self.conn.recv(BUFFER_SIZE)
-                if b == b'' and self.recv_buf != b'': break
-                self.recv_buf += b
+                with PROFILER.span("tracer_wait"):
+                    b = self.conn.recv(BUFFER_SIZE)
+                if b == b'' and len(self.decoder): break
+                self.decoder.feed(b)
+                # stop as soon as the tracer marks the end of the batch
+                with PROFILER.span("parse"):
+                    end_of_batch = self.parse()
+                if end_of_batch:
+                    self.end_markers = True
+                    break
                 # break if didn't receive a full buffer
                 # print("received data: ", b)
-                if len(b) != BUFFER_SIZE: break
+                if len(b) != BUFFER_SIZE and not self.end_markers: break
             except Exception as e:
                 print("Exception receiving", e)
                 break
 
-        self.events = list()
-        self.parse()
-        for e in self.events:
-            e["command"] = self.command
-            invariants = self.check(e)
-            e["invariants"] = invariants[0]
+        with PROFILER.span("check"):
+            self.events = self._annotate(self.events, self.command)
         # # return data to nav here
         return self.events
 
+    def _annotate(self, events: list, command):
+        # tag events with the command that produced them and check invariants
+        if self.event_schema == BINARY_SCHEMA:
+            events = self._as_array(events)
+            events["command"] = command
+            events["invariant"] = self.rules.check_batch(events).any(axis=1)
+            return events
+
+        for e in events:
+            if isinstance(e, np.ndarray):
+                # binary events the tracer sent without being asked to
+                events = self._as_dicts(events)
+                break
+        for e in events:
+            e["command"] = command
+            e["invariants"] = any(self.rules.check(command, e))
+        return events
 
-    def check(self, e: dict) -> tuple:
-        def dict_hash(dictionary) -> str:
-            dhash = hashlib.md5()
-            encoded = json.dumps(dictionary, sort_keys=True).encode()
-            dhash.update(encoded)
-            return dhash.hexdigest()
-
-        # check memos
-        h = dict_hash(e)
-        if h in self.memos:
-            return self.memos[h]
-
-        # calculate invariant and store in hash table
-        invariants = (False,)
-        if self.command == 2 and e["return"] == 0:
-            print("[INVARIANT VIOLATION]: GetAccessVariable returned EFI_SUCCESS")
-            invariants = (True,)
-        self.memos[h] = invariants
-        # print(self.memos)
-        return invariants
-
-    # parse packets stored in internal receive buffer and store events
-    def parse(self) -> None:
-        while True:
-            if len(self.recv_buf) < 4:
-                self.reset_buffer()
-                return
+    def try_transaction(self, actions: list) -> list:
+        """
+        sends a sequence of actions in a single binary frame (see transaction.py) and returns one batch
+        of events per action, in action order. Actions the tracer did not answer get an empty batch.
+        Without an acknowledgement of transactions from the tracer the actions are sent one at a time
+        """
+        if not self.conn:
+            return [[] for _ in actions]
+        if not self.transactions:
+            batches = []
+            for action in actions:
+                self.try_write(action)
+                batches.append(self.try_read())
+            return batches
+        self.bench.read_from_pipe()
+        print("NAV->Tracer: ", actions)
+        self.conn.sendall(encode_transaction(actions))
+
+        groups = {}
+        decoder = GroupDecoder()
+        while len(groups) < len(actions):
+            try:
+                b = self.conn.recv(BUFFER_SIZE)
+            except Exception as e:
+                print("Exception receiving", e)
+                break
+            if b == b'':
+                break
+            decoder.feed(b)
+            while True:
+                group = decoder.next_group()
+                if group is None:
+                    break
+                seq, frames = group
+                if seq < len(actions):
+                    groups[seq] = frames
+        if len(groups) < len(actions):
+            print(f"[*] NAV: tracer answered {len(groups)} of {len(actions)} actions of a transaction")
+
+        batches = []
+        for seq, action in enumerate(actions):
+            frame_decoder = FrameDecoder()
+            frame_decoder.feed(groups.get(seq, b''))
+            events = []
+            for frame in frame_decoder.frames():
+                events.extend(self._decode_payloads(frame))
+            self.command = action[0]
+            batches.append(self._annotate(events, action[0]))
+        return batches
+
+    @staticmethod
+    def _as_array(events: list) -> np.ndarray:
+        # parse() collects structured arrays for binary payloads and dicts for json ones
+        chunks = [e if isinstance(e, np.ndarray) else events_from_dicts([e]) for e in events]
+        return np.concatenate(chunks) if chunks else np.zeros(0, dtype=EVENT_DTYPE)
+
+    @staticmethod
+    def _as_dicts(events: list) -> list:
+        out = []
+        for e in events:
+            out.extend(to_dicts(e) if isinstance(e, np.ndarray) else [e])
+        return out
 
-            # check packet integrity by comparing poison value
-            poison = int.from_bytes(self.recv_buf[:4], "little")
-            if POISON != poison:
-                # packet corrupted, flush until next poison is found
-                self.reset_buffer()
-                continue
-            self.recv_buf = self.recv_buf[4:]
 
-            # get schema lengths. Indexes correspond to the schemas defined in
-            # SCHEMAS
-            schema_lengths = []
-            if len(self.recv_buf) < len(SCHEMAS) * 4:
-                self.reset_buffer()
+    def check(self, e: dict) -> tuple:
+        return self.rules.check(self.command, e)
+
+    # parse packets stored in internal receive buffer and store events.
+    # Returns True once an end of batch frame has been parsed
+    def parse(self) -> bool:
+        for frame in self.decoder.frames():
+            if is_end_of_batch(frame):
+                return True
+            self.events.extend(self._decode_payloads(frame))
+        return False
+
+    @staticmethod
+    def _decode_payloads(frame: tuple) -> list:
+        events = []
+        # TO DO: if returning more than one schema, would accumulate in
+        # dict or list here
+        for data in frame:
+            if not data:
                 continue
-            for i in range(len(SCHEMAS)):
-                schema_lengths.append(int.from_bytes(self.recv_buf[:4], "little"))
-                self.recv_buf = self.recv_buf[4:]
-
-            schema_data = {}
-            # use schema lengths to parse schema data (if available)
-            for i in range(len(SCHEMAS)):
-                if len(self.recv_buf) < schema_lengths[i]:
-                    self.reset_buffer()
-                    continue
-
-                # full event available in buffer. Parse and store event
-                data = self.recv_buf[:schema_lengths[i]]
-                self.recv_buf = self.recv_buf[schema_lengths[i]:]
-                try:
-                    # TO DO: can there be more than one schema returned??
-                    # schema_data[SCHEMAS[i]] = json.loads(data.decode())
-                    j = json.loads(data.decode())
-                    self.events.append(j)
-                except:
-                    # failure to deserialize, scrap rest of buffer until next
-                    # poison
-                    self.reset_buffer()
-                    continue
-
-                # TO DO: if returning more than one schema, would accumulate in
-                # dict or list in `try` clause above and return here
-                # return ??
-
-            # the following exceptions return none:
-            # socket.timeout, int conversion failure, buffer out of space
-            # except:
-            # return None
-
-    # finds next poison value to reset buffer. If dne, null buffer out
-    def reset_buffer(self) -> None:
-        idx = self.recv_buf.find(POISON.to_bytes(4, "little"))
-        if (idx >= 0):
-            self.recv_buf = self.recv_buffer[idx:]
-        else:
-            self.recv_buffer = b''
+            try:
+                if is_binary(data):
+                    events.append(decode_events(data))
+                else:
+                    events.append(json.loads(data))
+            except ValueError:
+                # failure to deserialize, the decoder already moved past the
+                # frame so carry on with the next one
+                print("failed to deserialize event")
+        return events
 
     def reset(self):
         """
-        kills socket connections
+        brings the target back to its initial state.
+
+        In respawn mode the current bench instance and its socket are torn down and a new one is
+        booted. In snapshot mode the first reset boots the target and saves a snapshot once the
+        initial events were flushed, later resets restore that snapshot over the QEMU monitor and
+        keep the tracer connection, which takes milliseconds instead of a full boot
         """
-        self.recv_buf: bytes = b''
+        self.decoder.clear()
         self.events = list()
-        self.memos = dict()
         self.expected_lockbox = None
 
-        # reinitialize bench
-        self.spawn_tracer()
-        self.connect_to_tracer()
+        if self.reset_mode == SNAPSHOT_RESET and self.snapshot_ready:
+            try:
+                self.restore_snapshot()
+                return
+            except (OSError, MonitorError) as e:
+                print("[*] NAV: failed to restore snapshot, respawning tracer:", e)
+                self.snapshot_ready = False
+
+        self.close()
+
+        if self.pool:
+            self._attach(self.pool.acquire())
+        else:
+            # reinitialize bench
+            self.spawn_tracer()
+            self.connect_to_tracer()
+
+        if self.reset_mode == SNAPSHOT_RESET:
+            self.take_snapshot()
+
+    def take_snapshot(self):
+        # the init (pre-main) events describe the initial state, snapshot once they are consumed
+        self._flush()
+        if self.bench.monitor is None:
+            print("[*] NAV: tracer has no QEMU monitor, falling back to respawning")
+            return
+        try:
+            self.bench.monitor.savevm(SNAPSHOT_TAG)
+            self.snapshot_ready = True
+        except (OSError, MonitorError) as e:
+            print("[*] NAV: failed to take snapshot, falling back to respawning:", e)
+
+    def restore_snapshot(self, tag: str = SNAPSHOT_TAG):
+        self.bench.monitor.loadvm(tag)
+        self._drain()
+
+    def _drain(self):
+        # drop whatever the tracer sent for the previous episode
+        self.conn.setblocking(False)
+        try:
+            while self.conn.recv(BUFFER_SIZE):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        finally:
+            self.conn.settimeout(30)
+        self.decoder.clear()
+
+    def _attach(self, instance: TracerInstance):
+        self.instance = instance
+        self.bench = instance.bench
+        self.cannoli_sock = instance.sock
+        self.conn = instance.conn
+        self.recv_path_cannoli = instance.path
+        print("[*] NAV: attached to pooled tracer on " + self.recv_path_cannoli)
+        self._negotiated(instance.transactions, instance.pending)
+
+    def close(self):
+        """
+        kills the bench instance and socket connections
+        """
+        if self.instance is not None:
+            self.instance.kill()
+            self.instance = None
+            self.conn = self.cannoli_sock = None
+            return
+        self.bench.kill()
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+        if self.cannoli_sock:
+            self.cannoli_sock.close()
+            self.cannoli_sock = None
+
+    def shutdown(self):
+        """
+        closes the current tracer and every spare of the tracer pool
+        """
+        self.close()
+        if self.pool:
+            self.pool.close()
 
     def _handle_kill(self):
         print("killing streaming client")
@@ -1,24 +1,43 @@
-import sqlite3
-import json
-con = sqlite3.connect("./demo.db")
-cur = con.cursor()
-pid = 10
-test_name = f"test_{pid}"
-# cur.execute(f"INSERT INTO tests VALUES({pid}, {test_name})")
-for res in cur.execute("SELECT * from tests"):
-    print(res)
-res = cur.execute("SELECT * FROM tests WHERE uuid = (SELECT MAX(uuid) from tests)")
-last = res.fetchone()[1]
-print(last)
-# epoch = 0
-# episode = 0
-# test = 1
-# data = [
-#     (0, 0, 1, json.dumps({"epoch": 0, "episode": 0, "test": 0, "data": [{"command":1, "req_crc":0}]})),
-#     (0, 0, 2, json.dumps({"epoch": 0, "episode": 0, "test": 0, "data": [{"command":1, "req_crc":0}]})),
-# ]
-# cur.executemany(f"INSERT INTO {test_name} VALUES(?, ?, ?, ?)", data)
-# con.commit()
-# test_name = "test_1223612"
-for row in cur.execute(f"SELECT * FROM {last} WHERE episode = 1 ORDER BY test ASC"):
-    print(row)
+"""
+Triage of past runs from the command line, see run_history.py
+
+    python -m libs.db                          latest run and its episodes
+    python -m libs.db --episode 1              steps and events of an episode of the latest run
+    python -m libs.db --invariants 100         episodes that hit an invariant with a reward above 100
+    python -m libs.db --top 10 demo.db         best episodes of demo.db
+"""
+from argparse import ArgumentParser
+
+from .run_history import HISTORY_GLOB, RunHistory
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("paths", nargs="*", help=f"trace databases, defaults to {HISTORY_GLOB}")
+    parser.add_argument("--episode", type=int, default=None, help="episode of the latest run to print")
+    parser.add_argument("--invariants", type=float, default=None, metavar="MIN_REWARD")
+    parser.add_argument("--top", type=int, default=None)
+    parser.add_argument("--actions", action="store_true", help="actions that hit invariants")
+    args = parser.parse_args()
+
+    with (RunHistory(args.paths) if args.paths else RunHistory.discover()) as history:
+        if args.invariants is not None:
+            for row in history.invariant_episodes(min_reward=args.invariants):
+                print(row)
+        elif args.top is not None:
+            for row in history.top_episodes(args.top):
+                print(row)
+        elif args.actions:
+            for action, hits in history.invariant_actions():
+                print(action, hits)
+        else:
+            last = history.latest_run()
+            print(last)
+            if last is not None:
+                for episode in history.episodes(last):
+                    if args.episode is None:
+                        print(episode)
+                    elif episode["episode"] == args.episode:
+                        for row in history.episode_steps(episode):
+                            print(row)
+                        for row in history.episode_events(episode):
+                            print(row)
@@ -0,0 +1,115 @@
+import struct
+
+import numpy as np
+
+# Compact fixed layout binary alternative to the JSON event payloads.
+#
+# A tracer opts in when it is started with CANNOLI_EVENT_SCHEMA=binary (see Bench.run). Payloads stay
+# inside the usual POISON frames and are self describing, so a tracer that does not know about the binary
+# schema keeps sending JSON and the client decodes whatever it receives.
+#
+#      4 bytes       u16        u16         u32
+# .-------------.---------.-------------.---------.-------------------------.
+# |    "CEV1"   | version | record size |  count  | count * EVENT_DTYPE ... |
+# `-------------`---------`-------------`---------`-------------------------`
+#
+# Fields that were null in the JSON representation are 0 and have their bit cleared in `present`.
+# `command` and `invariant` are filled in by the client.
+
+EVENT_MAGIC = b"CEV1"
+EVENT_VERSION = 1
+BINARY_SCHEMA = "binary"
+JSON_SCHEMA = "json"
+
+# wire fields in the order of their presence bits
+FIELDS = ["req_crc", "valid_key", "crc_magic1", "crc_magic2", "return", "heap_start", "heap_end", "heap_entropy"]
+PRESENT = {field: 1 << i for i, field in enumerate(FIELDS)}
+
+EVENT_DTYPE = np.dtype([
+    ("req_crc", "<u8"),
+    ("valid_key", "<u8"),
+    ("crc_magic1", "<u8"),
+    ("crc_magic2", "<u8"),
+    ("return", "<u8"),
+    ("heap_start", "<u8"),
+    ("heap_end", "<u8"),
+    ("heap_entropy", "<f4"),
+    ("command", "<i4"),
+    ("present", "<u2"),
+    ("invariant", "u1"),
+    ("_pad", "u1"),
+])
+
+HEADER = struct.Struct("<4sHHI")
+
+# columns of the 7-field observation built by CannoliEnv.step
+STATE_FIELDS = ["req_crc", "valid_key", "crc_magic1", "crc_magic2", "return", "command", "invariant"]
+
+
+def is_binary(payload) -> bool:
+    return payload[:len(EVENT_MAGIC)] == EVENT_MAGIC
+
+
+def decode_events(payload) -> np.ndarray:
+    """
+    decodes a binary payload straight into a structured array of EVENT_DTYPE
+    """
+    magic, version, record_size, count = HEADER.unpack_from(payload, 0)
+    if magic != EVENT_MAGIC or version != EVENT_VERSION or record_size != EVENT_DTYPE.itemsize:
+        raise ValueError(f"unsupported event schema {magic} v{version} with {record_size} byte records")
+    return np.frombuffer(payload, dtype=EVENT_DTYPE, count=count, offset=HEADER.size).copy()
+
+
+def encode_events(events: np.ndarray) -> bytes:
+    return HEADER.pack(EVENT_MAGIC, EVENT_VERSION, EVENT_DTYPE.itemsize, len(events)) + events.tobytes()
+
+
+def events_from_dicts(events: list) -> np.ndarray:
+    """
+    converts JSON decoded events into the structured representation
+    """
+    out = np.zeros(len(events), dtype=EVENT_DTYPE)
+    for i, e in enumerate(events):
+        heap = (e.get("heap") or {}).get("meta") or {}
+        bounds = heap.get("bounds") or {}
+        values = {"req_crc": e.get("req_crc"), "valid_key": e.get("valid_key"), "crc_magic1": e.get("crc_magic1"),
+                  "crc_magic2": e.get("crc_magic2"), "return": e.get("return"), "heap_start": bounds.get("start"),
+                  "heap_end": bounds.get("end"), "heap_entropy": heap.get("entropy")}
+        present = 0
+        for field, value in values.items():
+            if value is not None:
+                if isinstance(value, int) and value < 0:
+                    value &= (1 << 64) - 1
+                out[field][i] = value
+                present |= PRESENT[field]
+        out["present"][i] = present
+        out["command"][i] = e.get("command") or 0
+        out["invariant"][i] = bool(e.get("invariants"))
+    return out
+
+
+def to_dicts(events: np.ndarray) -> list:
+    """
+    JSON compatible view of structured events, absent fields are None like in the JSON schema
+    """
+    out = []
+    for record in events.tolist():
+        row = dict(zip(EVENT_DTYPE.names, record))
+        present = row.pop("present")
+        row.pop("_pad")
+        for field in FIELDS:
+            if not present & PRESENT[field]:
+                row[field] = None
+        row["invariants"] = bool(row.pop("invariant"))
+        out.append(row)
+    return out
+
+
+def featurize(events) -> np.ndarray:
+    """
+    [n_events, 7] float32 observation rows for either representation of a batch of events
+    """
+    if not isinstance(events, np.ndarray):
+        events = events_from_dicts(events)
+    return np.stack([events[field].astype(np.float32) for field in STATE_FIELDS], axis=-1) \
+        if len(events) else np.zeros((0, len(STATE_FIELDS)), dtype=np.float32)
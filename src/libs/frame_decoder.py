@@ -0,0 +1,107 @@
+import struct
+
+POISON = 0x36afb081
+SCHEMAS = ["heap"]
+POISON_BYTES = POISON.to_bytes(4, "little")
+# compact the receive buffer once this many consumed bytes have piled up in front of the cursor
+COMPACT_THRESHOLD = 1 << 16
+# anything larger than this is treated as a corrupted length field
+MAX_SCHEMA_LEN = 1 << 26
+
+
+class FrameDecoder:
+    """
+    Incremental decoder for the POISON wire format (see CannoliStreamingClient.try_read).
+
+    Received bytes are appended to a single bytearray and frames are decoded in place behind a read
+    cursor: headers are read with struct.unpack_from, payloads are sliced from a memoryview and the
+    buffer is only compacted once the consumed prefix is large, so the cost of decoding is linear in
+    the number of bytes received. On corruption the cursor jumps to the next poison value with
+    bytearray.find instead of copying the rest of the buffer.
+
+    next_frame() returns one tuple of payloads per frame, indexed like SCHEMAS. A frame whose schema
+    lengths are all 0 marks the end of an event batch and decodes to a tuple of empty payloads.
+    """
+
+    def __init__(self, n_schemas: int = len(SCHEMAS), compact_threshold: int = COMPACT_THRESHOLD,
+                 max_schema_len: int = MAX_SCHEMA_LEN):
+        self.header = struct.Struct("<" + "I" * (1 + n_schemas))
+        self.n_schemas = n_schemas
+        self.compact_threshold = compact_threshold
+        self.max_schema_len = max_schema_len
+
+        self.buf = bytearray()
+        self.pos = 0
+        # number of bytes thrown away while resynchronizing on a poison value
+        self.dropped = 0
+
+    def __len__(self) -> int:
+        return len(self.buf) - self.pos
+
+    def feed(self, data) -> None:
+        self._compact()
+        self.buf += data
+
+    def clear(self) -> None:
+        self.buf = bytearray()
+        self.pos = 0
+
+    def _compact(self) -> None:
+        if self.pos == len(self.buf):
+            self.buf.clear()
+            self.pos = 0
+        elif self.pos >= self.compact_threshold and self.pos * 2 >= len(self.buf):
+            del self.buf[:self.pos]
+            self.pos = 0
+
+    def _resync(self) -> None:
+        # skip to the next poison value after the cursor. If there is none keep the last 3 bytes
+        # around, they could be the start of a poison value split across two reads
+        idx = self.buf.find(POISON_BYTES, self.pos + 1)
+        if idx < 0:
+            idx = max(self.pos + 1, len(self.buf) - len(POISON_BYTES) + 1)
+        self.dropped += idx - self.pos
+        self.pos = idx
+
+    def next_frame(self):
+        """
+        decodes the frame under the cursor. Returns None if the buffer does not hold a complete frame yet
+        """
+        while len(self) >= self.header.size:
+            header = self.header.unpack_from(self.buf, self.pos)
+            poison, schema_lengths = header[0], header[1:]
+            if poison != POISON or max(schema_lengths, default=0) > self.max_schema_len:
+                self._resync()
+                continue
+
+            end = self.pos + self.header.size + sum(schema_lengths)
+            if end > len(self.buf):
+                return None
+
+            payloads = []
+            start = self.pos + self.header.size
+            with memoryview(self.buf) as view:
+                for length in schema_lengths:
+                    payloads.append(bytes(view[start:start + length]))
+                    start += length
+            self.pos = end
+            return tuple(payloads)
+
+        if len(self) and self.buf.find(POISON_BYTES[:len(self)], self.pos) != self.pos:
+            # not even the start of a poison value, no point in waiting for the rest of the header
+            self._resync()
+        return None
+
+    def frames(self):
+        """
+        yields every complete frame currently buffered
+        """
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                return
+            yield frame
+
+
+def is_end_of_batch(frame: tuple) -> bool:
+    return not any(frame)
@@ -0,0 +1,121 @@
+import math
+import os
+import time
+
+# histogram buckets grow geometrically from 1us, 200 buckets of 10% cover up to ~3 minutes
+MIN_SECONDS = 1e-6
+GROWTH = 1.1
+N_BUCKETS = 200
+
+
+class StreamingHistogram:
+    """
+    fixed memory histogram of durations with log spaced buckets, quantiles are accurate to ~5%
+    """
+
+    def __init__(self):
+        self.buckets = [0] * N_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float) -> None:
+        idx = 0 if seconds <= MIN_SECONDS else int(math.log(seconds / MIN_SECONDS, GROWTH)) + 1
+        self.buckets[min(idx, N_BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for idx, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n:
+                # geometric middle of the bucket, clamped by the largest value seen
+                return min(MIN_SECONDS * GROWTH ** (idx - 0.5) if idx else MIN_SECONDS, self.max)
+        return self.max
+
+    def merge(self, other: "StreamingHistogram") -> None:
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+
+class _Span:
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Profiler:
+    """
+    Per phase latency of the rollout path. Phases are timed with monotonic clock spans
+
+        with PROFILER.span("parse"):
+            ...
+
+    and kept in streaming histograms. When disabled a span is a shared no-op context manager, so
+    instrumentation left in the hot path costs a method call.
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.phases = {}
+
+    def span(self, name: str):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name)
+
+    def record(self, name: str, seconds: float) -> None:
+        histogram = self.phases.get(name)
+        if histogram is None:
+            histogram = self.phases[name] = StreamingHistogram()
+        histogram.record(seconds)
+
+    def summary(self) -> dict:
+        """
+        flat {phase/metric: value} dict with p50/p99 in milliseconds, ready for LightningModule.log_dict
+        """
+        out = {}
+        for name, histogram in sorted(self.phases.items()):
+            out[f"latency/{name}/p50_ms"] = histogram.quantile(0.5) * 1e3
+            out[f"latency/{name}/p99_ms"] = histogram.quantile(0.99) * 1e3
+            out[f"latency/{name}/total_s"] = histogram.total
+            out[f"latency/{name}/count"] = float(histogram.count)
+        return out
+
+    def reset(self) -> None:
+        self.phases = {}
+
+
+# process wide profiler, enabled with NAV_PROFILE=1 or the `profile` key of the target YAML
+PROFILER = Profiler(enabled=os.environ.get("NAV_PROFILE") == "1")
@@ -0,0 +1,165 @@
+import functools
+import operator
+
+import numpy as np
+
+from .event_schema import FIELDS, PRESENT
+
+# Invariants are declared in the `invariants` section of the target YAML and compiled once into
+# predicates that work on a single JSON event as well as on a whole structured array of binary events.
+#
+# invariants:
+#   - name: get_access_variable_success
+#     message: GetAccessVariable returned EFI_SUCCESS
+#     when:
+#       command: 2          # shorthand for {eq: 2}
+#       return: {eq: 0}
+#
+# A rule is violated by an event when every condition of `when` holds. A condition on a field the event
+# does not carry (null in JSON, presence bit cleared in binary) never holds.
+
+DEFAULT_RULES = [
+    {"name": "get_access_variable_success",
+     "message": "GetAccessVariable returned EFI_SUCCESS",
+     "when": {"command": 2, "return": 0}},
+]
+
+# bound of the per-event result cache, keyed on the values of the fields the rules look at
+CACHE_SIZE = 1 << 16
+
+RULE_FIELDS = FIELDS + ["command"]
+_U64_FIELDS = {field for field in FIELDS if field != "heap_entropy"}
+
+# op -> (scalar predicate, vectorized predicate)
+OPS = {
+    "eq": (operator.eq, operator.eq),
+    "ne": (operator.ne, operator.ne),
+    "lt": (operator.lt, operator.lt),
+    "le": (operator.le, operator.le),
+    "gt": (operator.gt, operator.gt),
+    "ge": (operator.ge, operator.ge),
+    "in": (lambda x, v: x in v, lambda x, v: np.isin(x, list(v))),
+    "not_in": (lambda x, v: x not in v, lambda x, v: ~np.isin(x, list(v))),
+    "bits": (lambda x, v: (x & v) != 0, lambda x, v: (x & np.uint64(v)) != 0),
+}
+
+
+def _normalize(field: str, value):
+    # wire fields are u64, negative JSON ints are stored two's complement like in events_from_dicts
+    if field in _U64_FIELDS and isinstance(value, int) and value < 0:
+        return value & ((1 << 64) - 1)
+    return value
+
+
+def _event_value(e: dict, field: str):
+    if field in ("heap_start", "heap_end", "heap_entropy"):
+        heap = (e.get("heap") or {}).get("meta") or {}
+        value = heap.get("entropy") if field == "heap_entropy" else (heap.get("bounds") or {}).get(field[5:])
+    else:
+        value = e.get(field)
+    return _normalize(field, value)
+
+
+class Condition:
+
+    def __init__(self, field: str, op: str, value):
+        if field not in RULE_FIELDS:
+            raise ValueError(f"unknown event field {field}, expected one of {RULE_FIELDS}")
+        if op not in OPS:
+            raise ValueError(f"unknown operator {op}, expected one of {list(OPS)}")
+        if op in ("in", "not_in"):
+            value = frozenset(_normalize(field, v) for v in value)
+        else:
+            value = _normalize(field, value)
+        self.field = field
+        self.op = op
+        self.value = value
+        self.scalar, self.vector = OPS[op]
+
+    def holds(self, value) -> bool:
+        return value is not None and bool(self.scalar(value, self.value))
+
+    def holds_batch(self, events: np.ndarray) -> np.ndarray:
+        mask = self.vector(events[self.field], self.value)
+        if self.field in PRESENT:
+            mask &= (events["present"] & PRESENT[self.field]) != 0
+        return mask
+
+
+class Rule:
+
+    def __init__(self, name: str, when: dict, message: str = None):
+        if not when:
+            raise ValueError(f"invariant {name} has no conditions")
+        self.name = name
+        self.message = message or name
+        self.conditions = []
+        for field, spec in when.items():
+            if isinstance(spec, dict):
+                self.conditions.extend(Condition(field, op, value) for op, value in spec.items())
+            else:
+                self.conditions.append(Condition(field, "eq", spec))
+
+
+class RuleEngine:
+    """
+    Evaluates the compiled invariants of a target. Binary batches are evaluated column-wise over the
+    structured array, JSON events one by one through a bounded LRU keyed on the values of the fields the
+    rules reference, so a memo hit costs a tuple build instead of hashing the JSON dump of the event.
+
+    Every violation is counted per rule in `violations`. Its message is only printed when the result is
+    freshly computed, on a cache miss for JSON events and the first time a rule fires in binary batches, so
+    a hot invariant does not flood stdout.
+    """
+
+    def __init__(self, rules: list = None, cache_size: int = CACHE_SIZE):
+        self.rules = [Rule(**rule) for rule in (DEFAULT_RULES if rules is None else rules)]
+        self.fields = sorted({c.field for rule in self.rules for c in rule.conditions}, key=RULE_FIELDS.index)
+        self._check_key = functools.lru_cache(maxsize=cache_size)(self._evaluate_key)
+        self.violations = {rule.name: 0 for rule in self.rules}
+
+    def _evaluate_key(self, key: tuple) -> tuple:
+        values = dict(zip(self.fields, key))
+        violations = tuple(all(c.holds(values[c.field]) for c in rule.conditions) for rule in self.rules)
+        self._report(violations)
+        return violations
+
+    def check(self, command, e: dict) -> tuple:
+        """
+        per rule violation flags of a single JSON event produced by command
+        """
+        key = tuple(command if field == "command" else _event_value(e, field) for field in self.fields)
+        violations = self._check_key(key)
+        self._count(violations)
+        return violations
+
+    def check_batch(self, events: np.ndarray) -> np.ndarray:
+        """
+        [n_events, n_rules] violation flags of a structured array of binary events, `command` must be set
+        """
+        out = np.zeros((len(events), len(self.rules)), dtype=bool)
+        if not len(events):
+            return out
+        for i, rule in enumerate(self.rules):
+            mask = np.ones(len(events), dtype=bool)
+            for condition in rule.conditions:
+                mask &= condition.holds_batch(events)
+                if not mask.any():
+                    break
+            out[:, i] = mask
+        counts = out.sum(axis=0)
+        self._report([count and not self.violations[rule.name] for rule, count in zip(self.rules, counts)])
+        self._count(counts)
+        return out
+
+    def _count(self, violations) -> None:
+        for rule, count in zip(self.rules, violations):
+            self.violations[rule.name] += int(count)
+
+    def _report(self, violations) -> None:
+        for rule, violated in zip(self.rules, violations):
+            if violated:
+                print(f"[INVARIANT VIOLATION]: {rule.message}")
+
+    def cache_info(self):
+        return self._check_key.cache_info()
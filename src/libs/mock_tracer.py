@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+
+"""
+mock_tracer.py
+
+Stand-in for bench + GDB + QEMU + tracer that speaks the Cannoli wire protocol, so that the NAV side
+(CannoliStreamingClient, CannoliEnv, VectorCannoliEnv) can be exercised and load tested without UEFI_PATH.
+
+It connects to the /tmp/nav_<id> socket like the real tracer, accepts pickled action tuples as well as
+transaction frames (see transaction.py, acknowledged when asked for) and answers with POISON framed event batches, either produced by
+a scripted model of the cromulence demoone target or replayed from a recorded trace. Latency,
+fragmentation of the byte stream and corruption can be injected.
+
+    python -m libs.mock_tracer --nav-id 1234 --trace libs/sample_json/response-cromulence-demo1.json
+"""
+
+import io
+import json
+import os
+import pickle
+import random
+import socket
+import struct
+import threading
+import time
+import zlib
+from argparse import ArgumentParser
+
+from .bench import MonitorError
+from .cannoli_streaming_client import INIT_EVENT_COUNT
+from .event_schema import BINARY_SCHEMA, encode_events, events_from_dicts
+from .frame_decoder import POISON_BYTES
+from .transaction import TXN_ACK_FRAME, TXN_MAGIC, decode_transaction, encode_group
+
+TXN_MAGIC_BYTES = TXN_MAGIC.to_bytes(4, "little")
+END_OF_BATCH = POISON_BYTES + b"\0\0\0\0"
+
+EFI_SUCCESS = 0
+EFI_NOT_FOUND = 0x800000000000000E
+
+
+class CromulenceModel:
+    """
+    scripted model of the cromulence demoone commands (see gen_action_space_cromulence_demoone.py)
+    0: GetCrc(loc), 1: AllocatePool(), 2: GetAccessVariable(loc), 3: Demo1ValidateAccessKey(loc)
+    """
+
+    def __init__(self, key_addr: int = 0x6abf0c8, crc_magic1: int = 177334383, crc_magic2: int = 2114797893):
+        self.key_addr = key_addr
+        self.crc_magic1 = crc_magic1
+        self.crc_magic2 = crc_magic2
+
+    def __call__(self, action: tuple) -> list:
+        command, loc = action[0], action[1] if len(action) > 1 else None
+        event = {"req_crc": None, "valid_key": None, "crc_magic1": self.crc_magic1, "crc_magic2": self.crc_magic2,
+                 "return": None, "command": command}
+        if command == 0 and loc is not None:
+            event["req_crc"] = zlib.crc32(loc.to_bytes(8, "little"))
+            event["return"] = EFI_SUCCESS
+        elif command == 1:
+            event["return"] = EFI_SUCCESS
+        elif command == 2:
+            event["return"] = EFI_SUCCESS if loc == self.key_addr else EFI_NOT_FOUND
+        elif command == 3:
+            event["valid_key"] = int(loc == self.key_addr)
+            event["return"] = EFI_SUCCESS
+        return [event]
+
+
+class RecordedTrace:
+    """
+    replays recorded responses in order, cycling once the recording is exhausted. The file holds either a
+    list of batches (lists of events), a single batch or a single event
+    """
+
+    def __init__(self, path: str):
+        with open(path, "r") as file:
+            recording = json.load(file)
+        if isinstance(recording, dict):
+            recording = [[recording]]
+        elif recording and isinstance(recording[0], dict):
+            recording = [recording]
+        self.batches = recording
+        self.idx = 0
+
+    def __call__(self, action: tuple) -> list:
+        batch = self.batches[self.idx % len(self.batches)]
+        self.idx += 1
+        return batch
+
+
+class MockTracer:
+
+    def __init__(self, nav_id, responder=None, latency: float = 0.0, fragment: int = 0, corrupt: float = 0.0,
+                 event_schema=None, end_marker: bool = True, connect_timeout: float = 30.0, seed=None,
+                 init_batches: int = 0, transactions: bool = False):
+        """
+        responder: callable mapping an action tuple to a list of events, defaults to CromulenceModel
+        latency: seconds to wait before answering an action
+        fragment: if set, the response is written in random chunks of at most this many bytes
+        corrupt: probability of garbage bytes being written in front of an event frame
+        end_marker: send an empty frame after every batch
+        init_batches: number of (empty) batches of pre-main events sent on connect, like the target does before
+        NAV snapshots its initial state
+        transactions: acknowledge transactions on connect, like a tracer started with CANNOLI_TRANSACTIONS=1
+        """
+        self.path = "/tmp/nav_" + str(nav_id)
+        self.responder = responder or CromulenceModel()
+        self.latency = latency
+        self.fragment = fragment
+        self.corrupt = corrupt
+        self.binary = event_schema == BINARY_SCHEMA
+        self.end_marker = end_marker
+        self.connect_timeout = connect_timeout
+        self.init_batches = init_batches
+        self.transactions = transactions
+        self.random = random.Random(seed)
+        self.sock = None
+        self.steps = 0
+        self.stopped = threading.Event()
+
+    def connect(self):
+        # NAV might not be listening yet (or still have the socket of a previous episode bound)
+        deadline = time.monotonic() + self.connect_timeout
+        while True:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                self.sock.connect(self.path)
+                return
+            except (FileNotFoundError, ConnectionRefusedError):
+                self.sock.close()
+                if time.monotonic() > deadline or self.stopped.is_set():
+                    raise
+                time.sleep(0.01)
+
+    def _frames(self, events: list) -> bytes:
+        out = bytearray()
+        payloads = [encode_events(events_from_dicts(events))] if self.binary and events else \
+            [json.dumps(e).encode() for e in events]
+        for payload in payloads:
+            if self.corrupt and self.random.random() < self.corrupt:
+                out += bytes(self.random.randrange(256) for _ in range(self.random.randint(1, 16)))
+            out += POISON_BYTES + struct.pack("<I", len(payload)) + payload
+        return bytes(out)
+
+    def _send(self, data: bytes):
+        if not self.fragment:
+            self.sock.sendall(data)
+            return
+        pos = 0
+        while pos < len(data):
+            n = self.random.randint(1, self.fragment)
+            self.sock.sendall(data[pos:pos + n])
+            pos += n
+
+    def _respond(self, action: tuple) -> bytes:
+        if self.latency:
+            time.sleep(self.latency)
+        self.steps += 1
+        return self._frames(self.responder(action))
+
+    def _handle(self, buf: bytearray) -> int:
+        """
+        answers the first request in buf, returns the number of bytes consumed or 0 if it is incomplete
+        """
+        if buf[:4] == TXN_MAGIC_BYTES:
+            actions, n = decode_transaction(buf)
+            if actions is None:
+                return 0
+            self._send(b"".join(encode_group(seq, self._respond(action)) for seq, action in enumerate(actions)))
+            return n
+
+        stream = io.BytesIO(bytes(buf))
+        try:
+            action = pickle.Unpickler(stream).load()
+        except (EOFError, pickle.UnpicklingError, ValueError, IndexError):
+            return 0
+        n = stream.tell()
+        if n < len(buf) and buf[n:n + 1] == b"\n":
+            n += 1
+        data = self._respond(tuple(action))
+        self._send(data + END_OF_BATCH if self.end_marker else data)
+        return n
+
+    def serve(self):
+        self.connect()
+        buf = bytearray()
+        try:
+            if self.transactions:
+                self._send(TXN_ACK_FRAME)
+            for _ in range(self.init_batches):
+                self._send(END_OF_BATCH)
+            while not self.stopped.is_set():
+                b = self.sock.recv(4096)
+                if not b:
+                    break
+                buf += b
+                while buf:
+                    n = self._handle(buf)
+                    if not n:
+                        break
+                    del buf[:n]
+        except OSError:
+            pass
+        finally:
+            self.sock.close()
+
+    def stop(self):
+        self.stopped.set()
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class _MockProcess:
+    # stands in for the Popen of `bench run` in Bench.gdb
+    def __init__(self, tracer: MockTracer, thread: threading.Thread):
+        self.tracer = tracer
+        self.thread = thread
+
+    def poll(self):
+        return None if self.thread.is_alive() else 0
+
+    def kill(self):
+        self.tracer.stop()
+
+
+class _MockMonitor:
+    # stands in for the QemuMonitor of Bench, the scripted targets are stateless so snapshots only need names
+    def __init__(self):
+        self.tags = set()
+
+    def savevm(self, tag: str) -> None:
+        self.tags.add(tag)
+
+    def loadvm(self, tag: str) -> None:
+        if tag not in self.tags:
+            raise MonitorError(f"Error: snapshot {tag} does not exist")
+
+    def close(self):
+        pass
+
+
+class MockBench:
+    """
+    drop-in replacement for Bench that starts a MockTracer thread instead of edk2 under QEMU, pass it as
+    CannoliStreamingClient(bench=MockBench(...)) or CannoliEnv(bench=...)
+    """
+
+    def __init__(self, **tracer_kwargs):
+        self.tracer_kwargs = tracer_kwargs
+        self.gdb = None
+        self.monitor = None
+
+    def run(self, pid, event_schema=None, monitor_path=None, transactions=False):
+        self.kill()
+        tracer_kwargs = dict(self.tracer_kwargs)
+        tracer_kwargs.setdefault("transactions", transactions)
+        if monitor_path:
+            # snapshot resets flush the pre-main events before saving the initial state
+            tracer_kwargs.setdefault("init_batches", INIT_EVENT_COUNT)
+        tracer = MockTracer(pid, event_schema=event_schema, **tracer_kwargs)
+        thread = threading.Thread(target=tracer.serve, daemon=True)
+        thread.start()
+        self.gdb = _MockProcess(tracer, thread)
+        self.monitor = _MockMonitor() if monitor_path else None
+
+    def read_from_pipe(self):
+        pass
+
+    def kill(self):
+        if self.gdb and self.gdb.poll() is None:
+            self.gdb.kill()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--nav-id", required=True)
+    parser.add_argument("--trace", default=None, help="recorded responses (json), defaults to the scripted model")
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--fragment", type=int, default=0)
+    parser.add_argument("--corrupt", type=float, default=0.0)
+    parser.add_argument("--event-schema", default=os.environ.get("CANNOLI_EVENT_SCHEMA"))
+    parser.add_argument("--transactions", action="store_true",
+                        default=os.environ.get("CANNOLI_TRANSACTIONS") == "1")
+    parser.add_argument("--no-end-marker", action="store_true")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    mock = MockTracer(args.nav_id,
+                      responder=RecordedTrace(args.trace) if args.trace else None,
+                      latency=args.latency,
+                      fragment=args.fragment,
+                      corrupt=args.corrupt,
+                      event_schema=args.event_schema,
+                      end_marker=not args.no_end_marker,
+                      transactions=args.transactions,
+                      seed=args.seed)
+    mock.serve()
+    print(f"[*] mock tracer served {mock.steps} steps")
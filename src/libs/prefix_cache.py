@@ -0,0 +1,63 @@
+import itertools
+from collections import OrderedDict
+
+ROOT = 0
+
+
+class _Node:
+    __slots__ = ("id", "responses")
+
+    def __init__(self, node_id: int, responses):
+        self.id = node_id
+        self.responses = responses
+
+
+class PrefixCache:
+    """
+    Tree of the tracer responses seen for every action prefix of a deterministic target. A node is the
+    response to the last action of a prefix and is addressed by (parent node, action), starting from ROOT
+    at the beginning of an episode, so a lookup costs one dict access no matter how long the prefix is.
+
+    The tree is bounded to `max_entries` nodes, the least recently used node is evicted first. The subtree
+    below an evicted node can no longer be reached and is evicted in turn as it ages.
+    """
+
+    def __init__(self, max_entries: int = 1 << 16):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.ids = itertools.count(ROOT + 1)
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "replayed": 0, "replay_failures": 0}
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, parent: int, action: tuple):
+        """
+        node answering action after the prefix ending in parent, None on a miss
+        """
+        key = (parent, tuple(action))
+        node = self.entries.get(key)
+        if node is None:
+            self.stats["misses"] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return node
+
+    def put(self, parent: int, action: tuple, responses) -> int:
+        node = _Node(next(self.ids), responses)
+        self.entries[(parent, tuple(action))] = node
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+        return node.id
+
+    def hit_rate(self) -> float:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / lookups if lookups else 0.0
+
+    def metrics(self) -> dict:
+        out = {f"prefix_cache/{name}": float(value) for name, value in self.stats.items()}
+        out["prefix_cache/hit_rate"] = self.hit_rate()
+        out["prefix_cache/entries"] = float(len(self))
+        return out
@@ -0,0 +1,204 @@
+import threading
+
+from .bench import MonitorError
+
+# snapshot tags of the branch points of a schedule, node ids restart with every schedule so tags are reused
+NODE_TAG = "nav_node_{}"
+
+
+class _TrieNode:
+    __slots__ = ("id", "parent", "action", "children", "responses")
+
+    def __init__(self, node_id: int, parent, action):
+        self.id = node_id
+        self.parent = parent
+        self.action = action
+        self.children = {}
+        self.responses = None
+
+    def prefix(self) -> list:
+        actions = []
+        node = self
+        while node.parent is not None:
+            actions.append(node.action)
+            node = node.parent
+        return actions[::-1]
+
+
+class _Worker:
+    __slots__ = ("client", "live", "snapshots")
+
+    def __init__(self, client):
+        self.client = client
+        # trie node the tracer currently is at, None when unknown (never reset)
+        self.live = None
+        self.snapshots = set()
+
+
+class PrefixScheduler:
+    """
+    Executes a batch of planned episodes (action sequences) with every shared action prefix run only once.
+
+    The sequences are merged into a prefix tree whose unbranched chains are segments. Segments are handed
+    to the tracers in `clients` as soon as the segment above them is done, each segment is sent as a single
+    transaction. A tracer continues live from the end of the segment it just ran when possible. Otherwise it
+    forks the target state of the branch point it needs, by restoring the QEMU snapshot it saved there
+    (reset_mode snapshot) or by resetting and replaying the prefix in one transaction.
+
+    stats counts the actions sent to tracers ("executed", replays included) against the actions of the
+    sequences ("planned"), and the actions whose response batch came back empty ("empty").
+    """
+
+    def __init__(self, clients: list):
+        self.workers = [_Worker(client) for client in clients]
+        self.stats = {"planned": 0, "executed": 0, "replayed": 0, "restored": 0, "segments": 0, "empty": 0}
+        self.stats_lock = threading.Lock()
+
+    def _build(self, sequences: list):
+        self.nodes = [_TrieNode(0, None, None)]
+        leaves = []
+        for sequence in sequences:
+            node = self.nodes[0]
+            for action in sequence:
+                action = tuple(action)
+                child = node.children.get(action)
+                if child is None:
+                    child = _TrieNode(len(self.nodes), node, action)
+                    node.children[action] = child
+                    self.nodes.append(child)
+                node = child
+            leaves.append(node)
+        return leaves
+
+    @staticmethod
+    def _segment(first: _TrieNode) -> list:
+        # the chain below a branch point up to the next branch point or leaf
+        chain = [first]
+        while len(chain[-1].children) == 1:
+            chain.append(next(iter(chain[-1].children.values())))
+        return chain
+
+    def run(self, sequences: list) -> list:
+        """
+        returns one list of response batches per sequence, in sequence order
+        """
+        leaves = self._build(sequences)
+        self._count(planned=sum(len(sequence) for sequence in sequences))
+        for worker in self.workers:
+            # node ids and snapshot tags of the previous schedule mean nothing in this one
+            worker.live = None
+            worker.snapshots = set()
+
+        self.ready = [self._segment(child) for child in self.nodes[0].children.values()]
+        self.in_flight = 0
+        self.errors = []
+        self.cond = threading.Condition()
+        threads = [threading.Thread(target=self._work, args=(worker,), daemon=True) for worker in self.workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
+
+        out = []
+        for leaf in leaves:
+            batches = []
+            node = leaf
+            while node.parent is not None:
+                batches.append(node.responses if node.responses is not None else [])
+                node = node.parent
+            out.append(batches[::-1])
+        empty = sum(node.responses is None or not len(node.responses) for node in self.nodes[1:])
+        if empty:
+            print(f"[*] NAV: {empty} of {len(self.nodes) - 1} scheduled actions got no response")
+            self._count(empty=empty)
+        return out
+
+    def _count(self, **counts) -> None:
+        # the worker threads of a run update the stats concurrently
+        with self.stats_lock:
+            for key, n in counts.items():
+                self.stats[key] += n
+
+    def _take(self, worker: _Worker):
+        # prefer continuing live, then a branch point this tracer has a snapshot of, then anything
+        for preferred in (lambda s: s[0].parent.id == worker.live,
+                          lambda s: s[0].parent.id in worker.snapshots,
+                          lambda s: True):
+            for i, segment in enumerate(self.ready):
+                if preferred(segment):
+                    return self.ready.pop(i)
+        return None
+
+    def _work(self, worker: _Worker):
+        while True:
+            with self.cond:
+                while True:
+                    if self.errors:
+                        return
+                    segment = self._take(worker)
+                    if segment is not None:
+                        self.in_flight += 1
+                        break
+                    if not self.in_flight:
+                        return
+                    self.cond.wait()
+            try:
+                children = self._run_segment(worker, segment)
+            except BaseException as e:
+                children = []
+                self.errors.append(e)
+            with self.cond:
+                self.in_flight -= 1
+                self.ready.extend(children)
+                self.cond.notify_all()
+
+    def _run_segment(self, worker: _Worker, segment: list) -> list:
+        self._fork(worker, segment[0].parent)
+        actions = [node.action for node in segment]
+        batches = worker.client.try_transaction(actions)
+        for node, responses in zip(segment, batches):
+            node.responses = responses
+        self._count(executed=len(actions), segments=1)
+
+        end = segment[-1]
+        worker.live = end.id
+        if len(end.children) > 1 and self._save(worker, end):
+            worker.snapshots.add(end.id)
+        return [self._segment(child) for child in end.children.values()]
+
+    def _fork(self, worker: _Worker, node: _TrieNode) -> None:
+        if worker.live == node.id:
+            return
+        if node.id in worker.snapshots and self._restore(worker, node):
+            self._count(restored=1)
+        else:
+            worker.client.reset()
+            prefix = node.prefix()
+            if prefix:
+                worker.client.try_transaction(prefix)
+                self._count(replayed=len(prefix), executed=len(prefix))
+        worker.live = node.id
+
+    @staticmethod
+    def _save(worker: _Worker, node: _TrieNode) -> bool:
+        monitor = worker.client.bench.monitor
+        if monitor is None:
+            return False
+        try:
+            monitor.savevm(NODE_TAG.format(node.id))
+            return True
+        except (OSError, MonitorError) as e:
+            print("[*] NAV: failed to snapshot branch point, falling back to replays:", e)
+            return False
+
+    @staticmethod
+    def _restore(worker: _Worker, node: _TrieNode) -> bool:
+        try:
+            worker.client.restore_snapshot(NODE_TAG.format(node.id))
+            return True
+        except (OSError, MonitorError) as e:
+            print("[*] NAV: failed to restore branch point, replaying its prefix:", e)
+            worker.snapshots.discard(node.id)
+            return False
@@ -0,0 +1,216 @@
+import ast
+import csv
+import glob
+import json
+import multiprocessing as mp
+import os
+import queue
+import threading
+from multiprocessing.connection import wait
+
+import numpy as np
+
+from .event_schema import STATE_FIELDS
+from .instrumentation import PROFILER
+
+# column names of the human readable states written next to the actions of a reproducer
+STATE_KEYS = ["req_crc", "valid_key", "crc_magic1", "crc_magic2", "ret", "command", "invariant"]
+INVARIANT_COLUMN = STATE_FIELDS.index("invariant")
+
+
+class ReproducerSink:
+    """
+    Collects the top-quantile episodes of a training run as reproducers, written by a background thread to
+    root/epoch:<n>.csv, two rows per episode: its actions, then its states. submit() only enqueues, the
+    files of every epoch stay open and are flushed every `flush_interval` seconds and on close.
+    """
+
+    def __init__(self, root: str = "reproducibility_criteria", queue_size: int = 1024, flush_interval: float = 5.0):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.files = {}
+        self.stats = {"submitted": 0, "written": 0}
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, epoch: int, actions: list, states: np.ndarray) -> None:
+        """
+        actions: action tuples of the episode, states: [steps, 7] observation rows, copied as the env reuses them
+        """
+        with PROFILER.span("reproducer_submit"):
+            self.queue.put((epoch, list(actions), np.array(states, dtype=np.float32)))
+        self.stats["submitted"] += 1
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+
+    def _writer(self, epoch: int):
+        if epoch not in self.files:
+            file = open(os.path.join(self.root, f"epoch:{epoch}.csv"), "a", newline="")
+            self.files[epoch] = (file, csv.writer(file))
+        return self.files[epoch][1]
+
+    def _run(self) -> None:
+        try:
+            while True:
+                try:
+                    item = self.queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    self._flush()
+                    continue
+                if item is None:
+                    break
+                epoch, actions, states = item
+                writer = self._writer(epoch)
+                writer.writerow(actions)
+                writer.writerow([dict(zip(STATE_KEYS, row)) for row in states.astype(np.int64).tolist()])
+                self.stats["written"] += 1
+        finally:
+            self._flush()
+            for file, _ in self.files.values():
+                file.close()
+            self.files = {}
+
+    def _flush(self) -> None:
+        for file, _ in self.files.values():
+            file.flush()
+
+
+def load_reproducers(root: str = "reproducibility_criteria") -> list:
+    """
+    every reproducer written by ReproducerSink as {"epoch", "index", "actions", "hits"}, hits being the steps
+    whose state had the invariant flag set
+    """
+    out = []
+    for path in glob.glob(os.path.join(root, "epoch:*.csv")):
+        epoch = int(os.path.basename(path)[len("epoch:"):-len(".csv")])
+        with open(path, "r", newline="") as file:
+            rows = list(csv.reader(file))
+        for index in range(len(rows) // 2):
+            actions = [ast.literal_eval(action) for action in rows[2 * index]]
+            states = [ast.literal_eval(state) for state in rows[2 * index + 1]]
+            hits = [step for step, state in enumerate(states) if state.get("invariant")]
+            out.append({"epoch": epoch, "index": index, "actions": actions, "hits": hits})
+    return sorted(out, key=lambda r: (r["epoch"], r["index"]))
+
+
+def _replay(env, actions: list) -> list:
+    # the steps of the open loop replay of actions that hit an invariant
+    env.reset()
+    results = env.run_open_loop(actions)
+    return [step for step, (obs, _, _, _) in enumerate(results) if obs[step][INVARIANT_COLUMN]]
+
+
+def _replay_worker(remote, parent_remote, env_kwargs: dict):
+    """
+    owns a CannoliEnv (and its tracer) and replays the action sequences it is sent in open loop, answering
+    with the steps that hit an invariant
+    """
+    from .vector_env import serve_env
+
+    serve_env(remote, parent_remote, env_kwargs, {"replay": _replay})
+
+
+class ReplayVerifier:
+    """
+    Re-executes stored reproducers on `num_envs` envs, each in its own process with its own tracer, and
+    records whether every invariant hit is deterministic: a reproducer is reproduced when a replay hits
+    invariants at exactly the recorded steps, deterministic when all `repeats` replays agree.
+
+    env_kwargs are CannoliEnv arguments, as for VectorCannoliEnv. max_steps_episode must cover the longest
+    reproducer.
+    """
+
+    def __init__(self, env_kwargs: dict, num_envs: int = 2, start_method: str = None):
+        ctx = mp.get_context(start_method)
+        base_id = os.getpid()
+        self.remotes, self.processes = [], []
+        for i in range(num_envs):
+            remote, work_remote = ctx.Pipe()
+            worker_kwargs = dict(env_kwargs, nav_id=f"{base_id}_replay_{i}")
+            process = ctx.Process(target=_replay_worker, args=(work_remote, remote, worker_kwargs), daemon=True)
+            process.start()
+            work_remote.close()
+            self.remotes.append(remote)
+            self.processes.append(process)
+
+    def verify(self, reproducers: list, repeats: int = 2) -> list:
+        """
+        returns the reproducers with "observed" (hit steps of every replay), "reproduced" and "deterministic".
+        A replay whose worker died is observed as None, and fails
+        """
+        jobs = [(i, r["actions"]) for i, r in enumerate(reproducers) for _ in range(repeats)]
+        observed = [[] for _ in reproducers]
+        idle = list(self.remotes)
+        busy = {}
+        while jobs or busy:
+            if jobs and not idle and not busy:
+                raise RuntimeError(f"every replay worker died, {len(jobs)} replays were not run")
+            while jobs and idle:
+                remote = idle.pop()
+                i, actions = jobs.pop()
+                try:
+                    remote.send(("replay", actions))
+                except OSError:
+                    self._dead(remote)
+                    jobs.append((i, actions))
+                    continue
+                busy[remote] = i
+            for remote in wait(list(busy)):
+                i = busy.pop(remote)
+                try:
+                    observed[i].append(remote.recv())
+                except (EOFError, OSError):
+                    self._dead(remote)
+                    observed[i].append(None)
+                    continue
+                idle.append(remote)
+
+        out = []
+        for reproducer, replays in zip(reproducers, observed):
+            out.append(dict(reproducer, observed=replays,
+                            reproduced=any(hits == reproducer["hits"] for hits in replays),
+                            deterministic=all(hits == reproducer["hits"] for hits in replays)))
+        return out
+
+    def _dead(self, remote) -> None:
+        process = self.processes[self.remotes.index(remote)]
+        process.join(timeout=1.0)
+        print(f"[*] NAV: replay worker {process.name} died with exit code {process.exitcode}")
+
+    def close(self) -> None:
+        for remote, process in zip(self.remotes, self.processes):
+            if not process.is_alive():
+                continue
+            try:
+                remote.send(("close", None))
+            except OSError:
+                pass
+        for process in self.processes:
+            process.join()
+
+
+def verify_reproducers(root: str, env_kwargs: dict, num_envs: int = 2, repeats: int = 2) -> list:
+    """
+    replays every reproducer below root and writes the outcome to root/verification.jsonl
+    """
+    reproducers = load_reproducers(root)
+    if not reproducers:
+        return []
+    env_kwargs = dict(env_kwargs, max_steps_episode=max(len(r["actions"]) for r in reproducers))
+    verifier = ReplayVerifier(env_kwargs, num_envs=num_envs)
+    try:
+        results = verifier.verify(reproducers, repeats=repeats)
+    finally:
+        verifier.close()
+    with open(os.path.join(root, "verification.jsonl"), "w") as file:
+        for result in results:
+            file.write(json.dumps(result) + "\n")
+    return results
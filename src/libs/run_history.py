@@ -0,0 +1,159 @@
+import glob
+import os
+import sqlite3
+from urllib.parse import quote
+
+from .trace_writer import EVENT_COLUMNS, to_u64
+
+# Triage queries over the trace databases of past runs (see trace_writer.py for the schema). Every query
+# is a fixed parameterized statement, compiled once per connection by sqlite3's statement cache, and
+# is answered from an index:
+#
+#   episodes (run_id, epoch, episode)   UNIQUE constraint
+#   episodes (total_reward)             episodes_reward, top episodes
+#   episodes (total_reward) invariants  episodes_invariant_reward, partial index of episodes with a hit
+#   steps (command, param)              steps_action, episodes that used an action
+#   events (episode_id, step) invariant events_invariant, partial index of the events that hit an invariant
+
+RUNS = "SELECT id, executable, nav_id, started FROM runs ORDER BY id"
+
+LATEST_RUN = "SELECT id, executable, nav_id, started FROM runs ORDER BY id DESC LIMIT 1"
+
+EPISODES = """
+SELECT id, run_id, epoch, episode, total_reward, steps, invariants FROM episodes
+WHERE run_id = ? ORDER BY epoch, episode
+"""
+
+INVARIANT_EPISODES = """
+SELECT id, run_id, epoch, episode, total_reward, steps, invariants FROM episodes INDEXED BY episodes_invariant_reward
+WHERE invariants > 0 AND total_reward > ? ORDER BY total_reward DESC LIMIT ?
+"""
+
+TOP_EPISODES = """
+SELECT id, run_id, epoch, episode, total_reward, steps, invariants FROM episodes INDEXED BY episodes_reward
+WHERE total_reward IS NOT NULL ORDER BY total_reward DESC LIMIT ?
+"""
+
+ACTION_EPISODES = """
+SELECT DISTINCT episode_id FROM steps INDEXED BY steps_action WHERE command = ? AND param IS ?
+"""
+
+INVARIANT_ACTIONS = """
+SELECT s.command, s.param, COUNT(*) AS hits FROM events AS e INDEXED BY events_invariant
+JOIN steps AS s ON s.episode_id = e.episode_id AND s.step = e.step
+WHERE e.invariant = 1 GROUP BY s.command, s.param
+"""
+
+EPISODE_STEPS = """
+SELECT step, command, param, total_reward, incremental_reward FROM steps WHERE episode_id = ? ORDER BY step
+"""
+
+EPISODE_EVENTS = f"""
+SELECT step, seq, {', '.join(f'"{c}"' for c in EVENT_COLUMNS)}, command, invariant FROM events
+WHERE episode_id = ? ORDER BY step, seq
+"""
+
+EPISODE_COLUMNS = ["id", "run_id", "epoch", "episode", "total_reward", "steps", "invariants"]
+RUN_COLUMNS = ["id", "executable", "nav_id", "started"]
+HISTORY_GLOB = "previous_runs/*/*.db"
+
+
+class RunHistory:
+    """
+    Read side of one or more trace databases, e.g. every iteration below previous_runs/
+
+        history = RunHistory.discover()
+        for hit in history.invariant_episodes(min_reward=100):
+            steps = history.episode_steps(hit)
+
+    Rows are dicts. Episode rows carry the database they come from under "db", so they can be passed back
+    to episode_steps / episode_events.
+    """
+
+    def __init__(self, paths: list):
+        self.paths = list(paths)
+        # read-only, so reading a database never changes its schema or journal mode under a running writer
+        self.cons = {path: sqlite3.connect(f"file:{quote(path)}?mode=ro", uri=True, timeout=30.0,
+                                           check_same_thread=False) for path in self.paths}
+
+    @classmethod
+    def discover(cls, pattern: str = HISTORY_GLOB) -> "RunHistory":
+        return cls(sorted(glob.glob(pattern), key=os.path.getmtime))
+
+    def close(self) -> None:
+        for con in self.cons.values():
+            con.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def _rows(self, path: str, sql: str, params: tuple, columns: list) -> list:
+        return [dict(zip(columns, row), db=path) for row in self.cons[path].execute(sql, params)]
+
+    def runs(self) -> list:
+        return [row for path in self.paths for row in self._rows(path, RUNS, (), RUN_COLUMNS)]
+
+    def latest_run(self) -> dict:
+        """
+        latest run of the most recently written database
+        """
+        for path in reversed(self.paths):
+            rows = self._rows(path, LATEST_RUN, (), RUN_COLUMNS)
+            if rows:
+                return rows[0]
+        return None
+
+    def episodes(self, run: dict) -> list:
+        return self._rows(run["db"], EPISODES, (run["id"],), EPISODE_COLUMNS)
+
+    def invariant_episodes(self, min_reward: float = float("-inf"), limit: int = 100) -> list:
+        """
+        episodes that hit an invariant with a total reward above min_reward, best first
+        """
+        rows = [row for path in self.paths
+                for row in self._rows(path, INVARIANT_EPISODES, (min_reward, limit), EPISODE_COLUMNS)]
+        return sorted(rows, key=lambda row: row["total_reward"], reverse=True)[:limit]
+
+    def top_episodes(self, limit: int = 10) -> list:
+        rows = [row for path in self.paths for row in self._rows(path, TOP_EPISODES, (limit,), EPISODE_COLUMNS)]
+        return sorted(rows, key=lambda row: row["total_reward"], reverse=True)[:limit]
+
+    def action_episodes(self, action: tuple) -> list:
+        """
+        (db, episode id) of every episode that used action
+        """
+        param = action[1] if len(action) > 1 else None
+        return [(path, row[0]) for path in self.paths
+                for row in self.cons[path].execute(ACTION_EPISODES, (action[0], param))]
+
+    def invariant_actions(self, limit: int = 20) -> list:
+        """
+        actions of the steps that hit an invariant, most frequent first
+        """
+        counts = {}
+        for path in self.paths:
+            for command, param, hits in self.cons[path].execute(INVARIANT_ACTIONS):
+                counts[(command, param)] = counts.get((command, param), 0) + hits
+        return sorted(counts.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+    def episode_steps(self, episode: dict) -> list:
+        return self._rows(episode["db"], EPISODE_STEPS, (episode["id"],),
+                          ["step", "command", "param", "total_reward", "incremental_reward"])
+
+    def episode_events(self, episode: dict) -> list:
+        """
+        events of an episode as JSON compatible dicts, u64 fields converted back from their signed storage
+        """
+        out = []
+        for row in self.cons[episode["db"]].execute(EPISODE_EVENTS, (episode["id"],)):
+            event = dict(zip(["step", "seq"] + EVENT_COLUMNS + ["command", "invariants"], row))
+            for field in EVENT_COLUMNS:
+                if field != "heap_entropy":
+                    event[field] = to_u64(event[field])
+            event["invariants"] = bool(event["invariants"])
+            out.append(event)
+        return out
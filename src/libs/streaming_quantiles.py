@@ -0,0 +1,77 @@
+import numpy as np
+
+# Quantiles of a stream of episode returns that follow the policy as it improves. Every update scales the
+# weight of the values seen before by `decay`, so the estimate covers roughly the last 1 / (1 - decay) values
+# instead of the whole run. Values are kept as weighted centroids, at most ~2 * max_centroids of them, merged
+# along an arcsine scale that keeps them finest at both tails where the risk-seeking thresholds sit. A sketch
+# is a list of centroids, so the sketches of several processes merge into the sketch of all their values.
+
+
+class DecayedQuantiles:
+
+    def __init__(self, decay: float = 0.999, max_centroids: int = 128):
+        if not 0 < decay <= 1:
+            raise ValueError(f"decay must be in (0, 1], got {decay}")
+        self.decay = decay
+        self.max_centroids = max_centroids
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+
+    def update(self, value: float, weight: float = 1.0) -> None:
+        self.weights *= self.decay
+        i = int(np.searchsorted(self.means, value))
+        self.means = np.insert(self.means, i, float(value))
+        self.weights = np.insert(self.weights, i, float(weight))
+        if len(self.means) > 2 * self.max_centroids:
+            self._compress()
+
+    def merge(self, other: "DecayedQuantiles") -> "DecayedQuantiles":
+        """
+        sketch of the values of both, neither is modified
+        """
+        return DecayedQuantiles.from_centroids(np.concatenate([self.means, other.means]),
+                                               np.concatenate([self.weights, other.weights]),
+                                               decay=self.decay, max_centroids=self.max_centroids)
+
+    @classmethod
+    def from_centroids(cls, means, weights, decay: float = 0.999, max_centroids: int = 128) -> "DecayedQuantiles":
+        sketch = cls(decay=decay, max_centroids=max_centroids)
+        means, weights = np.asarray(means, dtype=np.float64), np.asarray(weights, dtype=np.float64)
+        order = np.argsort(means[weights > 0], kind="stable")
+        sketch.means, sketch.weights = means[weights > 0][order], weights[weights > 0][order]
+        if len(sketch.means) > 2 * max_centroids:
+            sketch._compress()
+        return sketch
+
+    def centroids(self, size: int = None) -> np.ndarray:
+        """
+        [n, 2] (mean, weight) rows, zero-weight padded to `size` rows for fixed-shape exchanges
+        """
+        rows = np.stack([self.means, self.weights], axis=-1)
+        if size is not None:
+            rows = np.concatenate([rows, np.zeros((size - len(rows), 2))])
+        return rows
+
+    def quantile(self, q: float) -> float:
+        """
+        value below which a fraction q of the weight lies, nan before the first update
+        """
+        if not len(self.means):
+            return float("nan")
+        # every centroid's weight is centred on its mean
+        cumulative = np.cumsum(self.weights) - self.weights / 2
+        return float(np.interp(q * self.weights.sum(), cumulative, self.means))
+
+    def total_weight(self) -> float:
+        return float(self.weights.sum())
+
+    def __len__(self) -> int:
+        return len(self.means)
+
+    def _compress(self) -> None:
+        q = (np.cumsum(self.weights) - self.weights / 2) / self.weights.sum()
+        bucket = np.floor(self.max_centroids * (np.arcsin(2 * q - 1) / np.pi + 0.5)).astype(np.int64)
+        _, bucket = np.unique(bucket, return_inverse=True)
+        weights = np.bincount(bucket, weights=self.weights)
+        self.means = np.bincount(bucket, weights=self.means * self.weights) / weights
+        self.weights = weights
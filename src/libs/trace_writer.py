@@ -0,0 +1,261 @@
+import queue
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from .event_schema import EVENT_DTYPE, events_from_dicts
+from .instrumentation import PROFILER
+
+# One normalized schema shared by every env writing to the database (WAL mode, so parallel envs and
+# readers do not block each other).
+#
+#   runs      one row per CannoliEnv
+#   episodes  (run, epoch, episode) with the episode's total reward once it ended and its invariant hits
+#   steps     action and rewards of every step, keyed by (episode_id, step)
+#   events    typed columns of every event of a step, keyed by (episode_id, step, seq)
+#
+# SQLite integers are signed, u64 event fields are stored as their two's complement (see to_u64).
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    executable TEXT,
+    nav_id TEXT,
+    started REAL
+);
+CREATE TABLE IF NOT EXISTS episodes (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    epoch INTEGER NOT NULL,
+    episode INTEGER NOT NULL,
+    total_reward REAL,
+    steps INTEGER,
+    invariants INTEGER NOT NULL DEFAULT 0,
+    ended REAL,
+    UNIQUE (run_id, epoch, episode)
+);
+CREATE TABLE IF NOT EXISTS steps (
+    episode_id INTEGER NOT NULL REFERENCES episodes(id),
+    step INTEGER NOT NULL,
+    command INTEGER,
+    param INTEGER,
+    total_reward REAL,
+    incremental_reward REAL,
+    PRIMARY KEY (episode_id, step)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS events (
+    episode_id INTEGER NOT NULL,
+    step INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    req_crc INTEGER,
+    valid_key INTEGER,
+    crc_magic1 INTEGER,
+    crc_magic2 INTEGER,
+    return INTEGER,
+    heap_start INTEGER,
+    heap_end INTEGER,
+    heap_entropy REAL,
+    command INTEGER,
+    invariant INTEGER,
+    PRIMARY KEY (episode_id, step, seq)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS episodes_reward ON episodes(total_reward);
+CREATE INDEX IF NOT EXISTS episodes_invariant_reward ON episodes(total_reward) WHERE invariants > 0;
+CREATE INDEX IF NOT EXISTS steps_action ON steps(command, param);
+CREATE INDEX IF NOT EXISTS events_invariant ON events(episode_id, step) WHERE invariant = 1;
+"""
+
+# event columns in table order, absent fields are NULL
+EVENT_COLUMNS = ["req_crc", "valid_key", "crc_magic1", "crc_magic2", "return", "heap_start", "heap_end",
+                 "heap_entropy"]
+_INSERT_EVENT = f"INSERT OR REPLACE INTO events VALUES ({', '.join(['?'] * (len(EVENT_COLUMNS) + 5))})"
+_INSERT_STEP = "INSERT OR REPLACE INTO steps VALUES (?, ?, ?, ?, ?, ?)"
+
+_STEP, _END_EPISODE, _FLUSH, _CLOSE = range(4)
+
+
+def to_u64(value):
+    """
+    inverse of the signed storage of u64 event fields
+    """
+    return None if value is None else value & 0xFFFFFFFFFFFFFFFF
+
+
+def connect(db_path: str, timeout: float = 30.0) -> sqlite3.Connection:
+    con = sqlite3.connect(db_path, timeout=timeout, check_same_thread=False)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.executescript(SCHEMA)
+    return con
+
+
+def _event_rows(episode_id: int, step: int, events) -> list:
+    if not isinstance(events, np.ndarray):
+        events = events_from_dicts(events) if events else np.zeros(0, dtype=EVENT_DTYPE)
+    if not len(events):
+        return []
+    columns = []
+    for i, field in enumerate(EVENT_COLUMNS):
+        column = events[field] if field == "heap_entropy" else events[field].view("<i8")
+        present = (events["present"] & (1 << i)) != 0
+        columns.append([v if p else None for v, p in zip(column.tolist(), present.tolist())])
+    return [(episode_id, step, seq) + row for seq, row in
+            enumerate(zip(*columns, events["command"].tolist(), events["invariant"].tolist()))]
+
+
+class TraceWriter:
+    """
+    Writes the steps of a CannoliEnv from a background thread so that the database is off the rollout path.
+
+    Producers only enqueue (log_step / end_episode) on a bounded queue. The writer thread groups
+    rows and commits once `batch_size` steps are pending or `flush_interval` seconds passed since the last
+    commit. When the queue is full the producer blocks (block=True) or the step is dropped; either is
+    counted in `stats`, together with the time spent blocked and the highest queue depth seen:
+    the backpressure of the database on the rollout. A batch that fails to be written is rolled back and
+    counted as failed, the writer keeps going so that producers never wait on a dead thread.
+    """
+
+    def __init__(self, db_path: str, executable: str = None, nav_id=None, queue_size: int = 4096,
+                 batch_size: int = 256, flush_interval: float = 1.0, block: bool = True):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.block = block
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stats = {"enqueued": 0, "dropped": 0, "blocked": 0, "blocked_s": 0.0, "max_depth": 0,
+                      "written": 0, "events": 0, "commits": 0, "failed": 0}
+
+        # the run row is created synchronously so that its id is known to the caller
+        self.con = connect(db_path)
+        with self.con:
+            self.run_id = self.con.execute("INSERT INTO runs (executable, nav_id, started) VALUES (?, ?, ?)",
+                                           (executable, None if nav_id is None else str(nav_id),
+                                            time.time())).lastrowid
+        self.episode_ids = {}
+        self.closed = False
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _put(self, item) -> bool:
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            if not self.block:
+                self.stats["dropped"] += 1
+                return False
+            start = time.perf_counter()
+            with PROFILER.span("trace_enqueue"):
+                self.queue.put(item)
+            self.stats["blocked"] += 1
+            self.stats["blocked_s"] += time.perf_counter() - start
+        self.stats["enqueued"] += 1
+        depth = self.queue.qsize()
+        if depth > self.stats["max_depth"]:
+            self.stats["max_depth"] = depth
+        return True
+
+    def log_step(self, epoch: int, episode: int, step: int, command, param, total_reward: float,
+                 incremental_reward: float, events) -> bool:
+        """
+        events: list of JSON events or structured array of EVENT_DTYPE. Returns False if the step was dropped
+        """
+        return self._put((_STEP, (epoch, episode, step, command, param, float(total_reward),
+                                  float(incremental_reward), events)))
+
+    def end_episode(self, epoch: int, episode: int, total_reward: float, steps: int) -> None:
+        # never dropped, it only updates a row
+        self.queue.put((_END_EPISODE, (epoch, episode, float(total_reward), steps, time.time())))
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        blocks until everything enqueued so far is committed
+        """
+        done = threading.Event()
+        self.queue.put((_FLUSH, done))
+        return done.wait(timeout)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put((_CLOSE, None))
+        self.thread.join()
+        self.con.close()
+
+    def _episode_id(self, epoch: int, episode: int) -> int:
+        key = (epoch, episode)
+        episode_id = self.episode_ids.get(key)
+        if episode_id is None:
+            self.con.execute("INSERT OR IGNORE INTO episodes (run_id, epoch, episode) VALUES (?, ?, ?)",
+                             (self.run_id, epoch, episode))
+            episode_id = self.con.execute("SELECT id FROM episodes WHERE run_id = ? AND epoch = ? AND episode = ?",
+                                          (self.run_id, epoch, episode)).fetchone()[0]
+            self.episode_ids[key] = episode_id
+        return episode_id
+
+    def _write(self, steps: list, ends: list) -> None:
+        step_rows, event_rows, hits = [], [], {}
+        for epoch, episode, step, command, param, total_reward, incremental_reward, events in steps:
+            episode_id = self._episode_id(epoch, episode)
+            step_rows.append((episode_id, step, command, param, total_reward, incremental_reward))
+            rows = _event_rows(episode_id, step, events)
+            n_hits = sum(row[-1] for row in rows)
+            if n_hits:
+                hits[episode_id] = hits.get(episode_id, 0) + n_hits
+            event_rows.extend(rows)
+        if step_rows:
+            self.con.executemany(_INSERT_STEP, step_rows)
+            self.con.executemany(_INSERT_EVENT, event_rows)
+            self.con.executemany("UPDATE episodes SET invariants = invariants + ? WHERE id = ?",
+                                 [(n, episode_id) for episode_id, n in hits.items()])
+        for epoch, episode, total_reward, n_steps, ended in ends:
+            self.con.execute("UPDATE episodes SET total_reward = ?, steps = ?, ended = ? WHERE id = ?",
+                             (total_reward, n_steps, ended, self._episode_id(epoch, episode)))
+        self.con.commit()
+        self.stats["written"] += len(step_rows)
+        self.stats["events"] += len(event_rows)
+        self.stats["commits"] += 1
+
+    def _run(self) -> None:
+        steps, ends, waiters = [], [], []
+        last_commit = time.monotonic()
+        running = True
+        while running:
+            timeout = max(0.0, last_commit + self.flush_interval - time.monotonic())
+            try:
+                kind, item = self.queue.get(timeout=timeout if steps or ends else None)
+                if kind == _STEP:
+                    steps.append(item)
+                elif kind == _END_EPISODE:
+                    ends.append(item)
+                elif kind == _FLUSH:
+                    waiters.append(item)
+                else:
+                    running = False
+            except queue.Empty:
+                pass
+
+            due = time.monotonic() - last_commit >= self.flush_interval
+            if len(steps) >= self.batch_size or waiters or not running or ((steps or ends) and due):
+                if steps or ends:
+                    known = len(self.episode_ids)
+                    try:
+                        with PROFILER.span("db_commit"):
+                            self._write(steps, ends)
+                    except Exception as e:
+                        # a database error or a malformed event, only this batch is lost
+                        print("[*] NAV: failed to write trace:", repr(e))
+                        self.con.rollback()
+                        self.stats["failed"] += len(steps)
+                        # the rollback took back the episode rows inserted by this batch
+                        for key in list(self.episode_ids)[known:]:
+                            del self.episode_ids[key]
+                    steps, ends = [], []
+                last_commit = time.monotonic()
+                for waiter in waiters:
+                    waiter.set()
+                waiters = []
@@ -0,0 +1,193 @@
+import copy
+import itertools
+import os
+import queue
+import select
+import socket
+import threading
+import time
+
+from .bench import Bench
+from .transaction import read_ack
+
+
+class TracerInstance:
+    """
+    a booted bench/QEMU tracer together with the NAV side of its socket
+    """
+
+    def __init__(self, nav_id, bench: Bench, sock: socket.socket, conn: socket.socket, path: str,
+                 transactions: bool = False, pending: bytes = b""):
+        self.nav_id = nav_id
+        self.bench = bench
+        self.sock = sock
+        self.conn = conn
+        self.path = path
+        # whether the tracer acknowledged transactions, and what it sent in place of the acknowledgement
+        self.transactions = transactions
+        self.pending = pending
+        self.started = time.monotonic()
+
+    def age(self) -> float:
+        return time.monotonic() - self.started
+
+    def healthy(self) -> bool:
+        # the tracer process must still run and the socket must not have been closed by the tracer
+        if self.bench.gdb is not None and self.bench.gdb.poll() is not None:
+            return False
+        try:
+            readable, _, _ = select.select([self.conn], [], [], 0)
+            if readable and self.conn.recv(1, socket.MSG_PEEK) == b'':
+                return False
+        except (OSError, ValueError):
+            return False
+        return True
+
+    def kill(self):
+        self.bench.kill()
+        for s in (self.conn, self.sock):
+            try:
+                s.close()
+            except OSError:
+                pass
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class TracerPool:
+    """
+    Keeps `size` spare bench/QEMU instances booted and connected in the background so that a reset
+    only has to hand over a ready connection instead of waiting for bench to boot.
+
+    Spares are health checked every `health_check_interval` seconds and retired once they are older than
+    `max_lifetime` seconds (None keeps them forever). A replacement starts booting as soon as a spare is
+    acquired or retired. Configured through the `tracer_pool` section of the target YAML.
+
+    Every spare runs on a copy of `bench` when given (e.g. mock_tracer.MockBench), on a Bench in bench_dir
+    otherwise. With `monitor` spares expose their QEMU monitor, for snapshot resets. With `transactions` spares
+    are asked for transactions and their answer is read while they boot.
+    """
+
+    def __init__(self, base_id, size: int = 2, health_check_interval: float = 5.0, max_lifetime: float = None,
+                 boot_timeout: float = 120.0, bench_dir=None, event_schema=None, bench=None,
+                 monitor: bool = False, transactions: bool = False):
+        self.base_id = base_id
+        self.size = size
+        self.health_check_interval = health_check_interval
+        self.max_lifetime = max_lifetime
+        self.boot_timeout = boot_timeout
+        self.bench_dir = bench_dir
+        self.event_schema = event_schema
+        self.bench = bench
+        self.monitor_spares = monitor
+        self.transactions = transactions
+
+        self.ready = queue.Queue()
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+        self.booting = 0
+        self.closed = threading.Event()
+
+        # updated by the boot and health check threads as well as acquire(), under lock
+        self.stats = {"booted": 0, "failed": 0, "retired": 0, "acquired": 0, "waited": 0.0}
+
+        for _ in range(self.size):
+            self._boot_async()
+        self.monitor = threading.Thread(target=self._maintain, daemon=True)
+        self.monitor.start()
+
+    def _boot_async(self):
+        with self.lock:
+            self.booting += 1
+        threading.Thread(target=self._boot, daemon=True).start()
+
+    def _boot(self):
+        nav_id = f"{self.base_id}_{next(self.ids)}"
+        path = "/tmp/nav_" + nav_id
+        bench = copy.copy(self.bench) if self.bench is not None else Bench(bench_dir=self.bench_dir)
+        monitor_path = path + ".monitor" if self.monitor_spares else None
+        sock = None
+        try:
+            if os.path.exists(path):
+                os.unlink(path)
+            # listen before spawning so that the tracer can connect as soon as it is up
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(path)
+            sock.listen(1)
+            sock.settimeout(self.boot_timeout)
+            bench.run(nav_id, event_schema=self.event_schema, monitor_path=monitor_path,
+                      transactions=self.transactions)
+            conn, _ = sock.accept()
+            conn.settimeout(30)
+            acknowledged, pending = read_ack(conn) if self.transactions else (False, b"")
+            # every spare runs the same build, later ones are not asked again
+            self.transactions = self.transactions and acknowledged
+        except OSError as e:
+            print(f"[*] NAV: failed to boot spare tracer {nav_id}:", e)
+            bench.kill()
+            if sock is not None:
+                sock.close()
+            with self.lock:
+                self.booting -= 1
+                self.stats["failed"] += 1
+            if not self.closed.is_set():
+                # back off before trying again so that a broken setup does not spin
+                time.sleep(self.health_check_interval)
+                self._boot_async()
+            return
+
+        instance = TracerInstance(nav_id, bench, sock, conn, path, transactions=acknowledged, pending=pending)
+        with self.lock:
+            self.booting -= 1
+            self.stats["booted"] += 1
+        if self.closed.is_set():
+            instance.kill()
+            return
+        print("[*] NAV: spare tracer ready on " + path)
+        self.ready.put(instance)
+
+    def _maintain(self):
+        while not self.closed.wait(self.health_check_interval):
+            spares = []
+            while True:
+                try:
+                    spares.append(self.ready.get_nowait())
+                except queue.Empty:
+                    break
+            for instance in spares:
+                expired = self.max_lifetime is not None and instance.age() > self.max_lifetime
+                if expired or not instance.healthy():
+                    instance.kill()
+                    with self.lock:
+                        self.stats["retired"] += 1
+                    self._boot_async()
+                else:
+                    self.ready.put(instance)
+
+    def acquire(self) -> TracerInstance:
+        """
+        hands over a ready tracer, blocking only if every spare is still booting, and starts booting
+        its replacement
+        """
+        start = time.monotonic()
+        while True:
+            instance = self.ready.get()
+            if instance.healthy():
+                break
+            instance.kill()
+            with self.lock:
+                self.stats["retired"] += 1
+            self._boot_async()
+        with self.lock:
+            self.stats["acquired"] += 1
+            self.stats["waited"] += time.monotonic() - start
+        self._boot_async()
+        return instance
+
+    def close(self):
+        self.closed.set()
+        while True:
+            try:
+                self.ready.get_nowait().kill()
+            except queue.Empty:
+                break
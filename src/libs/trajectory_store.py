@@ -0,0 +1,224 @@
+import glob
+import json
+import os
+
+import numpy as np
+
+from .event_schema import STATE_FIELDS
+
+# Append-only columnar store of rollout steps for post-run analysis and offline training.
+#
+# root/
+#   <stream>/                 one stream per writer (env), e.g. its nav id
+#     manifest.json           {"chunks": [{"name": "chunk_000000", "rows": n}, ...]}
+#     chunk_000000/<column>.npy
+#     chunk_000001/<column>.npy
+#
+# Chunks are immutable once listed in the manifest, the manifest is replaced atomically after a chunk is
+# written so readers never see a partial chunk. Every column is a plain .npy file that is memory-mapped
+# by the reader, so slicing and filtering millions of steps only pages in the chunks that are touched.
+
+COLUMNS = {
+    "epoch": ("<i4", ()),
+    "episode": ("<i4", ()),
+    "step": ("<i4", ()),
+    "action": ("<i4", ()),          # index into the action space, -1 if the action is not part of it
+    "command": ("<i8", ()),
+    "param": ("<i8", ()),           # -1 for actions without a parameter
+    "state": ("<f4", (len(STATE_FIELDS),)),
+    "reward": ("<f4", ()),
+    "total_reward": ("<f4", ()),
+    "invariant": ("u1", ()),
+}
+
+CHUNK_ROWS = 1 << 16
+MANIFEST = "manifest.json"
+
+
+class TrajectoryWriter:
+    """
+    buffers steps in preallocated column arrays and writes them out as a chunk every `chunk_rows` steps
+    (and on flush / close)
+    """
+
+    def __init__(self, root: str, stream, chunk_rows: int = CHUNK_ROWS):
+        self.path = os.path.join(root, str(stream))
+        os.makedirs(self.path, exist_ok=True)
+        self.chunk_rows = chunk_rows
+        self.manifest = _read_manifest(self.path)
+        self.buffers = {name: np.zeros((chunk_rows,) + shape, dtype=dtype) for name, (dtype, shape) in COLUMNS.items()}
+        self.rows = 0
+
+    def append(self, epoch: int, episode: int, step: int, action: int, command: int, param, state, reward: float,
+               total_reward: float, invariant: bool) -> None:
+        i = self.rows
+        b = self.buffers
+        b["epoch"][i] = epoch
+        b["episode"][i] = episode
+        b["step"][i] = step
+        b["action"][i] = action
+        b["command"][i] = command
+        b["param"][i] = -1 if param is None else param
+        b["state"][i] = state
+        b["reward"][i] = reward
+        b["total_reward"][i] = total_reward
+        b["invariant"][i] = invariant
+        self.rows += 1
+        if self.rows == self.chunk_rows:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.rows:
+            return
+        name = f"chunk_{len(self.manifest['chunks']):06d}"
+        chunk_dir = os.path.join(self.path, name)
+        os.makedirs(chunk_dir, exist_ok=True)
+        for column, buffer in self.buffers.items():
+            np.save(os.path.join(chunk_dir, column + ".npy"), buffer[:self.rows])
+        self.manifest["chunks"].append({"name": name, "rows": self.rows})
+        _write_manifest(self.path, self.manifest)
+        self.rows = 0
+
+    def close(self) -> None:
+        self.flush()
+
+
+def _read_manifest(path: str) -> dict:
+    try:
+        with open(os.path.join(path, MANIFEST), "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {"chunks": []}
+
+
+def _write_manifest(path: str, manifest: dict) -> None:
+    tmp = os.path.join(path, MANIFEST + ".tmp")
+    with open(tmp, "w") as file:
+        json.dump(manifest, file)
+    os.replace(tmp, os.path.join(path, MANIFEST))
+
+
+class ChunkedColumn:
+    """
+    a column spread over memory-mapped chunks, indexed like a single array. Only the chunks an index touches
+    are read
+    """
+
+    def __init__(self, chunks: list, dtype, shape: tuple):
+        self.chunks = chunks
+        self.dtype = np.dtype(dtype)
+        self.shape = shape
+        self.offsets = np.cumsum([0] + [len(c) for c in chunks])
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1])
+
+    def __array__(self, dtype=None, copy=None):
+        out = np.concatenate(self.chunks) if self.chunks else np.zeros((0,) + self.shape, dtype=self.dtype)
+        return out if dtype is None else out.astype(dtype)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            idx = int(idx) + len(self) if idx < 0 else int(idx)
+            if not 0 <= idx < len(self):
+                raise IndexError(idx)
+            chunk = int(np.searchsorted(self.offsets, idx, side="right")) - 1
+            return self.chunks[chunk][idx - self.offsets[chunk]]
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            if step == 1:
+                return self._range(start, stop)
+            idx = np.arange(start, stop, step)
+        idx = np.asarray(idx)
+        if idx.dtype == bool:
+            idx = np.flatnonzero(idx)
+        return self._take(idx)
+
+    def _range(self, start: int, stop: int) -> np.ndarray:
+        parts = []
+        first = max(int(np.searchsorted(self.offsets, start, side="right")) - 1, 0)
+        for chunk in range(first, len(self.chunks)):
+            lo, hi = self.offsets[chunk], self.offsets[chunk + 1]
+            if lo >= stop:
+                break
+            parts.append(self.chunks[chunk][max(start - lo, 0):min(stop, hi) - lo])
+        return np.concatenate(parts) if parts else np.zeros((0,) + self.shape, dtype=self.dtype)
+
+    def _take(self, idx: np.ndarray) -> np.ndarray:
+        idx = np.where(idx < 0, idx + len(self), idx)
+        out = np.empty((len(idx),) + self.shape, dtype=self.dtype)
+        chunk_of = np.searchsorted(self.offsets, idx, side="right") - 1
+        for chunk in np.unique(chunk_of):
+            at = chunk_of == chunk
+            out[at] = self.chunks[chunk][idx[at] - self.offsets[chunk]]
+        return out
+
+
+class TrajectoryStore:
+    """
+    Read side of the store. Opens every stream below root, columns are accessed as ChunkedColumns
+
+        store = TrajectoryStore("previous_runs/iteration_0/trajectories")
+        rewards = store["reward"][-10000:]
+        hits = store.select(lambda c: c["invariant"] == 1, columns=["epoch", "episode", "action"])
+
+    Chunks written after the store was opened are picked up by refresh().
+    """
+
+    def __init__(self, root: str, streams: list = None):
+        self.root = root
+        self.streams = streams
+        self.refresh()
+
+    def refresh(self) -> None:
+        self.chunk_dirs = []
+        manifests = sorted(glob.glob(os.path.join(self.root, "*", MANIFEST)))
+        for manifest_path in manifests:
+            path = os.path.dirname(manifest_path)
+            if self.streams is not None and os.path.basename(path) not in map(str, self.streams):
+                continue
+            for chunk in _read_manifest(path)["chunks"]:
+                self.chunk_dirs.append((os.path.basename(path), os.path.join(path, chunk["name"]), chunk["rows"]))
+        self._columns = {}
+
+    def __len__(self) -> int:
+        return sum(rows for _, _, rows in self.chunk_dirs)
+
+    @property
+    def columns(self) -> list:
+        return list(COLUMNS)
+
+    def __getitem__(self, column: str) -> ChunkedColumn:
+        if column not in COLUMNS:
+            raise KeyError(f"unknown column {column}, expected one of {list(COLUMNS)}")
+        if column not in self._columns:
+            dtype, shape = COLUMNS[column]
+            chunks = [np.load(os.path.join(chunk_dir, column + ".npy"), mmap_mode="r")
+                      for _, chunk_dir, _ in self.chunk_dirs]
+            self._columns[column] = ChunkedColumn(chunks, dtype, shape)
+        return self._columns[column]
+
+    def iter_chunks(self, columns: list = None):
+        """
+        yields ({column: memory-mapped array}, stream) one chunk at a time
+        """
+        columns = columns or self.columns
+        views = [self[column] for column in columns]
+        for i, (stream, _, _) in enumerate(self.chunk_dirs):
+            yield {column: view.chunks[i] for column, view in zip(columns, views)}, stream
+
+    def select(self, where, columns: list = None) -> dict:
+        """
+        rows for which where(chunk) is True. where is evaluated chunk by chunk on the memory-mapped columns,
+        only the matching rows of `columns` are copied into memory
+        """
+        columns = columns or self.columns
+        out = {column: [] for column in columns}
+        for chunk, _ in self.iter_chunks():
+            mask = np.asarray(where(chunk), dtype=bool)
+            if not mask.any():
+                continue
+            for column in columns:
+                out[column].append(chunk[column][mask])
+        return {column: np.concatenate(parts) if parts else
+                np.zeros((0,) + COLUMNS[column][1], dtype=COLUMNS[column][0]) for column, parts in out.items()}
@@ -0,0 +1,154 @@
+import socket
+import struct
+
+from .frame_decoder import POISON_BYTES
+
+# Multi-action transactions: a sequence of actions is sent to the tracer in one compact binary frame
+# and the tracer answers with one group of events per action, tagged by the action's sequence index.
+#
+# request (NAV -> tracer). Never starts with 0x80 so it can not be mistaken for the pickled
+# tuples of single actions
+#
+#       u32          u32        u8      u8         u64 * arity
+# .-------------.---------.--------.-----------.--------------.-...
+# |  TXN_MAGIC  |  count  | arity  | none mask |    values    | ... one entry per action
+# `-------------`---------`--------`-----------`--------------`-...
+#
+# bit i of the none mask is set when value i of the action is None (e.g. (1, None))
+#
+# response (tracer -> NAV), one group per action in sequence order
+#
+#       u32            u32       u32
+# .---------------.---------.----------.-----------------------------------.
+# | TXN_GROUP     |   seq   |  length  | length bytes of POISON frames ... |
+# `---------------`---------`----------`-----------------------------------`
+#
+# Negotiated like the event schema: NAV asks for transactions by starting the tracer with
+# CANNOLI_TRANSACTIONS=1 (see Bench.run) and a tracer that handles them acknowledges by sending the
+# TXN_ACK frame before anything else. A tracer that does not answer with TXN_ACK within ACK_TIMEOUT
+# seconds only gets single actions.
+
+TXN_MAGIC = 0x36afb082
+TXN_GROUP = 0x36afb083
+
+REQUEST_HEADER = struct.Struct("<II")
+ACTION_HEADER = struct.Struct("<BB")
+VALUE = struct.Struct("<Q")
+GROUP_HEADER = struct.Struct("<III")
+GROUP_MAGIC_BYTES = TXN_GROUP.to_bytes(4, "little")
+
+TXN_ACK = b"CTX1"
+TXN_ACK_FRAME = POISON_BYTES + struct.pack("<I", len(TXN_ACK)) + TXN_ACK
+ACK_TIMEOUT = 5.0
+
+
+def encode_transaction(actions: list) -> bytes:
+    out = bytearray(REQUEST_HEADER.pack(TXN_MAGIC, len(actions)))
+    for action in actions:
+        none_mask = 0
+        for i, value in enumerate(action):
+            if value is None:
+                none_mask |= 1 << i
+        out += ACTION_HEADER.pack(len(action), none_mask)
+        for value in action:
+            out += VALUE.pack(0 if value is None else value & 0xFFFFFFFFFFFFFFFF)
+    return bytes(out)
+
+
+def decode_transaction(data) -> tuple:
+    """
+    returns (actions, bytes consumed) or (None, 0) if data does not hold a complete request yet
+    """
+    if len(data) < REQUEST_HEADER.size:
+        return None, 0
+    magic, count = REQUEST_HEADER.unpack_from(data, 0)
+    if magic != TXN_MAGIC:
+        raise ValueError(f"not a transaction: {magic:#x}")
+    pos = REQUEST_HEADER.size
+    actions = []
+    for _ in range(count):
+        if len(data) < pos + ACTION_HEADER.size:
+            return None, 0
+        arity, none_mask = ACTION_HEADER.unpack_from(data, pos)
+        pos += ACTION_HEADER.size
+        if len(data) < pos + arity * VALUE.size:
+            return None, 0
+        values = []
+        for i in range(arity):
+            values.append(None if none_mask & (1 << i) else VALUE.unpack_from(data, pos)[0])
+            pos += VALUE.size
+        actions.append(tuple(values))
+    return actions, pos
+
+
+def read_ack(conn: socket.socket, timeout: float = ACK_TIMEOUT) -> tuple:
+    """
+    waits for the TXN_ACK frame on a freshly connected tracer socket. Returns (acknowledged, data) where
+    data holds the bytes read that were not an acknowledgement, they belong to the event stream
+    """
+    data = b""
+    previous = conn.gettimeout()
+    conn.settimeout(timeout)
+    try:
+        # never read past the ack, and stop as soon as the bytes can not be one
+        while len(data) < len(TXN_ACK_FRAME) and TXN_ACK_FRAME.startswith(data):
+            b = conn.recv(len(TXN_ACK_FRAME) - len(data))
+            if not b:
+                break
+            data += b
+    except OSError:
+        pass
+    finally:
+        conn.settimeout(previous)
+    if data == TXN_ACK_FRAME:
+        return True, b""
+    return False, data
+
+
+def encode_group(seq: int, frames: bytes) -> bytes:
+    return GROUP_HEADER.pack(TXN_GROUP, seq, len(frames)) + frames
+
+
+class GroupDecoder:
+    """
+    incremental decoder of transaction response groups, same cursor based approach as FrameDecoder
+    """
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.pos = 0
+        self.dropped = 0
+
+    def __len__(self) -> int:
+        return len(self.buf) - self.pos
+
+    def feed(self, data) -> None:
+        if self.pos == len(self.buf):
+            self.buf.clear()
+            self.pos = 0
+        elif self.pos * 2 >= len(self.buf):
+            del self.buf[:self.pos]
+            self.pos = 0
+        self.buf += data
+
+    def next_group(self):
+        """
+        returns (seq, frames) or None if the buffer does not hold a complete group yet
+        """
+        while len(self) >= GROUP_HEADER.size:
+            magic, seq, length = GROUP_HEADER.unpack_from(self.buf, self.pos)
+            if magic != TXN_GROUP:
+                idx = self.buf.find(GROUP_MAGIC_BYTES, self.pos + 1)
+                idx = len(self.buf) - len(GROUP_MAGIC_BYTES) + 1 if idx < 0 else idx
+                idx = max(idx, self.pos + 1)
+                self.dropped += idx - self.pos
+                self.pos = idx
+                continue
+            end = self.pos + GROUP_HEADER.size + length
+            if end > len(self.buf):
+                return None
+            with memoryview(self.buf) as view:
+                frames = bytes(view[self.pos + GROUP_HEADER.size:end])
+            self.pos = end
+            return seq, frames
+        return None
@@ -0,0 +1,138 @@
+import multiprocessing as mp
+import os
+
+import numpy as np
+import torch
+
+from .cannoli_env import CannoliEnv
+
+
+def serve_env(remote, parent_remote, env_kwargs: dict, handlers: dict):
+    """
+    runs a single CannoliEnv (and therefore a single tracer) in a worker process and answers every
+    (cmd, data) request coming over the pipe with handlers[cmd](env, data), until "close"
+    """
+    parent_remote.close()
+    env = CannoliEnv(**env_kwargs)
+    try:
+        while True:
+            cmd, data = remote.recv()
+            if cmd == "close":
+                break
+            if cmd not in handlers:
+                raise ValueError(f"unknown command {cmd}")
+            remote.send(handlers[cmd](env, data))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        env.close()
+        remote.close()
+
+
+def _step(env: CannoliEnv, action) -> tuple:
+    obs, reward, done, info = env.step(action)
+    info = {"terminal_observation": obs.clone()} if done else {}
+    if done:
+        # auto-reset so the next batched step starts a fresh episode
+        obs = env.reset()
+    return obs, reward, done, info
+
+
+def _reset(env: CannoliEnv, _) -> torch.Tensor:
+    return env.reset()
+
+
+def _worker(remote, parent_remote, env_kwargs: dict):
+    # serves the step / reset requests of VectorCannoliEnv
+    serve_env(remote, parent_remote, env_kwargs, {"step": _step, "reset": _reset})
+
+
+class VectorCannoliEnv:
+    """
+    Steps N independent CannoliEnvs in lock-step. Every env lives in its own worker process and owns
+    its own tracer: a /tmp/nav_<id> socket and a bench working directory, so episode collection scales with
+    the number of cores instead of one target's round-trip latency. All envs write their traces to the same
+    WAL mode database, as separate runs.
+
+    step(actions[N]) -> obs[N], rewards[N], dones[N], infos[N]
+
+    Environments are reset automatically at the end of an episode; the observation returned for a done
+    env is the first observation of its next episode and the final one is kept in
+    infos[i]["terminal_observation"].
+
+    Any extra keyword argument (event_schema, reset_mode, ...) is forwarded to every CannoliEnv.
+    """
+
+    def __init__(self, executable_identifier, max_steps_episode: int, action_space: np.array, episodes: int,
+                 epochs: int, num_envs: int, db_dir: str = ".", bench_dirs: list = None, start_method: str = None,
+                 **env_kwargs):
+        if bench_dirs is not None and len(bench_dirs) != num_envs:
+            raise ValueError(f"expected {num_envs} bench directories, got {len(bench_dirs)}")
+
+        self.num_envs = num_envs
+        self.max_steps_episode = max_steps_episode
+        self.action_space = action_space
+        self.observation_shape = (max_steps_episode, 7)
+        self.observation_space = torch.zeros((num_envs,) + self.observation_shape)
+
+        ctx = mp.get_context(start_method)
+        base_id = os.getpid()
+
+        self.nav_ids = [f"{base_id}_{i}" for i in range(num_envs)]
+        self.remotes, self.work_remotes = zip(*[ctx.Pipe() for _ in range(num_envs)])
+        self.processes = []
+        for i, (work_remote, remote) in enumerate(zip(self.work_remotes, self.remotes)):
+            worker_kwargs = dict(env_kwargs,
+                                 executable_identifier=executable_identifier,
+                                 max_steps_episode=max_steps_episode,
+                                 action_space=action_space,
+                                 episodes=episodes,
+                                 epochs=epochs,
+                                 nav_id=self.nav_ids[i],
+                                 db_path=os.path.join(db_dir, "demo.db"),
+                                 bench_dir=bench_dirs[i] if bench_dirs else None)
+            process = ctx.Process(target=_worker, args=(work_remote, remote, worker_kwargs), daemon=True)
+            process.start()
+            self.processes.append(process)
+            work_remote.close()
+
+        self.waiting = False
+        self.closed = False
+
+    def __len__(self):
+        return self.num_envs
+
+    def step_async(self, actions) -> None:
+        assert len(actions) == self.num_envs, f"expected {self.num_envs} actions, got {len(actions)}"
+        for remote, action in zip(self.remotes, actions):
+            remote.send(("step", action))
+        self.waiting = True
+
+    def step_wait(self) -> tuple:
+        results = [remote.recv() for remote in self.remotes]
+        self.waiting = False
+        obs, rewards, dones, infos = zip(*results)
+        self.observation_space = torch.stack(obs)
+        return self.observation_space, torch.tensor(rewards, dtype=torch.float), torch.tensor(dones), list(infos)
+
+    def step(self, actions) -> tuple:
+        self.step_async(actions)
+        return self.step_wait()
+
+    def reset(self, **kwargs):
+        for remote in self.remotes:
+            remote.send(("reset", None))
+        self.observation_space = torch.stack([remote.recv() for remote in self.remotes])
+        return self.observation_space
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        if self.waiting:
+            for remote in self.remotes:
+                remote.recv()
+        for remote in self.remotes:
+            remote.send(("close", None))
+        for process in self.processes:
+            process.join()
+        self.closed = True
@@ -5,39 +5,18 @@ from torch.utils.data import DataLoader
 import torch.optim as optim
 from reward.intrinsic_curiosity_module import ICM
 from agent.recurrent_actor_critic import ActorCritic
-from typing import List
-from agent.replay_buffer import MiniBatch, Batch, Episode
-import csv
-from tdigest import TDigest
-import os
+from agent.factored_action_head import ActionFactors
+from agent.replay_buffer import Batch, RolloutStorage
+from agent.advantage import returns_and_advantages, vtrace
+from agent.actor_learner import ActorLearner
+from libs.instrumentation import PROFILER
+from libs.reproducers import ReproducerSink
+from libs.streaming_quantiles import DecayedQuantiles
+import numpy as np
 
 import ast
 
 
-def discount_rewards(rewards: List[float], discount: float) -> list:
-    # computes the discounted reward given the list of rewards and a discount coefficient
-
-    cumul_reward = []
-    sum_r = 0.0
-
-    for r in reversed(rewards):
-        sum_r = (sum_r * discount) + r
-        cumul_reward.append(sum_r)
-
-    r = list(reversed(cumul_reward))
-    return r
-
-
-def calc_advantage(rewards: list, values: list, last_value: float, gamma: float, lam: float) -> list:
-    # generalized advantage estimation
-    rews = rewards + [last_value]
-    vals = values + [last_value]
-
-    delta = [rews[i] + gamma * vals[i + 1] - vals[i] for i in range(len(rews) - 1)]
-
-    return discount_rewards(delta, gamma * lam)
-
-
 '''
 proximal policy optimization 
 
@@ -76,7 +55,14 @@ class RiskAwarePPO(pl.LightningModule):
             policy_weight: float,
             reward_scale: float,
             weight: float,
-            intrinsic_reward_integration: float
+            intrinsic_reward_integration: float,
+            schedule_group: int = 0,
+            action_head: str = 'flat',
+            actor_learner: dict = None,
+            env_kwargs: dict = None,
+            minibatch_size: int = None,
+            target_kl: float = None,
+            risk_seeking: dict = None
     ):
         super().__init__()
 
@@ -90,9 +76,18 @@ class RiskAwarePPO(pl.LightningModule):
 
         self.actor_lr, self.critic_lr = learning_rate
 
-        self.agent = ActorCritic(state_dim=state_dim, action_dim=self.action_shape,
-                                 hidden_size=latent_space, recurrent_layers=recurrent, actor_lr=self.actor_lr,
-                                 critic_lr=self.critic_lr)
+        if action_head not in ('flat', 'factored'):
+            raise ValueError(f"unknown action_head {action_head}, expected 'flat' or 'factored'")
+        # the factored head scales with the address bits of (command, address) actions instead of their number
+        action_factors = ActionFactors(self.action_space) if action_head == 'factored' else None
+
+        self.agent_kwargs = dict(state_dim=state_dim, action_dim=self.action_shape, hidden_size=latent_space,
+                                 recurrent_layers=recurrent, actor_lr=self.actor_lr, critic_lr=self.critic_lr,
+                                 action_factors=action_factors)
+        self.agent = ActorCritic(**self.agent_kwargs)
+
+        # (h, c) of the shared LSTM carried from step to step of the current episode, see ActorCritic.step
+        self.hidden = self.agent.initial_state()
 
         self.gamma = gamma
         self.lam = lam
@@ -104,9 +99,16 @@ class RiskAwarePPO(pl.LightningModule):
 
         self.batch_size = batch_size
 
-        self.automatic_optimization = False
+        # every collected rollout of batch_size episodes is trained on for nb_optim_steps epochs of shuffled
+        # minibatches of minibatch_size episodes, cut short once the approximate KL divergence from the policy
+        # that collected it exceeds 1.5 * target_kl
+        self.minibatch_size = minibatch_size or batch_size
+        self.target_kl = target_kl
+        # rollouts trained on so far, and the last one whose updates stopped on the KL divergence
+        self.rollouts = 0
+        self.kl_stopped_rollout = -1
 
-        self.optimizer_step = 0
+        self.automatic_optimization = False
 
         if risk_aware:
             self.k = k
@@ -119,19 +121,40 @@ class RiskAwarePPO(pl.LightningModule):
         self.entropy_beta = entropy_beta
         self.clip_ratio = clip_ratio
 
-        self.batch = MiniBatch()
-
-        # encapsulates all the collections that compose an episode
-        self.episode = Episode()
+        # batch_size episodes preallocated, advantages are computed once it is full
+        self.rollout = RolloutStorage(batch_size, steps_per_episode, self.obs_shape[1:], self.hidden.shape)
 
         self.epoch_rewards = []
 
         self.episode_step = 0
         self.avg_ep_reward = 0
 
-        self.state = self.env.reset()
-
-        self.td = TDigest()
+        # actor-learner mode: episodes are collected by rollout worker processes, each with its own env built
+        # from env_kwargs, while this module trains (see agent/actor_learner.py). actor_learner holds workers,
+        # slots and the V-trace truncation levels rho_clip and c_clip. Workers start with the first batch
+        self.actor_learner = actor_learner
+        self.env_kwargs = env_kwargs
+        self.learner = None
+        if actor_learner is not None:
+            self.rho_clip = actor_learner.get('rho_clip', 1.0)
+            self.c_clip = actor_learner.get('c_clip', 1.0)
+
+        self.state = self.env.reset() if actor_learner is None else None
+
+        # number of episodes planned up front and run together by the env's prefix-sharing scheduler,
+        # 0 steps every episode live
+        self.schedule_group = schedule_group if getattr(self.env, "scheduler", None) is not None else 0
+
+        # returns of the recent episodes, their k quantile selects the reproducers. risk_seeking (epsilon, decay)
+        # trains the actor only on the episodes of a rollout above the (1 - epsilon) quantile, the critic still
+        # learns from all of them. Without it the quantiles cover the whole run
+        self.risk_seeking = risk_seeking
+        self.episode_quantiles = DecayedQuantiles(decay=risk_seeking.get('decay', 0.999) if risk_seeking else 1.0)
+        # merged sketch of the other processes' episodes as of the last epoch when training on several devices
+        self.remote_quantiles = None
+
+        # top-quantile episodes are written to reproducibility_criteria/ off the rollout path
+        self.reproducers = ReproducerSink()
 
     def forward(self, x: torch.Tensor):
         pi, action = self.agent.actor(x)
@@ -139,8 +162,10 @@ class RiskAwarePPO(pl.LightningModule):
 
         return pi, action, value
 
-    def _compute_episode_reward(self, rewards, values):
-        last_value = values[-1][-1]
+    def _compute_episode_reward(self, rewards, values, dones):
+        # rewards, values and dones are [episodes, steps_per_episode], advantages of every finished episode
+        # of the batch are computed in one pass
+        last_value = values[:, -1]
 
         # enrich rewards with intrinsic reward
         # intr_temp_reward = self.icm.temp_reward(self.episode.rewards, self.episode.states, self.episode.actions)
@@ -150,84 +175,194 @@ class RiskAwarePPO(pl.LightningModule):
         # agg_rewards = (1. - self.intr_weight) * self.episode.rewards + self.intr_weight * intrinsic
         agg_rewards = rewards
 
-        qvals = discount_rewards(agg_rewards + [last_value], self.gamma)[:-1]
-        adv = calc_advantage(agg_rewards, values, last_value, self.gamma, self.lam)
+        qvals, adv = returns_and_advantages(agg_rewards, values, dones, last_value, self.gamma, self.lam)
 
-        assert len(qvals) == self.steps_per_episode and len(adv) == self.steps_per_episode
+        assert qvals.shape[1] == self.steps_per_episode and adv.shape[1] == self.steps_per_episode
 
         return qvals, adv
 
-    def train_batch(self) -> tuple:
-        for episode_idx in range(self.episodes):
-            for step in range(self.steps_per_episode):
-                pi, action, log_prob, value = self.agent(self.state)
+    def _finish_episodes(self):
+        rollout, n = self.rollout, self.rollout.size
+        if not n:
+            return
+        if self.learner is None:
+            qvals, adv = self._compute_episode_reward(rollout.rewards[:n], rollout.values[:n], rollout.dones[:n])
+        else:
+            qvals, adv = self._correct_episode_reward(n)
+        rollout.returns[:n], rollout.advantages[:n] = qvals, adv
+        if self.risk_seeking is not None:
+            threshold = self._quantiles().quantile(1 - self.risk_seeking.get('epsilon', 0.05))
+            rollout.selected[:n] = rollout.rewards[:n].sum(-1) >= threshold
+        # every minibatch carries the index of its rollout. The loader fetches one minibatch ahead of
+        # training_step, so a minibatch is still in flight when training_step stops the rollout on the KL
+        # divergence, and reaches it after the next rollout started. Keyed to its rollout it can neither train the
+        # actor nor stop the next rollout. The shuffled minibatches are copies of the rows, which is what lets
+        # the one in flight outlive the reset and the writes of the next collection
+        self.rollouts += 1
+        rollout_idx = self.rollouts
+        for _ in range(max(self.nb_optim_steps, 1)):
+            for minibatch in rollout.minibatches(self.minibatch_size, shuffle=True):
+                if self.kl_stopped_rollout == rollout_idx:
+                    break
+                yield minibatch + (rollout_idx,)
+        rollout.reset()
+
+    def _correct_episode_reward(self, n: int):
+        # episodes of the actor-learner mode were collected by an older policy, V-trace targets and advantages
+        # are computed with the current one
+        rollout = self.rollout
+        with torch.no_grad():
+            pi, values = self.agent.evaluate(rollout.obs[:n], rollout.hidden[:n])
+        values = values[..., 0]
+        return vtrace(rollout.logp[:n], pi.log_prob(rollout.actions[:n]), rollout.rewards[:n], values,
+                      rollout.dones[:n], values[:, -1], self.gamma, rho_clip=self.rho_clip, c_clip=self.c_clip)
+
+    def _record_episode(self, rewards: list, actions: list, final_state: torch.Tensor) -> None:
+        sum_episode_rewards = sum(rewards)
+        self.epoch_rewards.append(sum_episode_rewards)
+
+        self.episode_quantiles.update(sum_episode_rewards)
+        top_quintile = self._quantiles().quantile(self.k)
+        if sum_episode_rewards >= top_quintile:
+            # rows of the final observation are the states the episode's actions led to
+            self.reproducers.submit(self.current_epoch, [self.action_space[int(x)] for x in actions],
+                                    final_state[:len(actions)].numpy())
+
+    def _quantiles(self) -> DecayedQuantiles:
+        if self.remote_quantiles is None:
+            return self.episode_quantiles
+        return self.episode_quantiles.merge(self.remote_quantiles)
+
+    def _sync_quantiles(self) -> None:
+        # every process trains on its own env, thresholds are taken over the episodes of all of them
+        if self.trainer.world_size == 1:
+            return
+        size = 2 * self.episode_quantiles.max_centroids
+        gathered = self.all_gather(torch.from_numpy(self.episode_quantiles.centroids(size))).cpu().numpy()
+        others = np.concatenate([c for rank, c in enumerate(gathered) if rank != self.global_rank])
+        self.remote_quantiles = DecayedQuantiles.from_centroids(others[:, 0], others[:, 1],
+                                                                decay=self.episode_quantiles.decay)
+
+    def _learner_batch(self):
+        for _ in range(self.episodes):
+            episode = self.learner.get()
+            self.rollout.insert_episode(episode["states"], episode["next_states"], episode["actions"],
+                                        episode["logp"], episode["rewards"], episode["dones"], episode["hidden"])
+            self._record_episode(episode["rewards"].tolist(), episode["actions"].tolist(), episode["final_state"])
+            self.avg_ep_reward = sum(self.epoch_rewards) / self.steps_per_episode
 
-                assert action.shape[0] == self.steps_per_episode
+            if self.rollout.full():
+                yield from self._finish_episodes()
+
+        yield from self._finish_episodes()
+
+    def _live_steps(self):
+        for step in range(self.steps_per_episode):
+            # the policy acts on the row the previous step wrote, the LSTM state carries the rows before it
+            observation = self.state[step - 1] if step else torch.zeros_like(self.state[0])
+            hidden = self.hidden
+            with PROFILER.span("policy_forward"):
+                pi, action, log_prob, value, self.hidden = self.agent.step(observation, hidden)
+
+            next_state, reward, done, _ = self.env.step(self.action_space[action])
+            yield step, observation, hidden, action, log_prob, value, next_state, reward, done
+
+    def _plan(self) -> list:
+        # an open loop plan, one (observation, hidden, action, log_prob, value) per step. The whole plan is
+        # sampled before anything runs, so every step acts on the zeroed initial observation and only the LSTM
+        # state tells the steps apart: scheduled episodes train an observation-blind policy
+        plan = []
+        hidden = self.agent.initial_state()
+        # the env writes its observation in place as the scheduled steps are applied
+        for observation in self.state.clone():
+            with PROFILER.span("policy_forward"):
+                pi, action, log_prob, value, next_hidden = self.agent.step(observation, hidden)
+            plan.append((observation, hidden, action, log_prob, value))
+            hidden = next_hidden
+        return plan
+
+    def _scheduled_episodes(self, n: int) -> list:
+        plans = [self._plan() for _ in range(n)]
+        results = self.env.run_scheduled([[self.action_space[int(action)] for _, _, action, _, _ in plan]
+                                          for plan in plans])
+        return [[(step,) + planned + (next_state, reward, done)
+                 for step, (planned, (next_state, reward, done, _)) in enumerate(zip(plan, steps))]
+                for plan, steps in zip(plans, results)]
+
+    def _start_learner(self) -> None:
+        # started by the first batch, which the loop may fetch before any training hook runs
+        self.learner = ActorLearner(self.env_kwargs, self.agent_kwargs, self.agent,
+                                    num_workers=self.actor_learner.get('workers', 2),
+                                    slots=self.actor_learner.get('slots'),
+                                    inference=self.actor_learner.get('inference'))
 
-                # for the action of the current step, take the indexed action from the action space
+    def train_batch(self) -> tuple:
+        if self.actor_learner is not None and self.learner is None:
+            self._start_learner()
+        if self.learner is not None:
+            yield from self._learner_batch()
+            return
 
-                next_state, reward, done, _ = self.env.step(self.action_space[action[step]])
+        scheduled = []
+        for episode_idx in range(self.episodes):
+            if self.schedule_group and not scheduled:
+                scheduled = self._scheduled_episodes(min(self.schedule_group, self.episodes - episode_idx))
+            steps = scheduled.pop(0) if self.schedule_group else self._live_steps()
 
+            for step, observation, hidden, action, log_prob, value, next_state, reward, done in steps:
                 assert next_state.shape[0] == self.steps_per_episode
 
                 self.episode_step += 1
 
-                self.batch.update_experience(state=self.state[step, :], next_state=next_state[step, :],
-                                             action=action[step],
-                                             logp=log_prob[step])
-                self.episode.update(reward=reward, value=value, state=self.state[step], action=action[step])
+                # a finished episode is not bootstrapped, one cut off at steps_per_episode is. Training replays
+                # the episode from the LSTM state carried into its first step
+                self.rollout.insert(step, observation, next_state[step, :], action, log_prob, value, reward, done,
+                                    hidden=hidden if not step else None)
 
                 self.state = next_state
 
-                terminal = len(self.episode.rewards) == self.steps_per_episode
+                terminal = step + 1 == self.steps_per_episode
 
                 if done or terminal:
-                    qvals, adv = self._compute_episode_reward(self.episode.rewards, self.episode.values)
-
-                    sum_episode_rewards = sum(self.episode.rewards)
-                    self.epoch_rewards.append(sum_episode_rewards)
-
-                    self.td.update(sum_episode_rewards)
-                    top_quintile = self.td.percentile(self.k)
-                    if sum_episode_rewards >= top_quintile:
-                        filename = f'reproducibility_criteria/epoch:{self.current_epoch}.csv'
-                        file_exists = os.path.isfile(filename)
-
-                        # Open the file in the appropriate mode
-                        mode = 'a' if file_exists else 'w'
-                        with open(filename, mode) as csvfile:
-                            reproducibility_criteria = csv.writer(csvfile)
-                            human_read_actions = [self.action_space[int(x)] for x in self.episode.actions]
-                            reproducibility_criteria.writerow(human_read_actions)
-                            human_read_states = []
-                            for state in self.episode.states:
-                                req_crc = int(state[0])
-                                valid_key = int(state[1])
-                                crc_magic1 = int(state[2])
-                                crc_magic2 = int(state[3])
-                                ret = int(state[4])
-                                command = int(state[5])
-                                invariant = int(state[6])
-                                human_read_states.append({"req_crc": req_crc, "valid_key": valid_key,
-                                                          "crc_magic1": crc_magic1, "crc_magic2": crc_magic2,
-                                                          "ret": ret,
-                                                          "command": command, "invariant": invariant})
-
-                            reproducibility_criteria.writerow(human_read_states)
+                    row = self.rollout.end_episode(step + 1)
+                    self._record_episode(self.rollout.rewards[row, :step + 1].tolist(),
+                                         self.rollout.actions[row, :step + 1].tolist(), next_state)
 
                     # reset episode
-                    self.episode.reset()
                     self.episode_step = 0
-                    self.state = self.env.reset()
-
-                    yield torch.stack(self.batch.states), torch.stack(self.batch.next_states), torch.stack(
-                        self.batch.actions), \
-                        torch.stack(self.batch.logp), adv[-1], qvals[-1]
+                    self.hidden = self.agent.initial_state()
+                    # run_scheduled already started the env's next episode
+                    self.state = torch.zeros(self.obs_shape) if self.schedule_group else self.env.reset()
 
-                    self.batch.reset()
+                    if self.rollout.full():
+                        yield from self._finish_episodes()
 
             self.avg_ep_reward = sum(self.epoch_rewards) / self.steps_per_episode
 
+        yield from self._finish_episodes()
+
+    def on_train_batch_end(self, outputs, batch, batch_idx) -> None:
+        # rollout workers pick up the new weights with their next episode
+        if self.learner is not None:
+            self.learner.publish(self.agent)
+
+    def on_train_epoch_end(self) -> None:
+        # per phase p50/p99 step latency of the epoch, see libs/instrumentation.py
+        if PROFILER.enabled:
+            self.log_dict(PROFILER.summary())
+            PROFILER.reset()
+        cache = getattr(self.env, "cache", None)
+        if cache is not None:
+            self.log_dict(cache.metrics())
+        if self.learner is not None:
+            self.log_dict(self.learner.metrics())
+        self._sync_quantiles()
+
+    def on_train_end(self) -> None:
+        if self.learner is not None:
+            self.learner.close()
+        self.reproducers.close()
+
     def configure_optimizers(self) -> tuple:
         # initialize optimizer
         optimizer_actor = optim.Adam(self.agent.actor.parameters(), lr=self.actor_lr)
@@ -235,12 +370,9 @@ class RiskAwarePPO(pl.LightningModule):
 
         return optimizer_actor, optimizer_critic
 
-    def optimizer_step(self, *args, **kwargs):
-        for i in range(self.nb_optim_steps):
-            super().optimizer_step(*args, **kwargs)
-
     def train_dataloader(self) -> DataLoader:
-        return DataLoader(dataset=Batch(self.train_batch), batch_size=self.batch_size)
+        # train_batch yields whole minibatches, copies of rows of the rollout storage (see _finish_episodes)
+        return DataLoader(dataset=Batch(self.train_batch), batch_size=None)
 
     def _assert_batch(self, state, next_state, action, old_logp, adv, qval):
         assert state.shape[0] <= self.batch_size
@@ -258,34 +390,48 @@ class RiskAwarePPO(pl.LightningModule):
         assert qval.shape[0] <= self.batch_size
 
     def training_step(self, batch: tuple, batch_idx):
-        state, next_state, action, old_logp, adv, qval = batch
+        state, next_state, action, old_logp, adv, qval, hidden, selected, rollout_idx = batch
 
         self._assert_batch(state, next_state, action, old_logp, adv, qval)
 
-        adv = (adv - adv.mean()) / adv.std()
-
         self.log("avg_ep_reward", self.avg_ep_reward, prog_bar=True, on_step=False, on_epoch=True)
 
-        if not self.optimizer_step:
+        optimizer_actor, optimizer_critic = self.optimizers()
+
+        # minibatches of a rollout stopped on the KL divergence only still train the critic
+        if selected.any() and rollout_idx != self.kl_stopped_rollout:
+            # risk-seeking, the actor only learns from the episodes above the return threshold
+            actor_batch = (state, action, old_logp, adv, hidden) if selected.all() else \
+                (state[selected], action[selected], old_logp[selected], adv[selected], hidden[selected])
+            actor_state, actor_action, actor_logp, actor_adv, actor_hidden = actor_batch
+            actor_adv = (actor_adv - actor_adv.mean()) / actor_adv.std()
 
-            loss_actor = self.actor_loss(state, action, old_logp, adv)
+            loss_actor, approx_kl = self.actor_loss(actor_state, actor_action, actor_logp, actor_adv, actor_hidden)
             self.log('loss_actor_raw', loss_actor, on_step=False, on_epoch=True, prog_bar=True, logger=True)
+            self.log('approx_kl', approx_kl, on_step=False, on_epoch=True, prog_bar=False, logger=True)
             # intrinsic_loss = self.icm.loss(loss_actor, action, next_state, state)
             # self.log('loss_actor_curious', loss_actor, on_step=False, on_epoch=True, prog_bar=True, logger=True)
-            self.optimizer_step = 1
-            return loss_actor
-        else:
-
-            loss_critic = self.critic_loss(state, qval)
-            self.log('loss_critic', loss_critic, on_step=False, on_epoch=True, prog_bar=False, logger=True)
-            self.optimizer_step = 0
-            return loss_critic
+            if self.target_kl is not None and approx_kl > 1.5 * self.target_kl:
+                # the policy moved too far from the one that collected the rollout, its remaining minibatches
+                # are skipped
+                self.kl_stopped_rollout = rollout_idx
+            else:
+                optimizer_actor.zero_grad()
+                self.manual_backward(loss_actor)
+                optimizer_actor.step()
+
+        # after the actor step, the LSTM is shared
+        loss_critic = self.critic_loss(state, qval, hidden)
+        self.log('loss_critic', loss_critic, on_step=False, on_epoch=True, prog_bar=False, logger=True)
+        optimizer_critic.zero_grad()
+        self.manual_backward(loss_critic)
+        optimizer_critic.step()
 
     def get_device(self, batch) -> str:
         return batch[0].device.index if self.on_gpu else 'cpu'
 
-    def actor_loss(self, state, action, logp_old, adv) -> torch.Tensor:
-        pi, _ = self.agent.actor(state)
+    def actor_loss(self, state, action, logp_old, adv, hidden) -> tuple:
+        pi, _ = self.agent.evaluate(state, hidden)
         logp = self.agent.actor.get_log_prob(pi, action)
         ratio = torch.exp(logp - logp_old)
 
@@ -293,11 +439,15 @@ class RiskAwarePPO(pl.LightningModule):
         clip_adv = torch.clamp(ratio, 1 - self.clip_ratio, 1 + self.clip_ratio) * adv
         loss_actor = -(torch.min(ratio * adv, clip_adv)).mean()
 
-        return loss_actor
+        # KL(old || new) estimated from the ratios of the sampled actions, (r - 1) - log r
+        with torch.no_grad():
+            approx_kl = ((ratio - 1) - (logp - logp_old)).mean()
+
+        return loss_actor, approx_kl
 
-    def critic_loss(self, state, qval) -> torch.Tensor:
-        value = self.agent.critic(state)
-        loss_critic = (qval - value).pow(2).mean()
+    def critic_loss(self, state, qval, hidden) -> torch.Tensor:
+        _, value = self.agent.evaluate(state, hidden)
+        loss_critic = (qval.unsqueeze(-1) - value).pow(2).mean()
 
         assert value.shape[0] <= self.batch_size and value.shape[1] == self.steps_per_episode and len(value.shape) == 3
 
@@ -2,7 +2,10 @@ import os
 from argparse import ArgumentParser
 from pytorch_lightning import Trainer
 from proximal_policy_optimization import RiskAwarePPO
+from libs.action_space import ActionSpace
 from libs.cannoli_env import CannoliEnv
+from libs.instrumentation import PROFILER
+from libs.reproducers import verify_reproducers
 import yaml
 import numpy as np
 import ast
@@ -16,6 +19,8 @@ else:
     _GYM_AVAILABLE = True
 
 CONFIG_DIR = f"{os.getcwd()}" + "/configuration/cromulence_demoone/"
+# materialized action space specs, shared by every iteration
+ACTION_SPACE_CACHE = f"{os.getcwd()}" + "/previous_runs/action_spaces/"
 
 
 class Navigator:
@@ -30,7 +35,11 @@ class Navigator:
         with open(CONFIG_DIR + self.exec_identifier + '.yaml', 'r') as file:
             self.x = yaml.safe_load(file)
 
+        if self.x.get('profile', False):
+            PROFILER.enabled = True
+
         self.dir_path = os.getcwd() + "/" + f"previous_runs/iteration_{iteration_number}" + "/"
+        os.makedirs(self.dir_path, exist_ok=True)
 
         self.ppo = self.load()
 
@@ -42,15 +51,39 @@ class Navigator:
 
     def load(self):
 
-        with open(CONFIG_DIR + self.x['actions'], 'r') as file:
-            actions = yaml.safe_load(file)
-            actions = actions.split(" ")
-            trans_actions = []
-            for action in actions:
-                action = tuple(map(int, action.split(',')))
-                trans_actions.append(action)
-
-        env = CannoliEnv(self.exec_identifier, self.x['steps'], trans_actions, self.x['episodes'], self.x['epochs'])
+        if self.x.get('action_space'):
+            # declarative spec, see libs/action_space.py
+            trans_actions = ActionSpace(self.x['action_space'], cache_dir=ACTION_SPACE_CACHE)
+        else:
+            with open(CONFIG_DIR + self.x['actions'], 'r') as file:
+                actions = yaml.safe_load(file)
+                actions = actions.split(" ")
+                trans_actions = []
+                for action in actions:
+                    action = tuple(map(int, action.split(',')))
+                    trans_actions.append(action)
+
+        # traces of every iteration end up in previous_runs/ where libs/run_history.py finds them
+        env_kwargs = dict(executable_identifier=self.exec_identifier, max_steps_episode=self.x['steps'],
+                          action_space=trans_actions, episodes=self.x['episodes'], epochs=self.x['epochs'],
+                          db_path=self.dir_path + "trace.db",
+                          event_schema=self.x.get('event_schema', 'json'),
+                          reset_mode=self.x.get('reset_mode', 'respawn'),
+                          tracer_pool=self.x.get('tracer_pool'),
+                          invariants=self.x.get('invariants'),
+                          trace_writer=self.x.get('trace_writer'),
+                          trajectory_dir=self.dir_path + "trajectories" if self.x.get('trajectories') else None,
+                          prefix_cache=self.x.get('prefix_cache'),
+                          scheduler=self.x.get('scheduler'),
+                          transactions=self.x.get('transactions', False))
+        env = CannoliEnv(**env_kwargs)
+
+        # settings of the envs replaying reproducers once training is done
+        self.replay_env_kwargs = dict(executable_identifier=self.exec_identifier, action_space=trans_actions,
+                                      episodes=1, epochs=1, db_path=self.dir_path + "replay.db",
+                                      event_schema=self.x.get('event_schema', 'json'),
+                                      invariants=self.x.get('invariants'),
+                                      transactions=self.x.get('transactions', False))
 
         return RiskAwarePPO(
             self.dir_path,
@@ -74,8 +107,21 @@ class Navigator:
             self.x['policy_weight'],
             self.x['reward_scale'],
             self.x['weight'],
-            self.x['intrinsic_reward_integration']
+            self.x['intrinsic_reward_integration'],
+            schedule_group=(self.x.get('scheduler') or {}).get('group', 0),
+            action_head=self.x.get('action_head', 'flat'),
+            actor_learner=self.x.get('actor_learner'),
+            env_kwargs=env_kwargs,
+            minibatch_size=self.x.get('minibatch_size'),
+            target_kl=self.x.get('target_kl'),
+            risk_seeking=self.x.get('risk_seeking')
         )
 
     def navigate(self):
         self.trainer.fit(self.ppo)
+
+        if self.x.get('verify_reproducers'):
+            results = verify_reproducers(self.ppo.reproducers.root, self.replay_env_kwargs,
+                                         **self.x['verify_reproducers'])
+            deterministic = sum(r["deterministic"] for r in results)
+            print(f"[*] NAV: {deterministic}/{len(results)} reproducers hit their invariants deterministically")